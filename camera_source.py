@@ -0,0 +1,361 @@
+"""camera_source.py
+Reads frames of an IP camera (e.g. the IP Webcam app) on a background thread, so that the query loop always
+gets the latest frame without waiting for the network
+
+StandInCamera serves the frames of a video file the way such a camera does, so that IPCameraSource (and the
+livestream mode of RealTimeMatching) can be tried without a phone:
+    python camera_source.py testData/query.mp4 8080
+then http://127.0.0.1:8080/shot.jpg (snapshots) or http://127.0.0.1:8080/video (MJPEG)
+"""
+
+import sys
+import time
+import socket
+import threading
+import http.client
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit
+import cv2
+import numpy as np
+
+REDUCED_GRAYSCALE = {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                     8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+
+class IPCameraSource:
+    """
+    Fetches JPEG frames over one keep-alive HTTP connection, either by requesting a snapshot url
+    (e.g. http://ip:8080/shot.jpg) or by reading an MJPEG stream (e.g. http://ip:8080/video).
+    Only the JPEG of the latest frame is kept, and it is decoded (straight to grayscale at 1 / reduction of its
+    size) when read, so frames which arrive before it is read are dropped without being decoded. A snapshot is
+    requested once the last one has been read, and at most max_fps times a second, so the camera isn't asked
+    for frames nobody reads. Lost connections are retried with exponential backoff.
+
+    Usage:
+        source = IPCameraSource(url).start()
+        ret, gray = source.read()
+        source.stop()
+
+    Attributes
+    __________
+    frame_id : int
+        no of frames fetched, the id of the latest frame
+    frames_dropped : int
+        no of frames replaced before being read
+    reconnects : int
+        no of times the connection was made again after failing
+    """
+
+    def __init__(self, url: str, mjpeg: bool = False, reduction: int = 1, timeout: float = 5,
+                 min_backoff: float = 0.5, max_backoff: float = 8, max_fps: float = 30,
+                 max_frame_bytes: int = 8 << 20):
+        if reduction not in REDUCED_GRAYSCALE:
+            raise Exception("reduction should be one of " + str(list(REDUCED_GRAYSCALE.keys())))
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path + ("?" + parts.query if parts.query else "") or "/"
+        self.https = parts.scheme == "https"
+        self.mjpeg = mjpeg
+        self.imread_flag = REDUCED_GRAYSCALE[reduction]
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.max_fps = max_fps
+        self.max_frame_bytes = max_frame_bytes  # larger MJPEG parts are taken as a broken stream
+        self.connection = None
+        self.thread = None
+        self.running = False
+        self.condition = threading.Condition()
+        self.latest = None  # JPEG bytes of the latest frame
+        self.requested_at = 0.0
+        self.frame_id = 0
+        self.read_id = 0
+        self.frames_dropped = 0
+        self.reconnects = 0
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(self.timeout + 1)
+        self._close()
+
+    def release(self):
+        """Same as stop(), so that it can be used in place of cv2.VideoCapture"""
+        self.stop()
+
+    def read(self, timeout: float = None):
+        """
+        Waits for a frame newer than the one read last
+        :param timeout: seconds to wait, None means until a frame arrives or the source is stopped
+        :return: (True, grayscale frame) or (False, None) if no new frame arrived
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.frame_id > self.read_id or not self.running,
+                                        None if deadline is None else max(deadline - time.time(), 0))
+                if self.frame_id == self.read_id:
+                    return False, None
+                self.read_id = self.frame_id
+                jpeg = self.latest
+                self.condition.notify_all()  # the next snapshot can be requested
+            gray = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), self.imread_flag)
+            if gray is not None:
+                return True, gray
+            # Not a JPEG that can be decoded, wait for the next frame
+
+    def _publish(self, jpeg):
+        with self.condition:
+            if self.frame_id > self.read_id:
+                self.frames_dropped += 1
+            self.latest = jpeg
+            self.frame_id += 1
+            self.condition.notify_all()
+
+    def _connect(self):
+        connection_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        self.connection = connection_class(self.host, self.port, timeout=self.timeout)
+
+    def _close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def _run(self):
+        backoff = self.min_backoff
+        while self.running:
+            try:
+                if self.connection is None:
+                    self._connect()
+                if self.mjpeg:
+                    self._read_stream()
+                else:
+                    self._read_snapshot()
+                backoff = self.min_backoff
+            except (OSError, http.client.HTTPException) as exception:
+                self._close()
+                if not self.running:
+                    break
+                print("Camera connection failed (" + str(exception) + "), retrying in " + str(backoff) + " s")
+                with self.condition:
+                    self.condition.wait_for(lambda: not self.running, backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                self.reconnects += 1
+
+    def _get(self):
+        self.connection.request("GET", self.path)
+        return self.connection.getresponse()
+
+    def _read_snapshot(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.frame_id == self.read_id or not self.running)
+            self.condition.wait_for(lambda: not self.running,
+                                    max(self.requested_at + 1 / self.max_fps - time.time(), 0))
+        if not self.running:
+            return
+        self.requested_at = time.time()
+        try:
+            response = self._get()
+        except (http.client.RemoteDisconnected, ConnectionError):
+            # The camera may close a keep-alive connection left idle while the last frame wasn't read
+            self._close()
+            self._connect()
+            response = self._get()
+        jpeg = response.read()
+        if response.status != 200:
+            raise http.client.HTTPException("HTTP " + str(response.status))
+        if response.will_close:
+            self._close()  # Server doesn't keep connections alive, connect again for the next frame
+        self._publish(jpeg)
+
+    def _read_stream(self):
+        response = self._get()
+        if response.status != 200:
+            raise http.client.HTTPException("HTTP " + str(response.status))
+        buffer = bytearray()
+
+        def fill():
+            chunk = response.read1(65536)
+            if not chunk:
+                raise http.client.HTTPException("Stream ended")
+            buffer.extend(chunk)
+            if len(buffer) > self.max_frame_bytes + 4096:
+                raise http.client.HTTPException("No frame in the last " + str(len(buffer)) + " bytes of the stream")
+
+        while self.running:
+            # Headers of the next part, e.g. --boundary, Content-Type: image/jpeg, Content-Length: n
+            end = buffer.find(b"\r\n\r\n")
+            if end == -1:
+                fill()
+                continue
+            headers = [line.strip() for line in bytes(buffer[:end]).split(b"\r\n") if line.strip()]
+            del buffer[:end + 4]
+            if len(headers) == 0:
+                continue
+            length = None
+            for header in headers:
+                name, _, value = header.partition(b":")
+                if name.strip().lower() == b"content-length":
+                    if not value.strip().isdigit():
+                        raise http.client.HTTPException("Invalid Content-Length " + repr(value))
+                    length = int(value)
+            if length is None:
+                # No Content-Length, the part ends with the end of image marker of the JPEG
+                while buffer.find(b"\xff\xd9") == -1:
+                    fill()
+                length = buffer.find(b"\xff\xd9") + 2
+            elif length > self.max_frame_bytes:
+                raise http.client.HTTPException("Frame of " + str(length) + " bytes is too large")
+            while len(buffer) < length:
+                fill()
+            self._publish(bytes(buffer[:length]))
+            del buffer[:length]
+        self._close()
+
+
+class StandInCamera:
+    """
+    Local HTTP server standing in for an IP camera: GET /shot.jpg returns the current frame as JPEG (over
+    keep-alive connections), GET /video streams frames as MJPEG (multipart/x-mixed-replace). The frames of
+    the video file are played in a loop at fps, as a camera would give them.
+
+    Usage:
+        camera = StandInCamera("testData/query.mp4", port=8080).start()
+        source = IPCameraSource(camera.url("shot.jpg")).start()
+        ...
+        camera.stop()  # and start() again, e.g. to see IPCameraSource reconnect
+
+    Attributes
+    __________
+    frames : list
+        JPEG bytes of each frame of the video
+    requests : int
+        no of snapshot and stream requests served
+    """
+
+    def __init__(self, video_path: str, host: str = "127.0.0.1", port: int = 8080, fps: float = None,
+                 jpeg_quality: int = 80):
+        cap = cv2.VideoCapture(video_path)
+        self.fps = fps if fps is not None else (cap.get(cv2.CAP_PROP_FPS) or 30)
+        self.frames = []
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            self.frames.append(cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])[1].tobytes())
+        cap.release()
+        if len(self.frames) == 0:
+            raise Exception("No frames could be read from " + str(video_path))
+        self.host = host
+        self.port = port
+        self.server = None
+        self.thread = None
+        self.started_at = None
+        self.connections = set()  # sockets of clients connected
+        self.requests = 0
+
+    def url(self, path: str = "shot.jpg"):
+        return "http://" + self.host + ":" + str(self.port) + "/" + path
+
+    def current_frame(self):
+        """Returns JPEG of the frame being 'seen' now"""
+        return self.frames[int((time.time() - self.started_at) * self.fps) % len(self.frames)]
+
+    def start(self):
+        camera = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive
+
+            def log_message(self, format, *args):
+                pass
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                camera.connections.add(self.connection)
+
+            def finish(self):
+                camera.connections.discard(self.connection)
+                BaseHTTPRequestHandler.finish(self)
+
+            def do_GET(self):
+                camera.requests += 1
+                if self.path.startswith("/shot.jpg"):
+                    jpeg = camera.current_frame()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "image/jpeg")
+                    self.send_header("Content-Length", str(len(jpeg)))
+                    self.end_headers()
+                    self.wfile.write(jpeg)
+                elif self.path.startswith("/video"):
+                    self.send_response(200)
+                    self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=frame")
+                    self.send_header("Connection", "close")
+                    self.end_headers()
+                    try:
+                        while camera.server is not None:
+                            jpeg = camera.current_frame()
+                            self.wfile.write(b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: " +
+                                             str(len(jpeg)).encode() + b"\r\n\r\n" + jpeg + b"\r\n")
+                            time.sleep(1 / camera.fps)
+                    except (ConnectionError, OSError):
+                        pass
+                    self.close_connection = True
+                else:
+                    self.send_error(404)
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+            def handle_error(self, request, client_address):
+                if not isinstance(sys.exc_info()[1], ConnectionError):
+                    HTTPServer.handle_error(self, request, client_address)
+
+        self.server = Server((self.host, self.port), Handler)
+        self.port = self.server.server_address[1]  # port 0 picks a free one
+        if self.started_at is None:
+            self.started_at = time.time()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops serving, connections open are closed so clients see the camera going away"""
+        server, self.server = self.server, None
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            self.thread.join()
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+if __name__ == '__main__':
+    stand_in = StandInCamera(sys.argv[1] if len(sys.argv) > 1 else "testData/query.mp4",
+                             port=int(sys.argv[2]) if len(sys.argv) > 2 else 8080).start()
+    print("Serving " + stand_in.url("shot.jpg") + " and " + stand_in.url("video"))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stand_in.stop()
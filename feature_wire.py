@@ -0,0 +1,136 @@
+"""feature_wire.py
+Compact binary format of the SURF features of a query frame (ImgObj), so that devices can extract features
+themselves and upload them instead of JPEG frames
+
+A payload (little endian) is a header, then a record of KEYPOINT for every keypoint, then the descriptors,
+one row per keypoint, as float32, float16 or int8 (scaled by the scale in the header). The header also
+holds the parameters of the SURF detector used, which are checked against those of the graph (see check).
+With 64 long descriptors, a keypoint takes 280 bytes as float32, 152 as float16 and 88 as int8.
+"""
+
+import struct
+import numpy as np
+import video_operations_3 as vo
+from graph_arena import PackedKeypoints
+
+MAGIC = b"IMGF"
+VERSION = 1
+FLOAT32, FLOAT16, INT8 = range(3)
+ENCODINGS = {"float32": FLOAT32, "float16": FLOAT16, "int8": INT8}
+DTYPES = {FLOAT32: np.dtype("<f4"), FLOAT16: np.dtype("<f2"), INT8: np.dtype("i1")}
+# magic, version, encoding, descriptor length, no of keypoints, time_stamp, height, width, scale of int8
+# descriptors, then detector params: hessian threshold, extended, upright, no of octaves, no of octave layers
+HEADER = struct.Struct("<4sBBHIqHHffBBBB")
+KEYPOINT = np.dtype([("x", "<f4"), ("y", "<f4"), ("size", "<f4"), ("angle", "<f4"), ("response", "<f4"),
+                     ("octave", "<i4")])
+# Parameters of cv2.xfeatures2d_SURF.create(hessian_threshold) with which graph frames are extracted,
+# see video_operations_3.save_distinct_ImgObj
+SURF_DEFAULTS = {"hessian_threshold": 2500, "extended": False, "upright": False, "n_octaves": 4,
+                 "n_octave_layers": 3}
+
+
+class WireError(Exception):
+    pass
+
+
+def detector_params(detector):
+    """Returns dict of parameters of SURF detector, as in SURF_DEFAULTS"""
+    return {"hessian_threshold": detector.getHessianThreshold(), "extended": bool(detector.getExtended()),
+            "upright": bool(detector.getUpright()), "n_octaves": detector.getNOctaves(),
+            "n_octave_layers": detector.getNOctaveLayers()}
+
+
+def graph_detector_params(graph_obj):
+    """Returns dict of parameters of the SURF detector the frames of graph_obj were extracted with"""
+    params = dict(SURF_DEFAULTS)
+    # Graphs pickled before the threshold was recorded were made with the default one
+    if getattr(graph_obj, "hessian_threshold", None) is not None:
+        params["hessian_threshold"] = graph_obj.hessian_threshold
+    return params
+
+
+def check(params, expected, max_hessian_ratio: float = 2.0):
+    """
+    Checks that features extracted with detector params can be matched with those extracted with expected.
+    The hessian threshold only changes how many keypoints are found, so it may differ by up to
+    max_hessian_ratio times (e.g. when raised by load_controller.LoadController), the rest should be the same
+    :return: None if they can be matched, else str saying why not
+    """
+    for key in ("extended", "upright", "n_octaves", "n_octave_layers"):
+        if params[key] != expected[key]:
+            return "Detector " + key + " is " + str(params[key]) + ", graph was made with " + str(expected[key])
+    ratio = params["hessian_threshold"] / expected["hessian_threshold"]
+    if not 1 / max_hessian_ratio <= ratio <= max_hessian_ratio:
+        return "Detector hessian_threshold is " + str(params["hessian_threshold"]) + ", graph was made with " + \
+               str(expected["hessian_threshold"])
+    return None
+
+
+def encode(img_obj, params, encoding: str = "float16"):
+    """
+    :param img_obj: ImgObj of query frame
+    :param params: dict of detector params, see detector_params
+    :param encoding: "float32", "float16" or "int8"
+    :return: bytes
+    """
+    no_of_keypoints, descriptors, serialized_keypoints, shape = img_obj.get_elements()
+    code = ENCODINGS[encoding]
+    length = 128 if params["extended"] else 64
+    if descriptors is None or len(serialized_keypoints) == 0:
+        descriptors = np.zeros((0, length), dtype=np.float32)
+    if descriptors.shape != (len(serialized_keypoints), length):
+        raise WireError("Expected " + str(len(serialized_keypoints)) + " descriptors of length " + str(length))
+    scale = 1.0
+    if code == INT8:
+        scale = float(np.abs(descriptors).max()) / 127 if len(descriptors) > 0 else 1.0
+        scale = scale if scale > 0 else 1.0
+        descriptors = np.round(descriptors / scale)
+    keypoints = np.array([(x, y, size, angle, response, octave) for (x, y), size, angle, response, octave, class_id
+                          in serialized_keypoints], dtype=KEYPOINT)
+    header = HEADER.pack(MAGIC, VERSION, code, length, len(keypoints), img_obj.get_time(), shape[0], shape[1], scale,
+                         params["hessian_threshold"], params["extended"], params["upright"], params["n_octaves"],
+                         params["n_octave_layers"])
+    return header + keypoints.tobytes() + descriptors.astype(DTYPES[code]).tobytes()
+
+
+def decode(payload: bytes):
+    """
+    :return: (ImgObj, dict of detector params), with float32 descriptors
+    """
+    if len(payload) < HEADER.size:
+        raise WireError("Payload too short")
+    magic, version, code, length, count, time_stamp, height, width, scale, hessian_threshold, extended, upright, \
+        n_octaves, n_octave_layers = HEADER.unpack_from(payload)
+    if magic != MAGIC or version != VERSION:
+        raise WireError("Not a version " + str(VERSION) + " feature payload")
+    if code not in DTYPES or length not in (64, 128):
+        raise WireError("Invalid descriptor encoding or length")
+    if length != (128 if extended else 64):
+        raise WireError("Descriptors of length " + str(length) + " don't match extended = " + str(bool(extended)))
+    expected = HEADER.size + count * (KEYPOINT.itemsize + length * DTYPES[code].itemsize)
+    if len(payload) != expected:
+        raise WireError("Payload is " + str(len(payload)) + " bytes, expected " + str(expected))
+    keypoints = np.frombuffer(payload, dtype=KEYPOINT, count=count, offset=HEADER.size)
+    descriptors = np.frombuffer(payload, dtype=DTYPES[code], count=count * length,
+                                offset=HEADER.size + count * KEYPOINT.itemsize).reshape(count, length)
+    descriptors = descriptors.astype(np.float32) * np.float32(scale) if code == INT8 else \
+        descriptors.astype(np.float32)
+    rows = np.empty((count, 7), dtype=np.float32)
+    for column, name in enumerate(KEYPOINT.names):
+        rows[:, column] = keypoints[name]
+    rows[:, 6] = -1  # class_id, not used by SURF
+    params = {"hessian_threshold": hessian_threshold, "extended": bool(extended), "upright": bool(upright),
+              "n_octaves": n_octaves, "n_octave_layers": n_octave_layers}
+    img_obj = vo.ImgObj(count, descriptors if count > 0 else None, time_stamp, PackedKeypoints(rows),
+                        (height, width))
+    return img_obj, params
+
+
+def extract(gray, detector, time_stamp: int, encoding: str = "float16"):
+    """
+    Extracts SURF features of gray on the device and encodes them
+    :return: bytes
+    """
+    keypoints, descriptors = detector.detectAndCompute(gray, None)
+    img_obj = vo.ImgObj(len(keypoints), descriptors, time_stamp, vo.serialize_keypoints(keypoints), gray.shape)
+    return encode(img_obj, detector_params(detector), encoding)
@@ -7,8 +7,10 @@ import matcher as mt
 import shutil
 import time
 import numpy as np
-import math
 import image_in_one_frame as one_frame
+from spatial_index import NodeIndex
+from map_renderer import MapRenderer
+from path_history import PathHistory
 
 
 class Node:
@@ -44,14 +46,207 @@ class FloorMap:
         self.impure = copy.deepcopy(img)
 
 
+class EdgeGeometry:
+    """
+    Geometry of all the edges of one floor, kept as numpy rows so that the whole floor is computed at once
+
+    Attributes
+    __________
+    names : list
+        edge name of each row
+    rows : dict
+        edge name -> row index
+    src_ids, dest_ids : np.ndarray
+        identities of source and destination node of each edge
+    src_xy, dest_xy : np.ndarray
+        (x, y) of source and destination node of each edge on the map image
+    vectors : np.ndarray
+        (dx, dy) of each edge in map coordinates, with dy measured upwards
+    headings : np.ndarray
+        angle of each edge in degrees, anticlockwise from the x axis, in range (-180, 180]
+    lengths : np.ndarray
+        length of each edge in map coordinates
+    turns : dict
+        edge name -> list of (next_edge_name, angle) for every edge leaving its destination
+    """
+
+    def __init__(self, floor_no: int = 0):
+        self.floor_no = floor_no
+        self.names = []
+        self.rows = {}
+        self.src_ids = np.zeros(0, dtype=np.int64)
+        self.dest_ids = np.zeros(0, dtype=np.int64)
+        self.src_xy = np.zeros((0, 2))
+        self.dest_xy = np.zeros((0, 2))
+        self.vectors = np.zeros((0, 2))
+        self.headings = np.zeros(0)
+        self.lengths = np.zeros(0)
+        self.turns = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def build(self, edges, coordinates):
+        """
+        Computes the table for the whole floor
+        :param edges: list of Edge objects of the floor
+        :param coordinates: dict of node identity -> (x, y)
+        :return: None
+        """
+        self.names, self.rows, self.turns = [], {}, {}
+        self.src_ids = np.zeros(0, dtype=np.int64)
+        self.dest_ids = np.zeros(0, dtype=np.int64)
+        self.src_xy = np.zeros((0, 2))
+        self.dest_xy = np.zeros((0, 2))
+        self.vectors = np.zeros((0, 2))
+        self.headings = np.zeros(0)
+        self.lengths = np.zeros(0)
+        self.add_edges(edges, coordinates)
+
+    def add_edges(self, edges, coordinates):
+        """
+        Appends rows for edges and updates the turns of the new edges and of the edges leading into them
+        :return: list of names of edges whose turns changed
+        """
+        edges = [edge for edge in edges if edge.name not in self.rows]
+        if len(edges) == 0:
+            return []
+        src_ids = np.array([edge.src for edge in edges], dtype=np.int64)
+        dest_ids = np.array([edge.dest for edge in edges], dtype=np.int64)
+        src_xy = np.array([coordinates[edge.src][:2] for edge in edges], dtype=np.float64)
+        dest_xy = np.array([coordinates[edge.dest][:2] for edge in edges], dtype=np.float64)
+        vectors = dest_xy - src_xy
+        vectors[:, 1] *= -1  # Since y is measured from upper edge of map
+
+        first = len(self.names)
+        self.names.extend(edge.name for edge in edges)
+        for row in range(first, len(self.names)):
+            self.rows[self.names[row]] = row
+        self.src_ids = np.concatenate((self.src_ids, src_ids))
+        self.dest_ids = np.concatenate((self.dest_ids, dest_ids))
+        self.src_xy = np.concatenate((self.src_xy, src_xy))
+        self.dest_xy = np.concatenate((self.dest_xy, dest_xy))
+        self.vectors = np.concatenate((self.vectors, vectors))
+        self.headings = np.concatenate((self.headings, self._heading(vectors)))
+        self.lengths = np.concatenate((self.lengths, np.hypot(vectors[:, 0], vectors[:, 1])))
+
+        new_rows = np.arange(first, len(self.names))
+        into_new = np.nonzero(np.isin(self.dest_ids[:first], src_ids))[0]
+        return self._set_turns(np.concatenate((new_rows, into_new)))
+
+    def remove_edges(self, names):
+        """
+        Deletes rows of edges and updates the turns of the edges which led into them
+        :return: list of names of edges whose turns changed
+        """
+        rows = np.array([self.rows[name] for name in names if name in self.rows], dtype=np.int64)
+        if len(rows) == 0:
+            return []
+        removed_src = self.src_ids[rows]
+        for row in rows.tolist():
+            del self.turns[self.names[row]]
+        keep = np.ones(len(self.names), dtype=bool)
+        keep[rows] = False
+        self.names = [name for name, kept in zip(self.names, keep) if kept]
+        self.rows = {name: row for row, name in enumerate(self.names)}
+        self.src_ids = self.src_ids[keep]
+        self.dest_ids = self.dest_ids[keep]
+        self.src_xy = self.src_xy[keep]
+        self.dest_xy = self.dest_xy[keep]
+        self.vectors = self.vectors[keep]
+        self.headings = self.headings[keep]
+        self.lengths = self.lengths[keep]
+        return self._set_turns(np.nonzero(np.isin(self.dest_ids, removed_src))[0])
+
+    def heading(self, name):
+        return float(self.headings[self.rows[name]])
+
+    def length(self, name):
+        return float(self.lengths[self.rows[name]])
+
+    def nearest(self, x, y):
+        """
+        Returns (edge_name, fraction, distance) of the edge nearest to point (x, y) of the map image, where
+        fraction is the position of the foot of perpendicular along the edge, or (None, None, inf) if no edges
+        """
+        if len(self.names) == 0:
+            return None, None, np.inf
+        segment = self.dest_xy - self.src_xy
+        squared_lengths = (segment ** 2).sum(axis=1)
+        fractions = ((np.array((x, y)) - self.src_xy) * segment).sum(axis=1) / np.maximum(squared_lengths, 1e-12)
+        fractions = np.clip(fractions, 0, 1)
+        feet = self.src_xy + fractions[:, None] * segment
+        distances = np.hypot(feet[:, 0] - x, feet[:, 1] - y)
+        row = int(np.argmin(distances))
+        return self.names[row], float(fractions[row]), float(distances[row])
+
+    def turn_angle(self, name1, name2):
+        """Angle turned in degrees while going from edge name1 to edge name2, anticlockwise positive"""
+        row1, row2 = self.rows[name1], self.rows[name2]
+        if self.dest_ids[row2] == self.src_ids[row1]:
+            return 180
+        return float(self._wrap(self.headings[row2] - self.headings[row1]))
+
+    @staticmethod
+    def _heading(vectors):
+        return EdgeGeometry._wrap(np.degrees(np.arctan2(vectors[:, 1], vectors[:, 0])))
+
+    @staticmethod
+    def _wrap(angles):
+        # Brings angles into range (-180, 180]
+        angles = np.mod(np.asarray(angles, dtype=np.float64) + 180, 360) - 180
+        return np.where(angles == -180, 180, angles)
+
+    def _successor_pairs(self, rows):
+        # (pred, succ) row pairs for every edge succ leaving the destination of edge pred, pred in rows
+        order = np.argsort(self.src_ids, kind="stable")
+        sorted_src = self.src_ids[order]
+        starts = np.searchsorted(sorted_src, self.dest_ids[rows], "left")
+        counts = np.searchsorted(sorted_src, self.dest_ids[rows], "right") - starts
+        pred = np.repeat(rows, counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        succ = order[np.repeat(starts, counts) + offsets]
+        return pred, succ
+
+    def _set_turns(self, rows):
+        rows = np.unique(rows)
+        pred, succ = self._successor_pairs(rows)
+        angles = self._wrap(self.headings[succ] - self.headings[pred])
+        angles[self.dest_ids[succ] == self.src_ids[pred]] = 180
+        changed = [self.names[row] for row in rows.tolist()]
+        for name in changed:
+            self.turns[name] = []
+        for p, s, angle in zip(pred.tolist(), succ.tolist(), angles.tolist()):
+            self.turns[self.names[p]].append((self.names[s], angle))
+        return changed
+
+
+PATH_LOG = "path_traversed.log"  # file (next to graph.pkl) older runs of path_traversed are appended to
+
+
 class Graph:
 
-    def __init__(self):
+    def __init__(self, path_log: str = None):
         self.new_node_index = 0
         self.Nodes = []  # list of list of nodes Nodes[0] will be list of all nodes of floor0
         self.no_of_floors = 0
         self.Floor_map = []
-        self.path_traversed = []
+        # Runs of path_traversed older than it keeps are appended to path_log, see PathHistory
+        self.path_traversed = PathHistory(log_path=path_log)
+        self.edge_geometry = []  # list of EdgeGeometry, edge_geometry[0] is the table of floor0
+        self.node_index = []  # list of NodeIndex, node_index[0] is the spatial index of floor0
+        self.renderers = []  # list of MapRenderer, renderers[0] draws path_traversed on floor0
+        self.map_version = 0  # incremented whenever nodes or edges are added or deleted, or their frames replaced
+        self.hessian_threshold = None  # SURF hessian threshold frames were extracted with, None means default
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Graphs pickled before PathHistory was introduced have path_traversed as a list
+        if isinstance(self.path_traversed, list):
+            path_traversed = PathHistory()
+            for item in self.path_traversed:
+                path_traversed.append(item)
+            self.path_traversed = path_traversed
 
     # private functions
     def get_node(self, identity, z=None):
@@ -97,6 +292,9 @@ class Graph:
                     if len(Nd.links) == 0 or isinstance(Nd.links[0], Edge):
                         self.Nodes[z].append(Nd)
                         self.new_node_index = self.new_node_index + 1
+                        if self._built_node_index(z) is not None:
+                            self._built_node_index(z).add(Nd.identity, Nd.coordinates[0], Nd.coordinates[1], Nd)
+                        self._map_changed(z)
                 else:
                     raise Exception("Nd.links is not a list of Edge")
             else:
@@ -104,18 +302,35 @@ class Graph:
         else:
             raise Exception("Nd format is not of Node")
 
+    def _built_node_index(self, z):
+        # Graphs pickled before the spatial index was introduced don't have it
+        if getattr(self, "node_index", None) is None or len(self.node_index) <= z:
+            return None
+        return self.node_index[z]
+
+    def _node_index(self, z=0):
+        if getattr(self, "node_index", None) is None:
+            self.node_index = []
+        while len(self.node_index) <= z:
+            self.node_index.append(None)
+        if self.node_index[z] is None:
+            index = NodeIndex(z)
+            nodes = self.Nodes[z] if z < len(self.Nodes) else []
+            index.build([nd.identity for nd in nodes], [nd.coordinates[:2] for nd in nodes], nodes)
+            self.node_index[z] = index
+        return self.node_index[z]
+
     def _nearest_node(self, x, y, z):
-        def distance(nd):
-            delx = abs(nd.coordinates[0] - x)
-            dely = abs(nd.coordinates[1] - y)
+        def distance(xy):
+            delx = abs(xy[0] - x)
+            dely = abs(xy[1] - y)
             return delx ** 2 + dely ** 2
 
         minimum, nearest_node = -1, None
-        for Nd in self.Nodes[z]:
-            if abs(Nd.coordinates[0] - x) < 50 and abs(Nd.coordinates[1] - y) < 50:
-                if minimum == -1 or distance(Nd) < minimum:
-                    nearest_node = Nd
-                    minimum = distance(Nd)
+        for Nd, xy in self._node_index(z).within(x, y, 50, p=np.inf):
+            if minimum == -1 or distance(xy) < minimum:
+                nearest_node = Nd
+                minimum = distance(xy)
         return nearest_node
 
     def _connect(self, nd1, nd2):
@@ -123,6 +338,7 @@ class Graph:
             if nd2.identity < self.new_node_index and nd1.identity < self.new_node_index:
                 edge = Edge(True, nd1.identity, nd2.identity)
                 nd1.links.append(edge)
+                self._edges_added([edge], nd1.coordinates[2])
             else:
                 raise Exception("Wrong identities of Nodes")
         else:
@@ -131,86 +347,120 @@ class Graph:
     def _delete_node(self, nd: Node):
         z = nd.coordinates[2]
         if nd in self.Nodes[z]:
+            self._edges_removed(nd.links, z)
             self.Nodes[z].remove(nd)
+            if self._built_node_index(z) is not None:
+                self._built_node_index(z).remove(nd.identity)
+            self._map_changed(z)
             for floor_nodes in self.Nodes:
                 for nd2 in floor_nodes:
-                    for edge in nd2.links:
+                    for edge in list(nd2.links):
                         if nd.identity == edge.dest:
                             nd2.links.remove(edge)
+                            self._edges_removed([edge], nd2.coordinates[2])
         else:
             raise Exception("Nd does not exists in Nodes")
 
-    def _get_edge_slope(self, edge: Edge, floor: int = 0):
-        src = edge.src
-        dest = edge.dest
-        src_node = None
-        dest_node = None
-        for nd in self.Nodes[floor]:
-            if nd.identity == src:
-                src_node = nd
-            if nd.identity == dest:
-                dest_node = nd
-        src1 = src_node.coordinates[0]
-        src2 = src_node.coordinates[1]
-        dest1 = dest_node.coordinates[0]
-        dest2 = dest_node.coordinates[1]
-        slope_in_degree = None
-        if (dest1 - src1) == 0:
-            slope_in_degree = 90
-        elif (-1) * (dest2 - src2) > 0 and (dest1 - src1) > 0:
-            slope = (-1) * (dest_node.coordinates[1] - src_node.coordinates[1]) / (
-                        dest_node.coordinates[0] - src_node.coordinates[0])
-            slope_in_degree = math.degrees(math.atan(slope))
-        elif (-1) * (dest2 - src2) > 0 and (dest1 - src1) < 0:
-            slope = (-1) * (dest_node.coordinates[1] - src_node.coordinates[1]) / (
-                        dest_node.coordinates[0] - src_node.coordinates[0])
-            slope_in_degree = math.degrees(math.atan(slope))
-            slope_in_degree = 180 + slope_in_degree
-        elif (-1) * (dest2 - src2) < 0 and (dest1 - src1) < 0:
-            slope = (-1) * (dest_node.coordinates[1] - src_node.coordinates[1]) / (
-                        dest_node.coordinates[0] - src_node.coordinates[0])
-            slope_in_degree = math.degrees(math.atan(slope))
-            slope_in_degree = 180 + slope_in_degree - 360
-        elif (-1) * (dest2 - src2) < 0 and (dest1 - src1) > 0:
-            slope = (-1) * (dest_node.coordinates[1] - src_node.coordinates[1]) / (
-                        dest_node.coordinates[0] - src_node.coordinates[0])
-            slope_in_degree = math.degrees(math.atan(slope))
-            slope_in_degree = 360 + slope_in_degree - 360
-        else:
-            print("no such cased exists")
+    def _node_coordinates(self):
+        coordinates = {}
+        for floor_nodes in self.Nodes:
+            for nd in floor_nodes:
+                coordinates[nd.identity] = nd.coordinates
+        return coordinates
+
+    def _edge_geometry(self, z=0):
+        # Graphs pickled before the geometry table was introduced don't have it, so it is built lazily
+        if getattr(self, "edge_geometry", None) is None:
+            self.edge_geometry = []
+        while len(self.edge_geometry) <= z:
+            self.edge_geometry.append(None)
+        if self.edge_geometry[z] is None:
+            geometry = EdgeGeometry(z)
+            edges = [edge for nd in self.Nodes[z] for edge in nd.links] if z < len(self.Nodes) else []
+            geometry.build(edges, self._node_coordinates())
+            self.edge_geometry[z] = geometry
+            self._sync_edge_angles(geometry, geometry.names)
+        return self.edge_geometry[z]
+
+    def _sync_edge_angles(self, geometry: EdgeGeometry, names):
+        # Edge.angles is kept as a copy of the table, since it is pickled along with the edges
+        names = set(names)
+        if len(names) == 0 or geometry.floor_no >= len(self.Nodes):
+            return
+        for nd in self.Nodes[geometry.floor_no]:
+            for edge in nd.links:
+                if edge.name in names:
+                    edge.angles = list(geometry.turns[edge.name])
+
+    def _edges_added(self, edges, z):
+        geometry = self._edge_geometry(z)
+        self._sync_edge_angles(geometry, geometry.add_edges(edges, self._node_coordinates()))
+        self._map_changed(z)
+
+    def _edges_removed(self, edges, z):
+        geometry = self._edge_geometry(z)
+        self._sync_edge_angles(geometry, geometry.remove_edges([edge.name for edge in edges]))
+        self._map_changed(z)
+
+    def _renderer(self, z=0):
+        # Graphs pickled before the renderer was introduced don't have it
+        if getattr(self, "renderers", None) is None:
+            self.renderers = []
+        while len(self.renderers) <= z:
+            self.renderers.append(MapRenderer(len(self.renderers)))
+        return self.renderers[z]
+
+    def _map_changed(self, z):
+        # Lets tables built on top of the graph (e.g. routing.RoutingTable) know it has changed
+        self.map_version = getattr(self, "map_version", 0) + 1
+        # Cached drawings of the floor are stale once its nodes or edges change
+        if getattr(self, "renderers", None) is not None and len(self.renderers) > z:
+            self.renderers[z].invalidate()
 
-        return slope_in_degree
+    def _get_edge_slope(self, edge: Edge, floor: int = 0):
+        return self._edge_geometry(floor).heading(edge.name)
 
     def _get_angle_between_two_edges(self, edge1: Edge, edge2: Edge, floor: int = 0):
-        slope1 = self._get_edge_slope(edge1, floor)
-        print(edge1.name + str(slope1))
-        slope2 = self._get_edge_slope(edge2, floor)
-        print(edge2.name + str(slope2))
-        slope_diff = slope2 - slope1
-        if slope_diff > 180:
-            slope_diff = slope_diff - 360
-        if slope_diff < (-180):
-            slope_diff = slope_diff + 360
-
-        return slope_diff
-
-    def _set_specific_edge_angles(self, cur_edge: Edge):
-        cur_edge.angles = []
-        nd = self.get_node(cur_edge.dest)
-        for next_edge in nd.links:
-            if next_edge.dest == cur_edge.src:
-                ang = 180
-            else:
-                ang = self._get_angle_between_two_edges(cur_edge, next_edge)
-            cur_edge.angles.append((next_edge.name, ang))
-        print(cur_edge.name)
-        print(cur_edge.angles)
-        print()
+        return self._edge_geometry(floor).turn_angle(edge1.name, edge2.name)
+
+    def _set_specific_edge_angles(self, cur_edge: Edge, floor: int = 0):
+        cur_edge.angles = list(self._edge_geometry(floor).turns[cur_edge.name])
 
     def _set_all_angles(self, floor_no=0):
-        for nd in self.Nodes[floor_no]:
-            for edge in nd.links:
-                self._set_specific_edge_angles(edge)
+        if getattr(self, "edge_geometry", None) is not None and len(self.edge_geometry) > floor_no:
+            self.edge_geometry[floor_no] = None
+        self._edge_geometry(floor_no)
+
+    def nearest_node(self, x, y, z=0, max_distance=np.inf):
+        """
+        Returns (Node, distance) of the node nearest to point (x, y) of the map image of floor z,
+        or (None, inf) if there is no node within max_distance
+        """
+        return self._node_index(z).nearest(x, y, max_distance)
+
+    def nodes_within(self, x, y, radius, z=0):
+        """Returns list of Node objects within radius of point (x, y) of the map image of floor z"""
+        return [Nd for Nd, xy in self._node_index(z).within(x, y, radius)]
+
+    def nearest_edge(self, x, y, z=0):
+        """
+        Returns (Edge, fraction, distance) of the edge nearest to point (x, y) of the map image of floor z,
+        where fraction is how far along the edge the point lies, or (None, None, inf) if there are no edges
+        """
+        name, fraction, distance = self._edge_geometry(z).nearest(x, y)
+        if name is None:
+            return None, None, distance
+        src, dest = name.split("_")
+        return self.get_edge(int(src), int(dest), z), fraction, distance
+
+    def get_edge_angles(self, edge: Edge, z=0):
+        """
+        Returns angles of all the edges leaving destination of edge
+        :param edge: Edge object
+        :param z: floor of the edge
+        :return: list of (next_edge_name, angle) where angle is in degrees, anticlockwise positive
+        """
+        return self._edge_geometry(z).turns.get(edge.name, [])
 
     def _add_edge_images(self, id1: int, id2: int, distinct_frames: vo2.DistinctFrames, z1=None, z2=None):
         if id1 > self.new_node_index or id2 > self.new_node_index:
@@ -221,6 +471,8 @@ class Graph:
         if edge is not None:
             edge.distinct_frames = distinct_frames
             edge.video_length = distinct_frames.get_time()
+            # Caches of frames keyed on map_version (e.g. visual_index.VisualIndex) are stale
+            self._map_changed(self.get_node(id1, z1).coordinates[2])
             return
         raise Exception("Edge from " + str(id1) + " to " + str(id2) + " not found")
 
@@ -231,6 +483,7 @@ class Graph:
         Nd = self.get_node(identity, z)
         if Nd is not None:
             Nd.node_images = node_images
+            self._map_changed(Nd.coordinates[2])
             return
         raise Exception("Node " + str(identity) + " not found!")
 
@@ -239,6 +492,7 @@ class Graph:
                        z_node=None):
         distinct_frames = vo2.save_distinct_ImgObj(path_of_video, folder_to_save, frames_skipped, check_blurry,
                                                    hessian_threshold, ensure_min=True)
+        self.hessian_threshold = hessian_threshold
         self._add_node_images(identity, distinct_frames, z_node)
 
     def _add_edge_data(self, id1: int, id2: int, path_of_video: str, folder_to_save: str = None,
@@ -246,6 +500,7 @@ class Graph:
                        z1=None, z2=None):
         distinct_frames = vo2.save_distinct_ImgObj(path_of_video, folder_to_save, frames_skipped, check_blurry,
                                                    hessian_threshold, ensure_min=True)
+        self.hessian_threshold = hessian_threshold
         self._add_edge_images(id1, id2, distinct_frames, z1, z2)
 
     def _get_floor_img(self, z, params):
@@ -380,7 +635,6 @@ class Graph:
         cv2.setMouseCallback(window_text, click_event)
         cv2.waitKey(0)
         cv2.destroyAllWindows()
-        self._set_all_angles(z)
 
     def delete_nodes(self, z):
         window_text = 'Delete Nodes for floor ' + str(z)
@@ -414,12 +668,14 @@ class Graph:
             elif event == cv2.EVENT_LBUTTONUP:
                 if nd is not None:
                     ndcur = self._nearest_node(x, y, z)
-                    for edge in nd.links:
+                    for edge in list(nd.links):
                         if edge.dest == ndcur.identity:
                             nd.links.remove(edge)
-                    for edge in ndcur.links:
+                            self._edges_removed([edge], z)
+                    for edge in list(ndcur.links):
                         if edge.dest == nd.identity:
                             ndcur.links.remove(edge)
+                            self._edges_removed([edge], z)
                     img = self.print_graph_and_return(z)
                     cv2.namedWindow('Delete connections', cv2.WINDOW_NORMAL)
                     cv2.resizeWindow('Delete connections', 1600, 1600)
@@ -493,49 +749,52 @@ class Graph:
         self.path_traversed.append((src, dest, fraction_traversed))
 
     def display_path(self, z, current_location_str=""):
-        img = self.print_graph_and_return(0)
-        for item in self.path_traversed:
-            if type(item) == int:
-                nd = self.get_node(item)
-                img = cv2.circle(img, (nd.coordinates[0], nd.coordinates[1]), 10, (150, 0, 0), -1, cv2.LINE_AA)
-            if type(item) == tuple:
-                src_nd = self.get_node(item[0])
-                dest_nd = self.get_node(item[1])
-                start_coordinates = (src_nd.coordinates[0], src_nd.coordinates[1])
-                end_coordinates = (int(src_nd.coordinates[0] + item[2] * (dest_nd.coordinates[0] -
-                                                                          src_nd.coordinates[0])),
-                                   int(src_nd.coordinates[1] + item[2] * (dest_nd.coordinates[1] -
-                                                                          src_nd.coordinates[1])))
-                img = cv2.line(img, start_coordinates, end_coordinates, (150, 0, 0), 6,
-                               cv2.LINE_AA)
-        if len(self.path_traversed) > 0:
-            last = self.path_traversed[-1]
-            if type(last) == int:
-                nd = self.get_node(last)
-                img = cv2.circle(img, (nd.coordinates[0], nd.coordinates[1]), 15, (0, 200, 0), -1, cv2.LINE_AA)
-            if type(last) == tuple:
-                src_nd = self.get_node(last[0])
-                dest_nd = self.get_node(last[1])
-                end_coordinates = (int(src_nd.coordinates[0] + last[2] * (dest_nd.coordinates[0] -
-                                                                          src_nd.coordinates[0])),
-                                   int(src_nd.coordinates[1] + last[2] * (dest_nd.coordinates[1] -
-                                                                          src_nd.coordinates[1])))
-                img = cv2.circle(img, end_coordinates, 15, (0, 200, 0), -1, cv2.LINE_AA)
-
-        # cv2.namedWindow("Current location", cv2.WINDOW_NORMAL)
-        # cv2.resizeWindow("Current location", 1600, 1600)
-        cv2.putText(img, current_location_str, (20, 32), cv2.FONT_HERSHEY_COMPLEX, 1, (0, 0, 0), 2)
+        img = self._renderer(z).render(self, self.path_traversed, current_location_str)
         one_frame.run_graph_frame(img)
-        # cv2.imshow("Current location", img)
-        # cv2.waitKey(1)
-
-    @staticmethod
-    def load_graph(graph_path):
-        return general.load_from_memory(graph_path)
 
+    def fork(self, name=None):
+        """
+        Returns a graph sharing nodes, edges (with their frames) and lookup tables with this one, but with its own
+        path_traversed, so that the location of several users can be tracked on one map loaded once.
+        Lookup tables are built here, so that forks don't build them concurrently
+        :param name: name of the user, the path_traversed of the fork is logged to the log of this graph with
+        "_<name>" added to its name (e.g. path_traversed_<name>.log), not logged if None
+        """
+        for z in range(len(self.Nodes)):
+            self._edge_geometry(z)
+            self._node_index(z)
+        graph = copy.copy(self)
+        log_path = self.path_traversed.log_path
+        if log_path is not None and name is not None:
+            root, extension = os.path.splitext(log_path)
+            log_path = root + "_" + str(name) + extension
+        else:
+            log_path = None
+        graph.path_traversed = PathHistory(log_path=log_path)
+        graph.renderers = []
+        return graph
 
-def load_graph(graph_path):
-    return general.load_from_memory(graph_path)
+    @staticmethod
+    def load_graph(graph_path, path_log: str = None):
+        """
+        Loads graph pickled by save_graph
+        :param path_log: file older runs of path_traversed are appended to, by default PATH_LOG in the folder
+        of graph_path
+        :return: Graph object
+        :raises: the exception loading graph_path raised, or Exception if it doesn't hold a Graph
+        """
+        graph = general.load_from_memory(graph_path)
+        if isinstance(graph, tuple) and len(graph) == 2 and graph[0] is False:
+            raise graph[1]  # load_from_memory returns (False, exception) if it fails
+        if not isinstance(graph, Graph):
+            raise Exception(str(graph_path) + " doesn't hold a Graph but " + type(graph).__name__)
+        graph.path_traversed.log_path = path_log if path_log is not None else \
+            os.path.join(os.path.dirname(graph_path), PATH_LOG)
+        return graph
+
+
+def load_graph(graph_path, path_log: str = None):
+    return Graph.load_graph(graph_path, path_log)
 
 
 def run(code: int):
@@ -0,0 +1,225 @@
+"""graph_arena.py
+Stores the frames (descriptors and keypoints) of all edges and nodes of a graph in a few flat arrays on disk,
+which are memory mapped read-only when the graph is loaded. Processes loading the same arena (e.g. the
+workers of localisation_service) then share one copy of the frames in the page cache, and each only holds
+the rest of the graph (nodes, edges, floor maps) in its own memory.
+
+An arena is made from a pickled graph with:
+    python graph_arena.py new_objects/graph.pkl new_objects/graph_arena
+and loaded with load_graph("new_objects/graph_arena")
+"""
+
+import os
+import sys
+import pickle
+import numpy as np
+import general
+import video_operations_3 as vo
+from graph2 import Graph, PATH_LOG
+
+# Columns of FrameArena.frames
+START, COUNT, NO_OF_KEYPOINTS, TIME_STAMP, NDIM = range(5)
+SHAPE = slice(5, 8)
+
+
+class PackedKeypoints:
+    """
+    serialized_keypoints of a frame (see video_operations_3.serialize_keypoints) read from its rows of
+    FrameArena.keypoints, item i being ((x, y), size, angle, response, octave, class_id) of keypoint i
+    """
+
+    def __init__(self, rows):
+        self.rows = rows  # (n, 7) np.ndarray
+
+    def __len__(self):
+        return len(self.rows)
+
+    @staticmethod
+    def _item(row):
+        x, y, size, angle, response, octave, class_id = row
+        return (x, y), size, angle, response, int(octave), int(class_id)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._item(row) for row in self.rows[index].tolist()]
+        return self._item(self.rows[index].tolist())
+
+    def __iter__(self):
+        return (self._item(row) for row in self.rows.tolist())
+
+    def __reduce__(self):
+        # Pickled as the plain list it stands for, so that it doesn't depend on the arena
+        return list, (list(self),)
+
+
+class FrameArena:
+    """
+    Frames of a graph, memory mapped read-only from folder
+
+    Attributes
+    __________
+    descriptors : np.ndarray
+        (total no of keypoints, descriptor length) float32 descriptors of all the frames, one after the other
+    keypoints : np.ndarray
+        (total no of keypoints, 7) float32 x, y, size, angle, response, octave, class_id of the same keypoints
+    frames : np.ndarray
+        (no of frames, 8) int64 rows of first row in descriptors, no of rows, no_of_keypoints, time_stamp,
+        no of dimensions of shape and shape (0 padded)
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.descriptors = np.load(os.path.join(folder, "descriptors.npy"), mmap_mode="r")
+        self.keypoints = np.load(os.path.join(folder, "keypoints.npy"), mmap_mode="r")
+        self.frames = np.load(os.path.join(folder, "frames.npy"), mmap_mode="r")
+
+    def nbytes(self):
+        """Returns size of the arrays mapped, in bytes"""
+        return self.descriptors.nbytes + self.keypoints.nbytes + self.frames.nbytes
+
+    def img_obj(self, row: int):
+        """Returns ImgObj of frame at row of frames, its descriptors and keypoints being views of the arena"""
+        frame = self.frames[row].tolist()
+        start, count = frame[START], frame[COUNT]
+        descriptors = np.asarray(self.descriptors[start:start + count]) if count > 0 else None
+        keypoints = PackedKeypoints(np.asarray(self.keypoints[start:start + count]))
+        shape = tuple(frame[SHAPE][:frame[NDIM]])
+        return vo.ImgObj(frame[NO_OF_KEYPOINTS], descriptors, frame[TIME_STAMP], keypoints, shape)
+
+
+class ArenaFrames:
+    """
+    Read-only list of ImgObj, standing in for DistinctFrames.img_objects, whose frames are rows [start, stop)
+    of a FrameArena. ImgObj are made when read, so only the arena holds the frames
+    """
+
+    def __init__(self, arena: FrameArena, start: int, stop: int):
+        self.arena = arena
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.arena.img_obj(self.start + j) for j in range(*index.indices(len(self)))]
+        if not -len(self) <= index < len(self):
+            raise IndexError("Frame index out of range")
+        return self.arena.img_obj(self.start + index % len(self))
+
+    def __iter__(self):
+        return (self.arena.img_obj(row) for row in range(self.start, self.stop))
+
+    def __reduce__(self):
+        # Graphs loaded from an arena and saved with Graph.save_graph are saved with all their frames
+        return list, (list(self),)
+
+
+def frame_lists(graph_obj: Graph):
+    """Returns list of every DistinctFrames of the graph, i.e. distinct_frames of edges and node_images of nodes"""
+    lists = []
+    seen = set()
+    for floor_nodes in graph_obj.Nodes:
+        for nd in floor_nodes:
+            for distinct_frames in [nd.node_images] + [edge.distinct_frames for edge in nd.links]:
+                if distinct_frames is not None and id(distinct_frames) not in seen:
+                    seen.add(id(distinct_frames))
+                    lists.append(distinct_frames)
+    return lists
+
+
+class ArenaPickler(pickle.Pickler):
+    # img_objects lists are replaced by references to their rows of the arena
+    def __init__(self, file, rows):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.rows = rows  # id of img_objects list -> (start, stop)
+
+    def persistent_id(self, obj):
+        if isinstance(obj, list) and id(obj) in self.rows:
+            return self.rows[id(obj)]
+        return None
+
+
+class ArenaUnpickler(pickle.Unpickler):
+    def __init__(self, file, arena: FrameArena):
+        super().__init__(file)
+        self.arena = arena
+
+    def persistent_load(self, pid):
+        start, stop = pid
+        return ArenaFrames(self.arena, start, stop)
+
+
+def save_arena(graph_obj: Graph, folder: str):
+    """
+    Writes the frames of graph_obj to descriptors.npy, keypoints.npy and frames.npy in folder, and the rest
+    of the graph (referring to its rows of the arena) to graph.pkl
+    :return: None
+    """
+    lists = frame_lists(graph_obj)
+    img_objects = [img_obj for distinct_frames in lists for img_obj in distinct_frames.img_objects]
+    counts = [0 if img_obj.descriptors is None else len(img_obj.descriptors) for img_obj in img_objects]
+    widths = {img_obj.descriptors.shape[1] for img_obj, count in zip(img_objects, counts) if count > 0}
+    if len(widths) > 1:
+        raise Exception("Frames have descriptors of different lengths " + str(sorted(widths)))
+    for img_obj, count in zip(img_objects, counts):
+        if len(img_obj.serialized_keypoints) != count:
+            raise Exception("Frame " + str(img_obj.time_stamp) + " has " + str(count) + " descriptors but " +
+                            str(len(img_obj.serialized_keypoints)) + " keypoints")
+
+    os.makedirs(folder, exist_ok=True)
+    total = sum(counts)
+    width = widths.pop() if len(widths) > 0 else 64
+    descriptors = np.lib.format.open_memmap(os.path.join(folder, "descriptors.npy"), mode="w+",
+                                            dtype=np.float32, shape=(total, width))
+    keypoints = np.lib.format.open_memmap(os.path.join(folder, "keypoints.npy"), mode="w+",
+                                          dtype=np.float32, shape=(total, 7))
+    frames = np.zeros((len(img_objects), 8), dtype=np.int64)
+    start = 0
+    for row, (img_obj, count) in enumerate(zip(img_objects, counts)):
+        if count > 0:
+            descriptors[start:start + count] = img_obj.descriptors
+            keypoints[start:start + count] = [(x, y, size, angle, response, octave, class_id) for
+                                              (x, y), size, angle, response, octave, class_id in
+                                              img_obj.serialized_keypoints]
+        shape = tuple(img_obj.shape)
+        frames[row, :NDIM + 1] = (start, count, img_obj.no_of_keypoints, img_obj.time_stamp, len(shape))
+        frames[row, SHAPE.start:SHAPE.start + len(shape)] = shape
+        start += count
+    descriptors.flush()
+    keypoints.flush()
+    del descriptors, keypoints
+    np.save(os.path.join(folder, "frames.npy"), frames)
+
+    rows = {}
+    row = 0
+    for distinct_frames in lists:
+        rows[id(distinct_frames.img_objects)] = (row, row + len(distinct_frames.img_objects))
+        row += len(distinct_frames.img_objects)
+    with open(os.path.join(folder, "graph.pkl"), "wb") as graph_file:
+        ArenaPickler(graph_file, rows).dump(graph_obj)
+
+
+def load_graph(folder: str, path_log: str = None):
+    """
+    Loads graph saved by save_arena, with the frames of its edges and nodes memory mapped from the arena
+    :param path_log: file older runs of path_traversed are appended to, by default graph2.PATH_LOG in folder
+    :return: Graph object
+    """
+    arena = FrameArena(folder)
+    with open(os.path.join(folder, "graph.pkl"), "rb") as graph_file:
+        graph = ArenaUnpickler(graph_file, arena).load()
+    graph.path_traversed.log_path = path_log if path_log is not None else os.path.join(folder, PATH_LOG)
+    return graph
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: python graph_arena.py <graph.pkl> <arena folder>")
+        sys.exit(1)
+    graph1: Graph = general.load_from_memory(sys.argv[1])
+    save_arena(graph1, sys.argv[2])
+    arena1 = FrameArena(sys.argv[2])
+    print("Arena of " + str(len(arena1.frames)) + " frames, " + str(round(arena1.nbytes() / 2 ** 20, 1)) +
+          " MB saved to " + sys.argv[2])
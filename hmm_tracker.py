@@ -0,0 +1,234 @@
+"""hmm_tracker.py
+Probabilistic tracking of the location over (edge, frame index) states, as an alternative to voting
+over the last 5 matches in RealTimeMatching
+"""
+
+import numpy as np
+from graph2 import Graph
+
+
+class EdgeStateSpace:
+    """
+    States are the frames of all edges (having distinct_frames) of a floor, numbered edge by edge
+
+    Attributes
+    __________
+    edges : list
+        Edge objects, edges[e] is edge e
+    offsets : np.ndarray
+        state of frame 0 of each edge
+    counts : np.ndarray
+        no of frames of each edge
+    successors : list
+        successors[e] is np.ndarray of edges starting at the destination of edge e
+    state_edge, state_frame : np.ndarray
+        edge and frame index of each state
+    """
+
+    def __init__(self, graph_obj: Graph, z: int = 0):
+        self.edges = [edge for nd in graph_obj.Nodes[z] for edge in nd.links if edge.distinct_frames is not None]
+        self.rows = {edge.name: e for e, edge in enumerate(self.edges)}
+        self.counts = np.array([edge.distinct_frames.no_of_frames() for edge in self.edges], dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts)[:-1])).astype(np.int64)
+        self.no_of_states = int(self.counts.sum())
+        self.state_edge = np.repeat(np.arange(len(self.edges)), self.counts)
+        self.state_frame = np.arange(self.no_of_states) - self.offsets[self.state_edge]
+        self.successors = []
+        for edge in self.edges:
+            self.successors.append(np.array([self.rows[next_edge.name] for next_edge in self.edges
+                                             if next_edge.src == edge.dest], dtype=np.int64))
+
+    def state(self, edge_name, frame_index):
+        return int(self.offsets[self.rows[edge_name]] + frame_index)
+
+    def get_edge(self, state):
+        return self.edges[self.state_edge[state]]
+
+    def get_frame_index(self, state):
+        return int(self.state_frame[state])
+
+    def get_frame_params(self, state):
+        """Returns ( no_of_keypoints, descriptors, serialized_keypoints, shape ) of frame of state"""
+        return self.get_edge(state).distinct_frames.get_object(self.get_frame_index(state)).get_elements()
+
+    def entry_states(self, entry_frames: int = 1):
+        """Returns states of the first entry_frames frames of every edge"""
+        frames = np.arange(entry_frames)
+        states = self.offsets[:, None] + frames[None, :]
+        return states[frames[None, :] < self.counts[:, None]]
+
+    def transitions(self, states, step_probs):
+        """
+        Moves each of states forward along its edge by 0, 1, 2 ... frames with probabilities step_probs.
+        Moving beyond the last frame of an edge leads to the first frames of its successors with the
+        probability split equally between them (or to its last frame if there are none)
+        :return: (parents, next_states, probs), where parents are indexes into states
+        """
+        edge, frame = self.state_edge[states], self.state_frame[states]
+        steps = np.arange(len(step_probs))
+        targets = frame[:, None] + steps[None, :]
+        step_probs = np.broadcast_to(np.asarray(step_probs, dtype=np.float64), targets.shape)
+        parents = np.broadcast_to(np.arange(len(states))[:, None], targets.shape)
+        inside = targets < self.counts[edge][:, None]
+        all_parents = [parents[inside]]
+        next_states = [(self.offsets[edge][:, None] + targets)[inside]]
+        probs = [step_probs[inside]]
+        for k, d in zip(*np.nonzero(~inside)):
+            e = edge[k]
+            overflow = targets[k, d] - self.counts[e]
+            successors = self.successors[e]
+            successors = successors[overflow < self.counts[successors]]
+            if len(successors) == 0:
+                successor_states = np.array([self.offsets[e] + self.counts[e] - 1])
+            else:
+                successor_states = self.offsets[successors] + overflow
+            all_parents.append(np.full(len(successor_states), k))
+            next_states.append(successor_states)
+            probs.append(np.full(len(successor_states), step_probs[k, d] / len(successor_states)))
+        return np.concatenate(all_parents), np.concatenate(next_states), np.concatenate(probs)
+
+    def step(self, states, probs, step_probs):
+        """
+        Moves probability mass of states forward as in transitions()
+        :return: (states, probs) with unique states
+        """
+        parents, next_states, transition_probs = self.transitions(states, step_probs)
+        unique_states, inverse = np.unique(next_states, return_inverse=True)
+        return unique_states, np.bincount(inverse, weights=probs[parents] * transition_probs,
+                                          minlength=len(unique_states))
+
+
+class HMMTracker:
+    """
+    Forward filter over (edge, frame index) states. For every query frame, the belief (kept only for the
+    top_k most probable states) is moved forward by the transition model, the frames of the states it now
+    covers are matched with the query frame, and the belief is weighted by exp(sharpness * fraction_matched)
+
+    Usage, for every query frame:
+        candidates = tracker.predict()  # states whose frames are to be matched
+        tracker.update(fractions)  # fraction matched of each of them, -1 if not matched at all
+
+    Attributes
+    __________
+    space : EdgeStateSpace (object)
+    states, probs : np.ndarray
+        belief, i.e. states with non zero probability and their probabilities
+    confidence : float
+        probability of the user being on the edge of the most probable state
+    """
+
+    def __init__(self, graph_obj: Graph, z: int = 0, top_k: int = 8, step_probs=(0.3, 0.5, 0.2),
+                 sharpness: float = 20, match_threshold: float = 0.09, max_misses: int = 5, entry_frames: int = 1):
+        self.space = EdgeStateSpace(graph_obj, z)
+        self.top_k = top_k
+        self.step_probs = step_probs
+        self.sharpness = sharpness
+        self.match_threshold = match_threshold  # fraction_matched above which a frame is considered matched
+        self.max_misses = max_misses  # no of query frames in a row with no match after which belief is reset
+        self.entry_frames = entry_frames  # no of first frames of every edge to be matched when belief is reset
+        self.misses = 0
+        self.candidates = None
+        self.prior = None
+        self.confidence = 0
+        self.reset()
+
+    def reset(self):
+        """Spreads the belief uniformly over the first frames of all edges (start or lost track)"""
+        self.states = self.space.entry_states(self.entry_frames)
+        self.probs = np.full(len(self.states), 1 / max(len(self.states), 1))
+        self.localised = False
+        self.confidence = 0
+
+    def predict(self):
+        """
+        Applies the transition model to the belief
+        :return: np.ndarray of states whose frames are to be matched with the next query frame
+        """
+        if self.localised:
+            self.candidates, self.prior = self.space.step(self.states, self.probs, self.step_probs)
+        else:
+            self.candidates, self.prior = self.states, self.probs
+        return self.candidates
+
+    def update(self, fractions):
+        """
+        Weighs the predicted belief with the match scores of the query frame and prunes it to top_k states.
+        The belief is left as it was if no frame is matched while not localised
+        :param fractions: fraction_matched of the query frame with frame of each state returned by predict()
+        :return: None
+        """
+        fractions = np.asarray(fractions, dtype=np.float64)
+        if len(fractions) == 0 or fractions.max() <= self.match_threshold:
+            self.misses += 1
+            if self.misses >= self.max_misses:
+                self.misses = 0
+                self.reset()
+                return
+            if len(fractions) == 0 or not self.localised:
+                # Nothing to weigh the belief with, or it is still the uniform one of reset() which is kept
+                # whole (pruning it to top_k would leave out edges at random) until a frame is matched
+                return
+        else:
+            self.misses = 0
+        posterior = self.prior * np.exp(self.sharpness * np.clip(fractions, 0, 1))
+        posterior /= posterior.sum()
+        if len(posterior) > self.top_k:
+            keep = np.argpartition(-posterior, self.top_k)[:self.top_k]
+        else:
+            keep = np.arange(len(posterior))
+        self.states, self.probs = self.candidates[keep], posterior[keep] / posterior[keep].sum()
+        if fractions.max() > self.match_threshold:
+            self.localised = True
+        best_edge = self.space.state_edge[self.states[np.argmax(self.probs)]]
+        self.confidence = float(self.probs[self.space.state_edge[self.states] == best_edge].sum())
+
+    def snapshot(self):
+        """
+        Returns belief as a dict of plain values (states referenced by edge name and frame index), see
+        RealTimeMatching.snapshot
+        """
+        return {"states": [[self.space.get_edge(state).name, self.space.get_frame_index(state)]
+                           for state in self.states],
+                "probs": [float(prob) for prob in self.probs], "misses": self.misses,
+                "localised": self.localised, "confidence": self.confidence}
+
+    def restore(self, snapshot):
+        """
+        Sets belief to that of snapshot. States on edges (or frames) no longer in the graph are left out, and
+        if none are left the belief is reset
+        :raises ValueError: if snapshot is not valid, in which case the belief is left as it was
+        """
+        if not isinstance(snapshot.get("states"), list) or not isinstance(snapshot.get("probs"), list) or \
+                len(snapshot["states"]) != len(snapshot["probs"]) or type(snapshot.get("misses")) != int or \
+                type(snapshot.get("localised")) != bool or type(snapshot.get("confidence")) not in (int, float):
+            raise ValueError("Invalid hmm belief")
+        states, probs = [], []
+        for state, prob in zip(snapshot["states"], snapshot["probs"]):
+            if not isinstance(state, list) or len(state) != 2 or type(state[0]) != str or type(state[1]) != int or \
+                    type(prob) not in (int, float) or prob < 0:
+                raise ValueError("Invalid hmm state " + repr(state))
+            edge_name, frame_index = state
+            row = self.space.rows.get(edge_name)
+            if row is not None and 0 <= frame_index < self.space.counts[row]:
+                states.append(self.space.state(edge_name, frame_index))
+                probs.append(prob)
+        if len(states) == 0 or sum(probs) <= 0:
+            self.reset()
+            return
+        self.states = np.array(states, dtype=np.int64)
+        self.probs = np.array(probs, dtype=np.float64)
+        if len(states) < len(snapshot["states"]):
+            self.probs /= self.probs.sum()
+        self.misses = snapshot["misses"]
+        self.localised = snapshot["localised"]
+        self.confidence = snapshot["confidence"]
+
+    def location(self):
+        """
+        Returns most probable location
+        :return: (Edge, frame index, confidence), or (None, None, 0) if not localised yet
+        """
+        if not self.localised:
+            return None, None, 0
+        state = self.states[np.argmax(self.probs)]
+        return self.space.get_edge(state), self.space.get_frame_index(state), self.confidence
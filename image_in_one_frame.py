@@ -4,6 +4,10 @@ import numpy as np
 graph_frame=None
 query_video_frame= None
 
+# (width, height) of the graph and query video parts of the window
+GRAPH_FRAME_SIZE = (450, 550)
+QUERY_FRAME_SIZE = (800, 550)
+
 def run_query_frame(img):
     global query_video_frame
     query_video_frame=img
@@ -19,9 +23,11 @@ def show_frames ():
     global query_video_frame
 
     if graph_frame is not None and query_video_frame is not None:
-        graph_frame1= cv2.resize(graph_frame, (450,550),interpolation = cv2.INTER_AREA)
+        graph_frame1 = graph_frame
+        if graph_frame.shape[1::-1] != GRAPH_FRAME_SIZE:
+            graph_frame1= cv2.resize(graph_frame, GRAPH_FRAME_SIZE,interpolation = cv2.INTER_AREA)
         grey_3_channel = cv2.cvtColor(query_video_frame, cv2.COLOR_GRAY2BGR)
-        grey_3_channel1 = cv2.resize(grey_3_channel, (800, 550), interpolation=cv2.INTER_AREA)
+        grey_3_channel1 = cv2.resize(grey_3_channel, QUERY_FRAME_SIZE, interpolation=cv2.INTER_AREA)
         numpy_horizontal_concat = np.concatenate((graph_frame1, grey_3_channel1), axis=1)
         cv2.imshow('Live Stream and localization', numpy_horizontal_concat)
         if cv2.waitKey(1) & 0xFF == ord('q'):
@@ -0,0 +1,94 @@
+"""junction_detector.py
+Detects arrival at a node (junction) by matching the query frame with the node_images of the node the
+user is approaching, so that only the edges leaving it need to be matched afterwards
+"""
+
+import numpy as np
+from graph2 import Graph, Node
+from match_batcher import EdgeDescriptors, keypoint_xy, symmetric_match
+
+
+class JunctionDetector:
+    """
+    Matches a query frame with all the frames of one node at once: distances to the descriptors of all the
+    frames are computed with a single matrix product (as in match_batcher.MatchBatcher), and the ratio test,
+    slope check and symmetry match of matcher.SURF_returns are then done with each node frame on its own.
+    A node is detected once the fraction matched with its best frame is above min_fraction for min_hits
+    query frames in a row.
+
+    Attributes
+    __________
+    graph_obj : Graph (object)
+    node_frames : dict
+        node identity -> EdgeDescriptors of the node_images of the node, built when the node is first checked
+    hits : int
+        no of query frames in a row matching hit_node
+    """
+
+    def __init__(self, graph_obj: Graph, ratio_thresh: float = 0.7, max_slope: float = 0.2,
+                 min_fraction: float = 0.09, min_hits: int = 2):
+        self.graph_obj = graph_obj
+        self.ratio_thresh = ratio_thresh
+        self.max_slope = max_slope
+        self.min_fraction = min_fraction
+        self.min_hits = min_hits
+        self.node_frames = {}
+        self.map_version = getattr(graph_obj, "map_version", 0)
+        self.hit_node = None
+        self.hits = 0
+
+    def _frames(self, node: Node):
+        if getattr(self.graph_obj, "map_version", 0) != self.map_version:
+            self.node_frames = {}
+            self.map_version = getattr(self.graph_obj, "map_version", 0)
+        if node.identity not in self.node_frames:
+            self.node_frames[node.identity] = EdgeDescriptors(node.node_images) if node.node_images is not None \
+                else None
+        return self.node_frames[node.identity]
+
+    def match(self, node: Node, query_params):
+        """
+        Matches a query frame with the frames of node
+        :param node: Node object
+        :param query_params: ( no_of_keypoints, descriptors, serialized_keypoints, shape ) of the query frame
+        :return: (fraction_matched, frame_index) of the best matching frame of the node,
+        or (0, None) if the node has no frames
+        """
+        frames = self._frames(node)
+        no_of_keypoints, descriptors, serialized_keypoints, shape = query_params
+        if frames is None or len(frames.descriptors) == 0 or no_of_keypoints < 2 or descriptors is None or \
+                len(descriptors) < 2:
+            return 0, None
+        queries = np.asarray(descriptors, dtype=np.float32)
+        # |q - f| ^ 2 = |q| ^ 2 - 2 q.f + |f| ^ 2, for the query frame and all the node frames at once
+        squared_distances = (queries.astype(np.float64) ** 2).sum(axis=1)[:, None] - \
+            2 * (queries @ frames.descriptors.T) + frames.norms[None, :]
+        np.maximum(squared_distances, 0, out=squared_distances)
+        query_xy = keypoint_xy(serialized_keypoints)
+
+        fractions = np.zeros(len(frames.no_of_keypoints))
+        for j in range(len(frames.no_of_keypoints)):
+            start, stop = frames.offsets[j], frames.offsets[j + 1]
+            if stop - start >= 2:
+                fractions[j] = symmetric_match(
+                    squared_distances[:, start:stop], int(frames.no_of_keypoints[j]), no_of_keypoints,
+                    frames.xy[start:stop], query_xy, frames.widths[j], shape[1], self.ratio_thresh, self.max_slope)[0]
+        best = int(np.argmax(fractions))
+        return float(max(fractions[best], 0)), best
+
+    def detect(self, node: Node, query_params):
+        """
+        Checks if the query frame shows node, and counts hits of the same node in a row
+        :return: True if node has matched min_hits query frames in a row
+        """
+        fraction_matched, frame_index = self.match(node, query_params)
+        if fraction_matched > self.min_fraction:
+            self.hits = self.hits + 1 if self.hit_node == node.identity else 1
+            self.hit_node = node.identity
+        else:
+            self.reset()
+        return self.hits >= self.min_hits
+
+    def reset(self):
+        self.hit_node = None
+        self.hits = 0
@@ -0,0 +1,142 @@
+"""load_controller.py
+Keeps the real time query loop (RealTimeMatching.save_query_objects) up with the video by trading accuracy
+for speed when matching falls behind, and back when it catches up
+"""
+
+import time
+
+
+class LoadController:
+    """
+    Measures the time taken to process each query frame (read to location shown) and compares its moving
+    average with the budget, the time until the next frame to be processed arrives, i.e.
+    (frames_skipped + 1) / target_fps seconds for frames arriving at target_fps. Above the budget, the load is
+    shed one step at a time, first by raising the hessian threshold (fewer keypoints), then by narrowing the
+    search windows, then by skipping more frames. Well below the budget, the steps are undone in the reverse
+    order. Steps are taken at most once every adjust_every frames, all within the bounds given.
+
+    Frames of a video file which could only be processed more than max_lag seconds after their time in the
+    video are dropped instead of being processed late.
+
+    Attributes
+    __________
+    frames_skipped : int
+        no of frames to be skipped after every frame read
+    hessian_threshold : int
+        SURF hessian threshold for query frames
+    window : int
+        no of frames on each side of the expected frame to be matched (RealTimeMatching.window)
+    latency : float
+        moving average of the time (in seconds) taken per frame processed
+    """
+
+    def __init__(self, target_fps: float = 30, frames_skipped=(0, 10), hessian_threshold=(2500, 5000),
+                 hessian_step: int = 500, window=(1, 2), max_lag: float = 1.0, adjust_every: int = 5,
+                 smoothing: float = 0.2):
+        self.target_fps = target_fps
+        self.skip_bounds = frames_skipped
+        self.hessian_bounds = hessian_threshold
+        self.hessian_step = hessian_step
+        self.window_bounds = window
+        self.max_lag = max_lag
+        self.adjust_every = adjust_every
+        self.smoothing = smoothing
+        self.frames_skipped = frames_skipped[0]
+        self.hessian_threshold = hessian_threshold[0]
+        self.window = window[1]
+        self.latency = None
+        self.lag = 0.0
+        self.clock_start = None
+        self.frames_since_adjustment = 0
+        self.frames_processed = 0
+        self.frames_dropped = 0
+        self.adjustments = 0
+        self.last_decision = ""
+
+    @property
+    def budget(self):
+        return (self.frames_skipped + 1) / self.target_fps
+
+    def is_stale(self, video_time):
+        """
+        Returns True (and counts it as dropped) if a frame at video_time seconds into the video is too late
+        to be processed, the video being played in real time from the first frame checked
+        """
+        now = time.time()
+        if self.clock_start is None:
+            self.clock_start = now - video_time
+        self.lag = now - self.clock_start - video_time
+        if self.lag > self.max_lag:
+            self.frames_dropped += 1
+            return True
+        return False
+
+    def frame_done(self, started_at: float):
+        """
+        Records the time taken by a frame and adjusts the settings if needed
+        :param started_at: time the frame was read
+        :return: True if any setting changed
+        """
+        elapsed = time.time() - started_at
+        self.frames_processed += 1
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency += self.smoothing * (elapsed - self.latency)
+        self.frames_since_adjustment += 1
+        if self.frames_since_adjustment < self.adjust_every:
+            return False
+        if self.latency > self.budget:
+            changed = self._shed()
+        elif self.latency < 0.6 * self.budget:
+            changed = self._restore()
+        else:
+            changed = False
+        if changed:
+            self.frames_since_adjustment = 0
+            self.adjustments += 1
+            print("Load controller: " + self.last_decision + " (" + str(round(self.latency * 1000)) + " ms/frame)")
+        return changed
+
+    def _shed(self):
+        if self.hessian_threshold < self.hessian_bounds[1]:
+            self.hessian_threshold = min(self.hessian_threshold + self.hessian_step, self.hessian_bounds[1])
+            self.last_decision = "hessian_threshold raised to " + str(self.hessian_threshold)
+        elif self.window > self.window_bounds[0]:
+            self.window -= 1
+            self.last_decision = "window narrowed to " + str(self.window)
+        elif self.frames_skipped < self.skip_bounds[1]:
+            self.frames_skipped += 1
+            self.last_decision = "frames_skipped raised to " + str(self.frames_skipped)
+        else:
+            return False
+        return True
+
+    def _restore(self):
+        if self.frames_skipped > self.skip_bounds[0]:
+            self.frames_skipped -= 1
+            self.last_decision = "frames_skipped lowered to " + str(self.frames_skipped)
+        elif self.window < self.window_bounds[1]:
+            self.window += 1
+            self.last_decision = "window widened to " + str(self.window)
+        elif self.hessian_threshold > self.hessian_bounds[0]:
+            self.hessian_threshold = max(self.hessian_threshold - self.hessian_step, self.hessian_bounds[0])
+            self.last_decision = "hessian_threshold lowered to " + str(self.hessian_threshold)
+        else:
+            return False
+        return True
+
+    def metrics(self):
+        """Returns dict of the current settings and the measurements behind them"""
+        return {
+            "latency_ms": None if self.latency is None else round(self.latency * 1000, 1),
+            "budget_ms": round(self.budget * 1000, 1),
+            "lag_s": round(self.lag, 3),
+            "frames_processed": self.frames_processed,
+            "frames_dropped": self.frames_dropped,
+            "frames_skipped": self.frames_skipped,
+            "hessian_threshold": self.hessian_threshold,
+            "window": self.window,
+            "adjustments": self.adjustments,
+            "last_decision": self.last_decision,
+        }
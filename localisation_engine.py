@@ -0,0 +1,352 @@
+"""localisation_engine.py
+Localises many devices at once on one graph, loaded once: each device has a session with its own tracker
+(RealTimeMatching). Served over HTTP by localisation_service and over TCP by socket_server
+"""
+
+import os
+import re
+import threading
+import time
+import uuid
+import cv2
+import numpy as np
+import video_operations_3 as vo
+import graph_arena
+import feature_wire
+from graph2 import Graph
+from localisation_final import RealTimeMatching, SnapshotError
+from match_batcher import MatchBatcher
+
+SESSION_OPTIONS = {"tracking": bool, "window": int, "entry_frames": int, "use_hmm": bool, "relocalise_after": int}
+SESSION_ID = re.compile("[0-9a-f]{32}")  # as uuid.uuid4().hex, which session ids are made of
+
+
+def check_options(options):
+    """
+    Checks session options sent by a client
+    :return: None if options are valid, else str saying what is wrong
+    """
+    if not isinstance(options, dict):
+        return "Options should be a JSON object"
+    for key, value in options.items():
+        if key not in SESSION_OPTIONS or type(value) != SESSION_OPTIONS[key]:
+            return "Invalid option " + str(key) + ", options are " + ", ".join(SESSION_OPTIONS)
+    return None
+
+
+def check_session_id(session_id):
+    """
+    Checks a session id sent by a client. It names the session's log file (see Graph.fork), so only ids of the
+    form the engine makes are taken
+    :return: None if session_id is valid, else str saying what is wrong
+    """
+    if not isinstance(session_id, str) or SESSION_ID.fullmatch(session_id) is None:
+        return "Invalid session id, it should be 32 lowercase hex digits"
+    return None
+
+
+def load_graph(graph_path: str):
+    """Loads graph from graph.pkl or from a folder saved by graph_arena.save_arena"""
+    if os.path.isdir(graph_path):
+        return graph_arena.load_graph(graph_path)
+    return Graph.load_graph(graph_path)
+
+
+def tracker_location(matcher: RealTimeMatching):
+    """
+    Returns dict of the current location of matcher: edge ("src_dest"), src, dest and fraction of the edge
+    traversed, or node if the user is at a node (all None if not localised yet), and confidence, the
+    probability of being there given by hmm_tracker, or else the share of last_5_matches agreeing with the edge
+    """
+    location = {"edge": None, "src": None, "dest": None, "fraction": None, "node": None, "confidence": 0.0}
+    path_traversed = matcher.graph_obj.path_traversed
+    if len(path_traversed) == 0:
+        return location
+    current = path_traversed[-1]
+    if type(current) == tuple:
+        src, dest, fraction = current
+        location.update({"edge": str(src) + "_" + str(dest), "src": src, "dest": dest, "fraction": float(fraction)})
+    else:
+        location["node"] = current
+    if matcher.hmm_tracker is not None:
+        location["confidence"] = float(matcher.confidence)
+    elif location["edge"] is not None and len(matcher.last_5_matches) > 0:
+        votes = sum(1 for match, edge_name in matcher.last_5_matches if edge_name == location["edge"])
+        location["confidence"] = votes / len(matcher.last_5_matches)
+    return location
+
+
+def decode_frame(data):
+    """Returns gray image decoded from JPEG/PNG bytes, None if they aren't an image"""
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+
+
+class Session:
+    """
+    Tracker of one device
+
+    Attributes
+    __________
+    matcher : RealTimeMatching
+        tracker, on a fork of the graph (see Graph.fork) so that it has its own path_traversed, logged to
+        path_traversed_<session_id>.log next to the graph
+    options : dict
+        options of the tracker, see SESSION_OPTIONS
+    lock : threading.Lock
+        held while a frame of the session is localised, frames of a session are localised one at a time
+    last_seen : float
+        time of the last request of the session
+    """
+
+    def __init__(self, session_id, graph_obj: Graph, hessian_threshold: int = 2500, **options):
+        self.session_id = session_id
+        self.options = {key: value for key, value in options.items() if key in SESSION_OPTIONS}
+        self.matcher = RealTimeMatching(graph_obj.fork(session_id), **options)
+        self.matcher.display_hook = lambda current_location_str: None  # Nothing is displayed on the server
+        self.hessian_threshold = hessian_threshold
+        self.detector = None  # SURF detector, created on the first frame (detectors can't be shared by threads)
+        self.lock = threading.Lock()
+        self.frames_received = 0
+        self.frames_localised = 0
+        self.created_at = self.last_seen = time.time()
+
+    def localise(self, gray, frame_index=None):
+        """
+        Localises a query frame
+        :param gray: gray image
+        :param frame_index: index of the frame in the video of the device, defaults to the no of frames received
+        :return: dict of location (see location()) and whether the frame was localised
+        """
+        if frame_index is None:
+            frame_index = self.frames_received
+        self.frames_received += 1
+        if self.detector is None:
+            self.detector = cv2.xfeatures2d_SURF.create(self.hessian_threshold)
+        if vo.is_blurry_grayscale(gray):
+            return self._result(frame_index, "blurry")
+        img_obj = self.matcher.extract_features(frame_index, gray, self.detector)
+        if img_obj is None:
+            return self._result(frame_index, "few keypoints")
+        self.matcher.process_frame(img_obj, gray)
+        self.frames_localised += 1
+        return self._result(frame_index, None)
+
+    def localise_features(self, img_obj):
+        """
+        Localises a query frame whose features were extracted by the device, see feature_wire
+        :param img_obj: ImgObj, whose time_stamp is the index of the frame in the video of the device
+        :return: dict as localise()
+        """
+        self.frames_received += 1
+        if img_obj.no_of_keypoints < 50:
+            return self._result(img_obj.get_time(), "few keypoints")
+        self.matcher.process_frame(img_obj, None)
+        self.frames_localised += 1
+        return self._result(img_obj.get_time(), None)
+
+    def _result(self, frame_index, skipped):
+        result = self.location()
+        result.update({"frame_index": frame_index, "localised": skipped is None, "skipped": skipped})
+        return result
+
+    def location(self):
+        """Returns dict of the current location of the session, see tracker_location"""
+        return tracker_location(self.matcher)
+
+    def snapshot(self):
+        """
+        Returns state of the session as a dict of plain values: its options, no of frames received and the
+        state of its tracker (see RealTimeMatching.snapshot), from which LocalisationEngine.restore_session
+        resumes it, on any worker
+        """
+        return {"options": dict(self.options), "frames_received": self.frames_received,
+                "tracker": self.matcher.snapshot()}
+
+
+class LocalisationEngine:
+    """
+    Loads the graph once and keeps the sessions localised on it
+
+    Attributes
+    __________
+    sessions : dict
+        session_id -> Session
+    slots : threading.BoundedSemaphore
+        limits the no of frames localised at once to max_concurrent
+    match_batcher : MatchBatcher
+        if batch_window (seconds) is given, frames of all sessions being localised at the same time are matched
+        together in batches (of at most max_concurrent frames), see match_batcher
+    """
+
+    def __init__(self, graph_path: str, session_ttl: float = 300, max_sessions: int = 100,
+                 max_concurrent: int = 4, queue_timeout: float = 2.0, graph_obj: Graph = None,
+                 batch_window: float = None):
+        self.graph_path = graph_path
+        self.graph_obj = graph_obj  # loaded on the first session if not given
+        self.session_ttl = session_ttl  # sessions with no request for these many seconds are deleted
+        self.max_sessions = max_sessions
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.batch_window = batch_window
+        self.match_batcher = None  # created along with the first session
+        self.sessions = {}
+        self.lock = threading.Lock()  # guards sessions and loading the graph
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.active = 0
+        self.frames_localised = 0
+        self.frames_rejected = 0
+        self.sessions_expired = 0
+
+    def _graph(self):
+        if self.graph_obj is None:
+            self.graph_obj = load_graph(self.graph_path)
+        return self.graph_obj
+
+    def _expire(self, now):
+        expired = [session_id for session_id, session in self.sessions.items()
+                   if now - session.last_seen > self.session_ttl]
+        for session_id in expired:
+            del self.sessions[session_id]
+        self.sessions_expired += len(expired)
+
+    def _new_session(self, session_id, **options):
+        """Returns Session on the graph (loaded if not yet), not yet added to sessions. Called with lock held"""
+        graph_obj = self._graph()
+        if self.batch_window is not None and self.match_batcher is None:
+            self.match_batcher = MatchBatcher(graph_obj, self.batch_window, self.max_concurrent)
+        return Session(session_id, graph_obj, feature_wire.graph_detector_params(graph_obj)["hessian_threshold"],
+                       match_batcher=self.match_batcher, **options)
+
+    def _add_session(self, session: Session):
+        """Adds session, replacing the one with the same id if any. Called with lock held"""
+        self._expire(time.time())
+        if session.session_id not in self.sessions and len(self.sessions) >= self.max_sessions:
+            return None
+        self.sessions[session.session_id] = session
+        return session
+
+    def create_session(self, **options):
+        """
+        :param options: keyword arguments of RealTimeMatching, restricted to SESSION_OPTIONS
+        :return: Session, or None if there are max_sessions sessions already
+        """
+        with self.lock:
+            self._expire(time.time())
+            if len(self.sessions) >= self.max_sessions:
+                return None
+            return self._add_session(self._new_session(uuid.uuid4().hex, **options))
+
+    def get_session(self, session_id):
+        """Returns Session with session_id (marking it as seen), None if it doesn't exist or has expired"""
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            session = self.sessions.get(session_id)
+            if session is not None:
+                session.last_seen = now
+            return session
+
+    def delete_session(self, session_id):
+        with self.lock:
+            return self.sessions.pop(session_id, None) is not None
+
+    def snapshot_session(self, session: Session):
+        """
+        Returns state of session (see Session.snapshot) once no frame of it is being localised, so that it can
+        be checkpointed, or moved to another worker
+        :return: dict, or None if a frame of it was still being localised after queue_timeout
+        """
+        if not session.lock.acquire(timeout=self.queue_timeout):
+            return None
+        try:
+            return session.snapshot()
+        finally:
+            session.lock.release()
+
+    def restore_session(self, state, session_id=None):
+        """
+        Creates a session resuming from state returned by snapshot_session (possibly of another engine, on the
+        same graph), whose tracker goes on matching around the location it was at instead of searching all edges.
+        The session is added only once its tracker is restored, so an invalid state changes nothing
+        :param session_id: id of the session, a new one by default. A session with the same id is replaced
+        :return: Session, or None if there are max_sessions sessions already
+        :raises SnapshotError: if state or session_id is not valid
+        """
+        if session_id is not None:
+            error = check_session_id(session_id)
+            if error is not None:
+                raise SnapshotError(error)
+        if not isinstance(state, dict) or not isinstance(state.get("tracker"), dict):
+            raise SnapshotError("State should be an object with the tracker state")
+        options = state.get("options", {})
+        error = check_options(options)
+        if error is not None:
+            raise SnapshotError(error)
+        if type(state.get("frames_received", 0)) != int:
+            raise SnapshotError("frames_received should be an int")
+        with self.lock:
+            session = self._new_session(uuid.uuid4().hex if session_id is None else session_id, **options)
+        session.matcher.restore(state["tracker"])
+        session.frames_received = state.get("frames_received", 0)
+        with self.lock:
+            return self._add_session(session)
+
+    def check_features(self, params):
+        """
+        Checks that features extracted by a device with detector params (see feature_wire) can be matched with
+        the frames of the graph
+        :return: None if they can, else str saying why not
+        """
+        return feature_wire.check(params, feature_wire.graph_detector_params(self.graph_obj))
+
+    def localise(self, session: Session, gray, frame_index=None):
+        """
+        Localises a query frame of session once it is its turn, i.e. no other frame of the session is being
+        localised and less than max_concurrent frames are
+        :return: dict (see Session.localise), or None if it wasn't its turn within queue_timeout
+        """
+        return self._run(session, lambda: session.localise(gray, frame_index))
+
+    def localise_features(self, session: Session, img_obj):
+        """Same as localise(), for features extracted by the device (see Session.localise_features)"""
+        return self._run(session, lambda: session.localise_features(img_obj))
+
+    def _run(self, session: Session, localise):
+        deadline = time.time() + self.queue_timeout
+        if not session.lock.acquire(timeout=self.queue_timeout):
+            self.frames_rejected += 1
+            return None
+        try:
+            if not self.slots.acquire(timeout=max(deadline - time.time(), 0)):
+                self.frames_rejected += 1
+                return None
+            try:
+                with self.lock:
+                    self.active += 1
+                result = localise()
+                with self.lock:
+                    self.frames_localised += 1
+            finally:
+                with self.lock:
+                    self.active -= 1
+                self.slots.release()
+            session.last_seen = time.time()
+            return result
+        finally:
+            session.lock.release()
+
+    def metrics(self):
+        with self.lock:
+            metrics = {
+                "graph_loaded": self.graph_obj is not None,
+                "sessions": len(self.sessions),
+                "max_sessions": self.max_sessions,
+                "active": self.active,
+                "max_concurrent": self.max_concurrent,
+                "frames_localised": self.frames_localised,
+                "frames_rejected": self.frames_rejected,
+                "sessions_expired": self.sessions_expired,
+            }
+        if self.match_batcher is not None:
+            metrics["batching"] = self.match_batcher.metrics()
+        return metrics
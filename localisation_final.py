@@ -1,11 +1,71 @@
 import os
 import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 import general
 import cv2
+import numpy as np
 import video_operations_3 as vo
 from graph2 import Graph, Edge, Node, FloorMap
 import matcher as mt
 import image_in_one_frame as one_frame
+from hmm_tracker import HMMTracker
+from visual_odometry import rank_turns
+from camera_source import IPCameraSource
+from query_pipeline import QueryPipeline
+
+SNAPSHOT_VERSION = 1  # version of the dict returned by RealTimeMatching.snapshot
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def check_snapshot(snapshot):
+    """
+    Checks the types of the fields of a tracker snapshot (see RealTimeMatching.snapshot)
+    :raises SnapshotError: naming the first field which is not valid
+    """
+    def is_int(value, minimum=None):
+        return type(value) == int and (minimum is None or value >= minimum)
+
+    def is_number(value):
+        return type(value) in (int, float)
+
+    def is_window(value):
+        return type(value) == list and len(value) == 3 and type(value[0]) == str and is_int(value[1]) and \
+            is_int(value[2])
+
+    def is_path_item(value):
+        return is_int(value) or (type(value) == list and len(value) == 3 and is_int(value[0]) and
+                                 is_int(value[1]) and is_number(value[2]))
+
+    checks = {
+        "map_version": is_int(snapshot.get("map_version")),
+        "confirmed_path": type(snapshot.get("confirmed_path")) == list and
+        all(is_int(identity) for identity in snapshot["confirmed_path"]),
+        "probable_path": snapshot.get("probable_path") is None or type(snapshot["probable_path"]) == str,
+        "possible_edges": type(snapshot.get("possible_edges")) == list and
+        all(is_window(window) for window in snapshot["possible_edges"]),
+        "next_possible_edges": type(snapshot.get("next_possible_edges")) == list and
+        all(is_window(window) for window in snapshot["next_possible_edges"]),
+        "max_confidence_edges": is_int(snapshot.get("max_confidence_edges"), 0),
+        "last_5_matches": type(snapshot.get("last_5_matches")) == list and len(snapshot["last_5_matches"]) <= 5 and
+        all(type(item) == list and len(item) == 2 and (item[0] is None or is_int(item[0], 0)) and
+            (item[1] is None or type(item[1]) == str) for item in snapshot["last_5_matches"]),
+        "last_matched": type(snapshot.get("last_matched")) == dict and
+        all(type(item) == list and len(item) == 2 and is_int(item[0], 0) and is_number(item[1])
+            for item in snapshot["last_matched"].values()),
+        "frames_without_match": is_int(snapshot.get("frames_without_match"), 0),
+        "window": is_int(snapshot.get("window"), 0),
+        "confidence": is_number(snapshot.get("confidence")),
+        "path_traversed": type(snapshot.get("path_traversed")) == list and
+        all(is_path_item(item) for item in snapshot["path_traversed"]),
+        "hmm": snapshot.get("hmm") is None or type(snapshot["hmm"]) == dict,
+    }
+    for field, valid in checks.items():
+        if not valid:
+            raise SnapshotError("Invalid tracker snapshot: " + field + " is missing or of the wrong type")
 
 
 class PossibleEdge:
@@ -14,6 +74,7 @@ class PossibleEdge:
         self.edge = edge
         self.no_of_frames = edge.distinct_frames.no_of_frames()
         self.to_match_params = (0, self.no_of_frames) # Indexes to be queried in the edge
+        self.frame_times = None # time_stamp of each frame of the edge, read when first needed
 
     def __str__(self):
         return self.name
@@ -27,16 +88,41 @@ class PossibleEdge:
         """
         return self.edge.distinct_frames.get_object(frame_index).get_elements()
 
+    def get_expected_index(self, last_index, time_elapsed):
+        """
+        Returns index of the frame the user is expected to be at, walking along the edge
+        :param last_index: Index of the frame of the edge last matched
+        :param time_elapsed: time (in query video frames) elapsed since that match
+        :return: int in range(last_index, no_of_frames)
+        """
+        if self.frame_times is None:
+            self.frame_times = np.array([self.edge.distinct_frames.get_object(j).get_time()
+                                         for j in range(self.no_of_frames)])
+        expected_time = self.frame_times[last_index] + time_elapsed
+        expected_index = int(np.searchsorted(self.frame_times, expected_time, side="right")) - 1
+        return min(max(expected_index, last_index), self.no_of_frames - 1)
+
+    def set_window(self, start, end):
+        """Sets to_match_params to frames in range(start, end), clipped to the frames of the edge"""
+        start = min(max(start, 0), self.no_of_frames - 1)
+        end = min(max(end, start + 1), self.no_of_frames)
+        self.to_match_params = (start, end)
+
 
 class RealTimeMatching:
-    def __init__(self, graph_obj: Graph, ):
+    def __init__(self, graph_obj: Graph, tracking: bool = True, window: int = 2, entry_frames: int = 2,
+                 use_hmm: bool = False, workers: int = 0, visual_index=None, relocalise_after: int = 3,
+                 top_k: int = 10, junction_detector=None, approach_fraction: float = 0.7,
+                 rotation_estimator=None, klt_tracker=None, change_detector=None, load_controller=None,
+                 query_history: int = 32, record_path: str = None, match_batcher=None):
         self.confirmed_path = [] # contains identity of first node
         self.probable_path = None # contains PossibleEdge object of current edge
         self.possible_edges = [] # list of PossibleEdge objects
         # It contains current 'src_dest' edge, edges with source as 'dest' and edges with destination as 'src'
         self.next_possible_edges = [] # possible_edges for the upcoming (next) query frame
         self.graph_obj = graph_obj
-        self.query_objects = vo.DistinctFrames() # list, but can be changed later to just store the latest frame
+        # Only the latest query_history query frames are kept, all of them are recorded to record_path if given
+        self.query_objects = vo.FrameRing(query_history, record_path)
         self.last_5_matches = [] # last 5 matches as (edge_index_matched, edge_name)
         self.max_confidence_edges = 0 # no of edges with max confidence, i.e. those which are to be checked first
         # generally it is equal to 1 and corresponds to the current edge (self.probable_path)
@@ -45,6 +131,52 @@ class RealTimeMatching:
         # Also self.possible_edges is arranged in such a way that the edges corresponding to max confidence are appended
         # first in the list
         self.current_location_str = ""
+        self.tracking = tracking # If True, only frames near the expected location are matched once localised
+        self.window = window # no of frames on each side of the expected frame of current edge to be matched
+        self.entry_frames = entry_frames # no of first frames of other possible edges to be matched
+        self.last_matched = {} # edge_name -> (edge_index_matched, time_stamp of query frame) of its last match
+        self.frames_without_match = 0 # no of query frames in a row with no match, widens the windows
+        # True if the last query frame localised matched on a known current edge. Set once the frame is done, so
+        # that extract_features (on another thread in QueryPipeline) reads it in one go while frames are localised
+        self.location_known = False
+        # If use_hmm, location is decided by a forward filter over (edge, frame index) states instead of
+        # voting over last_5_matches, see handle_edges_hmm
+        self.hmm_tracker = HMMTracker(graph_obj) if use_hmm else None
+        self.confidence = 0 # probability of being on the current edge, given by hmm_tracker
+        self.workers = workers # If more than 1, frames are matched on a pool of these many threads
+        self.executor = None # ThreadPoolExecutor, created when first needed
+        self.cv2_threads = None # OpenCV's no of threads before get_executor changed it, see close
+        # If visual_index (VisualIndex object) is given, the first location, and the location after
+        # relocalise_after query frames in a row with no match, is searched among the edges of the top_k frames
+        # most similar to the query frame, see relocalisation_edges
+        self.visual_index = visual_index
+        self.relocalise_after = relocalise_after
+        self.top_k = top_k
+        # If junction_detector (JunctionDetector object) is given, query frames are also matched with the
+        # node_images of the destination of the current edge once approach_fraction of it is traversed,
+        # see check_junction
+        self.junction_detector = junction_detector
+        self.approach_fraction = approach_fraction
+        # If rotation_estimator (RotationEstimator object) is given, it is fed every query frame and the heading
+        # change it measures near the end of the current edge orders (and once clearly turned, prunes) the
+        # edges leaving its destination, see ordered_links
+        self.rotation_estimator = rotation_estimator
+        # If klt_tracker (KLTTracker object) is given, query frames are SURF matched only when the scene has
+        # changed enough since the last frame matched, as long as the location is known, see save_query_objects
+        self.klt_tracker = klt_tracker
+        self.frames_matched = 0 # no of query frames SURF matched
+        # If change_detector (video_operations_3.ChangeDetector object) is given, query frames nearly the same as
+        # the last frame processed are skipped before any other processing, and the location found for it holds
+        self.change_detector = change_detector
+        # If load_controller (LoadController object) is given, it sets frames_skipped, hessian threshold and window
+        # from the time taken per query frame, and stale frames of video files are dropped, see save_query_objects
+        self.load_controller = load_controller
+        # If match_batcher (match_batcher.MatchBatcher object) is given, frames are matched by it, together with
+        # those of other trackers sharing it, see match_edges_batched
+        self.match_batcher = match_batcher
+        # If display_hook is set, it is called with current_location_str instead of the path being displayed here,
+        # e.g. by QueryPipeline which displays it on another thread
+        self.display_hook = None
 
     def get_query_params(self, frame_index):
         """
@@ -64,6 +196,10 @@ class RealTimeMatching:
         progress : bool -> if a match has been found or not
         """
         # Assume all possible edge objects are there in possible_edges
+        if self.match_batcher is not None:
+            return self.match_edges_batched(query_index)
+        if self.workers > 1:
+            return self.match_edges_parallel(query_index)
         progress = False
         match, maxmatch, maxedge = None, 0, None
         # These 3 variables correspond to the best match for the given query_index frame
@@ -80,34 +216,186 @@ class RealTimeMatching:
 
             # First check best match in the max confidence edges. If yes, then no need to check others
             if i == self.max_confidence_edges - 1 and match is not None:
-                print("---Max match for " + str(query_index) + ": ", end="")
-                print((match, maxedge))
-                if match is None:
-                    self.current_location_str = "---Max match for " + str(query_index) + ": (None, None)"
-                else:
-                    self.current_location_str = "---Max match for " + str(query_index) + ": (" + str(
-                        match) + " ," + str(
-                        maxedge) + " )"
-                self.graph_obj.display_path(0, self.current_location_str)
-                # Update last_5_matches
-                self.last_5_matches.append((match, maxedge))
-                if len(self.last_5_matches) > 5:
-                    self.last_5_matches.remove(self.last_5_matches[0])
+                self.update_last_matches(query_index, match, maxedge)
                 return progress
 
+        self.update_last_matches(query_index, match, maxedge)
+        return progress
+
+    def get_executor(self):
+        """
+        Returns the thread pool used for matching, creating it the first time. OpenCV's own threads are
+        divided between the workers so that together they don't use more than the available cores
+        """
+        if self.executor is None:
+            self.cv2_threads = cv2.getNumThreads()
+            cv2.setNumThreads(max(1, (os.cpu_count() or 1) // self.workers))
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self.executor
+
+    def close(self):
+        """
+        Shuts down the thread pool created by get_executor, if any, and gives OpenCV back its no of threads.
+        A pool set from outside (executor attribute) is left to its owner
+        """
+        if self.cv2_threads is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+            cv2.setNumThreads(self.cv2_threads)
+            self.cv2_threads = None
+
+    def match_edges_parallel(self, query_index):
+        """
+        Same as match_edges, but the frames are matched on a thread pool (SURF_returns spends most of its time
+        in OpenCV, which releases the GIL).
+        Frames of the max confidence edges are submitted before those of the other edges, and if the max
+        confidence edges have a match, the frames of other edges not yet matched are cancelled.
+        Results are compared in the same order as in match_edges, so the match found is also the same
+        :param:
+        query_index: current index (to be queried) of query frames
+        :return:
+        progress : bool -> if a match has been found or not
+        """
+        executor = self.get_executor()
+        query_params = self.get_query_params(query_index)
+        tiers = [[], []] # (edge_name, edge_index, future) of max confidence edges and of the other edges
+        for i, possible_edge in enumerate(self.possible_edges):
+            tier = tiers[0] if i < self.max_confidence_edges else tiers[1]
+            for j in range(possible_edge.to_match_params[0], possible_edge.to_match_params[1]):
+                tier.append((possible_edge.name, j, executor.submit(mt.SURF_returns, possible_edge.get_frame_params(j),
+                                                                    query_params)))
+        progress = False
+        match, maxmatch, maxedge = None, 0, None
+        for k, tier in enumerate(tiers):
+            for edge_name, j, future in tier:
+                fraction_matched, features_matched = future.result()
+                if fraction_matched > 0.09 or features_matched > 200:
+                    progress = True
+
+                    if fraction_matched > maxmatch:
+                        match, maxmatch, maxedge = j, fraction_matched, edge_name
+
+            # First check best match in the max confidence edges. If yes, then no need to check others
+            if k == 0 and match is not None:
+                for edge_name, j, future in tiers[1]:
+                    future.cancel()
+                break
+
+        self.update_last_matches(query_index, match, maxedge)
+        return progress
+
+    def match_edges_batched(self, query_index):
+        """
+        Same as match_edges, but the frames are matched by match_batcher, in a batch with the frames other
+        trackers are matching at the same time. Frames of the max confidence edges are matched first, and those
+        of the other edges only if they have no match, as in match_edges
+        :param:
+        query_index: current index (to be queried) of query frames
+        :return:
+        progress : bool -> if a match has been found or not
+        """
+        query_params = self.get_query_params(query_index)
+        tiers = [self.possible_edges[:self.max_confidence_edges], self.possible_edges[self.max_confidence_edges:]]
+        progress = False
+        match, maxmatch, maxedge = None, 0, None
+        for tier in tiers:
+            pairs = [(possible_edge, j) for possible_edge in tier
+                     for j in range(possible_edge.to_match_params[0], possible_edge.to_match_params[1])]
+            results = self.match_batcher.match(query_params, [(possible_edge.edge, j) for possible_edge, j in pairs])
+            for (possible_edge, j), (fraction_matched, features_matched) in zip(pairs, results):
+                if fraction_matched > 0.09 or (features_matched is not None and features_matched > 200):
+                    progress = True
+
+                    if fraction_matched > maxmatch:
+                        match, maxmatch, maxedge = j, fraction_matched, possible_edge.name
+
+            # First check best match in the max confidence edges. If yes, then no need to check others
+            if match is not None:
+                break
+
+        self.update_last_matches(query_index, match, maxedge)
+        return progress
+
+    def update_last_matches(self, query_index, match, maxedge):
+        """
+        Displays the best match for the query frame and updates last_5_matches and last_matched with it
+        :param query_index: index of the query frame
+        :param match: edge_index (int) of the best match, None if nothing matched
+        :param maxedge: edge_name (str) of the best match
+        :return: None
+        """
         print("---Max match for " + str(query_index) + ": ", end="")
         print((match, maxedge))
         if match is None:
             self.current_location_str = "---Max match for " + str(query_index) + ": (None, None)"
+            self.frames_without_match += 1
         else:
             self.current_location_str = "---Max match for " + str(query_index) + ": (" + str(match) + " ," + str(
                 maxedge) + " )"
-        self.graph_obj.display_path(0, self.current_location_str)
+            self.frames_without_match = 0
+            self.last_matched[maxedge] = (match, self.query_objects.get_object(query_index).get_time())
+        self.show_path()
         # Update last_5_matches
         self.last_5_matches.append((match, maxedge))
         if len(self.last_5_matches) > 5:
             self.last_5_matches.remove(self.last_5_matches[0])
-        return progress
+
+    def set_search_windows(self, query_index):
+        """
+        Restricts to_match_params of possible_edges (when tracking) to the frames the user can be at:
+        for the current edge, frames from the last matched frame up to a few frames beyond the frame expected
+        from the time elapsed since, and for the other edges their first few (entry) frames.
+        The windows double in size for every query frame in a row with no match.
+        :param query_index: index of the query frame to be matched
+        :return: None
+        """
+        if not self.tracking or self.probable_path is None:
+            return
+        query_time = self.query_objects.get_object(query_index).get_time()
+        widen = 2 ** min(self.frames_without_match, 16)
+        for possible_edge in self.possible_edges:
+            if possible_edge.name == self.probable_path.name and possible_edge.name in self.last_matched:
+                last_index, last_time = self.last_matched[possible_edge.name]
+                expected_index = possible_edge.get_expected_index(last_index, query_time - last_time)
+                possible_edge.set_window(last_index - self.window * widen,
+                                         expected_index + self.window * widen + 1)
+            else:
+                possible_edge.set_window(0, self.entry_frames * widen)
+
+    def relocalisation_edges(self, query_index):
+        """
+        Returns possible_edges to be matched when the location is not known: edges of the top_k frames of
+        visual_index most similar to the query frame, each to be matched around those frames, followed by
+        the other edges in last_5_matches (so that votes for them can still be confirmed)
+        :param query_index: index of the query frame to be matched
+        :return: list of PossibleEdge objects
+        """
+        descriptors = self.get_query_params(query_index)[1]
+        possible_edges, names = [], set()
+        for edge, frame_indexes in self.visual_index.candidate_edges(self.graph_obj, descriptors, self.top_k):
+            possible_edge = PossibleEdge(edge)
+            possible_edge.set_window(frame_indexes[0] - self.window, frame_indexes[-1] + self.window + 1)
+            possible_edges.append(possible_edge)
+            names.add(edge.name)
+        for match, edge_name in self.last_5_matches:
+            if edge_name is None or edge_name in names:
+                continue
+            src, dest = edge_name.split("_")
+            edge = self.graph_obj.get_edge(int(src), int(dest))
+            if edge is None:
+                continue
+            possible_edge = PossibleEdge(edge)
+            possible_edge.set_window(match - self.window, match + self.window + 1)
+            possible_edges.append(possible_edge)
+            names.add(edge_name)
+        return possible_edges
+
+    def show_path(self):
+        """Displays the path traversed along with current_location_str, or hands them over to display_hook"""
+        if self.display_hook is not None:
+            self.display_hook(self.current_location_str)
+        else:
+            self.graph_obj.display_path(0, self.current_location_str)
 
     def handle_edges(self):
         """
@@ -116,20 +404,29 @@ class RealTimeMatching:
         based on last_5_matches
         :return: None
         """
+        if self.hmm_tracker is not None:
+            self.handle_edges_hmm()
+            return
+
         # if self.confirmed_path is empty then starting pt is not defined yet.
         if len(self.confirmed_path) == 0:
 
-            # Append all edges in self.possible_edges with the to_match_params being only the first frame of each edge
-            for nd in self.graph_obj.Nodes[0]:
-                for edge in nd.links:
-                    possible_edge_node = PossibleEdge(edge)
-                    possible_edge_node.to_match_params = (0, 1) # <- Change this to include more frames of each edge
-                                                                # in determination of initial node
-                    self.possible_edges.append(possible_edge_node)
-
             # Pick up the last query index
 
             query_index = self.query_objects.no_of_frames() - 1
+
+            if self.visual_index is not None:
+                self.possible_edges = self.relocalisation_edges(query_index)
+            else:
+                # Append all edges in self.possible_edges with the to_match_params being only the first frame of
+                # each edge
+                for nd in self.graph_obj.Nodes[0]:
+                    for edge in nd.links:
+                        possible_edge_node = PossibleEdge(edge)
+                        possible_edge_node.to_match_params = (0, 1) # <- Change this to include more frames of each
+                                                                    # edge in determination of initial node
+                        self.possible_edges.append(possible_edge_node)
+
             progress = self.match_edges(query_index)
 
             # We need at least 2 matches to consider first node
@@ -189,7 +486,13 @@ class RealTimeMatching:
 
         # If something is already there is self.next_possible_edges, use that
         elif len(self.next_possible_edges) != 0:
-            self.possible_edges = self.next_possible_edges
+            if self.visual_index is not None and self.frames_without_match >= self.relocalise_after:
+                # Track lost, search where the query frame looks like instead of around the last location
+                self.possible_edges = self.relocalisation_edges(self.query_objects.no_of_frames() - 1)
+                self.max_confidence_edges = 0
+            else:
+                self.possible_edges = self.next_possible_edges
+                self.set_search_windows(self.query_objects.no_of_frames() - 1)
 
         # Else use the node identity stored in self.confirmed_path
         # This should be deprecated i guess
@@ -269,7 +572,7 @@ class RealTimeMatching:
         nd = self.graph_obj.get_node(self.probable_path.edge.dest)
         if cur_edge_index > self.probable_path.no_of_frames - 2:
             count_of_straight_edges, straightPossibleEdge = 0, None
-            for tup in self.probable_path.edge.angles:
+            for tup in self.graph_obj.get_edge_angles(self.probable_path.edge):
                 if abs(tup[1]) < 20:
                     count_of_straight_edges += 1
                     src, dest = tup[0].split('_')
@@ -291,7 +594,10 @@ class RealTimeMatching:
                     cur_edge_index = 0
                     self.next_possible_edges = [self.probable_path]
                     nd = self.graph_obj.get_node(self.probable_path.edge.dest)
-        for edge in nd.links:
+        if self.rotation_estimator is not None and \
+                cur_edge_index + 1 < self.approach_fraction * self.probable_path.no_of_frames:
+            self.rotation_estimator.reset() # Walking along the edge, heading is measured from here on
+        for edge in self.ordered_links(nd)[0]:
             present = False
             for possible_edg in self.next_possible_edges:
                 if possible_edg.name == edge.name:
@@ -307,6 +613,9 @@ class RealTimeMatching:
             possibleEdge = PossibleEdge(edge)
             self.next_possible_edges.append(possibleEdge)
 
+        if self.check_junction(query_index, cur_edge_index):
+            return
+
         # Displaying current location on graph
         # print(str(most_occuring_edge)+", "+str(cur_edge_index))
         edgeObj, allow = None, True
@@ -317,49 +626,141 @@ class RealTimeMatching:
                     edgeObj = edge
                     allow = False
                     break
-        last_jth_matched_img_obj = edgeObj.distinct_frames.get_object(cur_edge_index)
+        self.show_location(edgeObj, cur_edge_index)
+        return
+
+    def ordered_links(self, nd: Node):
+        """
+        Returns edges leaving nd, the destination of the current edge, ordered by how well their angle from the
+        current edge agrees with the heading change measured by rotation_estimator. Once the user has clearly
+        turned, edges not agreeing with the turn are left out
+        :param nd: Node object
+        :return: (list of Edge objects, True if the user has clearly turned)
+        """
+        if self.rotation_estimator is None or self.probable_path is None or \
+                nd.identity != self.probable_path.edge.dest:
+            return nd.links, False
+        heading_change = self.rotation_estimator.heading_change
+        ranked = rank_turns(self.graph_obj.get_edge_angles(self.probable_path.edge), heading_change)
+        links = {edge.name: edge for edge in nd.links}
+        ordered = [links[edge_name] for edge_name, angle, error in ranked if edge_name in links]
+        if len(ordered) == 0:
+            return nd.links, False
+        return ordered, len(ordered) < len(links)
+
+    def check_junction(self, query_index, cur_edge_index):
+        """
+        When the user is near the end of the current edge, checks if the query frame shows its destination
+        node. Once junction_detector confirms it, the current edge is marked traversed, the user is shown at
+        the node, and next_possible_edges are narrowed down to the edges leaving the node (with last 5 matches
+        cleared so that the next edge is decided only by matches with them)
+        :param query_index: index of the query frame
+        :param cur_edge_index: index of the frame of the current edge the user is at
+        :return: True if the user is at the node
+        """
+        if self.junction_detector is None:
+            return False
+        if cur_edge_index + 1 < self.approach_fraction * self.probable_path.no_of_frames:
+            self.junction_detector.reset()
+            return False
+        nd = self.graph_obj.get_node(self.probable_path.edge.dest)
+        if nd is None or not self.junction_detector.detect(nd, self.get_query_params(query_index)):
+            return False
+        links, turned = self.ordered_links(nd)
+        next_possible_edges = [PossibleEdge(edge) for edge in links if edge.distinct_frames is not None]
+        if len(next_possible_edges) == 0:
+            return False
+        self.junction_detector.reset()
+        self.next_possible_edges = next_possible_edges
+        # If the turn taken is known, the edge agreeing best with it is checked first
+        self.max_confidence_edges = 1 if turned else 0
+        self.last_5_matches = []
+        self.confirmed_path.append(nd.identity)
+        self.graph_obj.on_edge(self.probable_path.edge.src, nd.identity, 1)
+        self.graph_obj.on_node(nd.identity)
+        self.show_path()
+        return True
+
+    def handle_edges_hmm(self):
+        """
+        Decides the current location using hmm_tracker instead of last_5_matches. Only frames of the states
+        the tracker expects the user to be at are matched with the latest query frame
+        :return: None
+        """
+        query_index = self.query_objects.no_of_frames() - 1
+        candidates = self.hmm_tracker.predict()
+        fractions = []
+        if self.match_batcher is not None:
+            space = self.hmm_tracker.space
+            results = self.match_batcher.match(self.get_query_params(query_index),
+                                               [(space.get_edge(state), space.get_frame_index(state))
+                                                for state in candidates])
+            fractions = [fraction_matched for fraction_matched, features_matched in results]
+        for state in candidates[len(fractions):]:
+            fraction_matched, features_matched = mt.SURF_returns(self.hmm_tracker.space.get_frame_params(state),
+                                                                 self.get_query_params(query_index))
+            fractions.append(fraction_matched)
+        self.hmm_tracker.update(fractions)
+
+        edge, frame_index, self.confidence = self.hmm_tracker.location()
+        if edge is None:
+            self.update_last_matches(query_index, None, None)
+            return
+        self.update_last_matches(query_index, frame_index, edge.name)
+        self.show_location(edge, frame_index)
+
+    def show_location(self, edge: Edge, edge_index):
+        """
+        Marks the location on the graph as the point on edge where its frame at edge_index was taken
+        :param edge: Edge object
+        :param edge_index: index of frame of the edge
+        :return: None
+        """
+        last_jth_matched_img_obj = edge.distinct_frames.get_object(edge_index)
         time_stamp = last_jth_matched_img_obj.get_time()
-        total_time = edgeObj.distinct_frames.get_time()
+        total_time = edge.distinct_frames.get_time()
         fraction = time_stamp / total_time if total_time != 0 else 0
-        self.graph_obj.on_edge(edgeObj.src, edgeObj.dest, fraction)
+        self.graph_obj.on_edge(edge.src, edge.dest, fraction)
         # print("graph called")
-        self.graph_obj.display_path(0,self.current_location_str)
-        return
-
-    def save_query_objects(self, video_path, folder="query_distinct_frame", livestream=False, write_to_disk=False,
-                           frames_skipped=0):
+        self.show_path()
 
+    def open_source(self, video_path, livestream=False, mjpeg=False, reduction=1):
         """
-        Receives and reads query video, generates non-blurry gray image frames, creates ImgObj and
-        updates query_objects
+        Opens query video
         :param video_path: The address of query video , can be a path or a url, str format
-        :param folder: Path of folder to save query frames, str format
         :param livestream: bool, If True: then video_path is a url , If False: video_path is a path on disk
-        :param write_to_disk: bool, If True, then query frames will be saved
-        to specified folder in .pkl and .jpg formats
-        :param frames_skipped: int, No of frames to be skipped in query video
-        :return: None
+        :param mjpeg: bool, If True (and livestream), video_path is an MJPEG stream instead of a snapshot url
+        :param reduction: int (1, 2, 4 or 8), livestream frames are decoded at 1 / reduction of their size
+        (matching thresholds are tuned for query frames of the size graph frames were extracted at)
+        :return: IPCameraSource (giving grayscale frames) if livestream, else cv2.VideoCapture
         """
+        if livestream:
+            # Frames are fetched on a background thread over one connection, and are already grayscale
+            return IPCameraSource(video_path, mjpeg=mjpeg, reduction=reduction).start()
+        return cv2.VideoCapture(video_path)
 
+    def read_frames(self, cap, livestream=False, frames_skipped=0):
+        """
+        Reads frames of query video opened by open_source, leaving out skipped, stale (see load_controller),
+        near duplicate (see change_detector) and blurry frames
+        :return: generator of (index of frame in the video, gray image, time read) of frames to be localised,
+        with gray image None when there is no frame to be localised for a while (so that the display can be
+        kept responsive)
+        """
         frames_skipped += 1
-        hessian_threshold = 2500
-
-        if write_to_disk:
-            if os.path.exists(folder):
-                print('---INPUT REQD----" ' + folder + " \"alongwith its contents will be deleted. Continue? (y/n)")
-                if input() == "y":
-                    shutil.rmtree(folder)
-        general.ensure_path(folder + '/jpg')
-
-        detector = cv2.xfeatures2d_SURF.create(hessian_threshold)
-
-        cap = cv2.VideoCapture(video_path)
         i = 0
         while True:
             if livestream:
-                cap = cv2.VideoCapture(video_path)
-            ret, frame = cap.read()
+                ret, frame = cap.read(timeout=1)
+                if not ret:
+                    # Camera not reachable yet, keep waiting (IPCameraSource reconnects by itself)
+                    yield i, None, time.time()
+                    continue
+            else:
+                ret, frame = cap.read()
 
+            if self.load_controller is not None:
+                frames_skipped = self.load_controller.frames_skipped + 1
             if i % frames_skipped != 0:
                 i = i + 1
                 continue
@@ -367,43 +768,236 @@ class RealTimeMatching:
             if not ret:
                 break
 
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-            if vo.is_blurry_grayscale(gray):
+            read_at = time.time()
+            # A live stream always gives the latest frame, but frames of a video file can fall behind
+            if self.load_controller is not None and not livestream and \
+                    self.load_controller.is_stale(cap.get(cv2.CAP_PROP_POS_MSEC) / 1000):
+                i = i + 1
                 continue
 
-            # cv2.imshow('Query Video!!', gray)
-            break_video= one_frame.run_query_frame(gray)
+            gray = frame if livestream else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
 
-            keypoints, descriptors = detector.detectAndCompute(gray, None)
-            if len(keypoints) < 50:
-                print("frame skipped as keypoints", len(keypoints), " less than 50")
+            if self.change_detector is not None and self.change_detector.is_duplicate(gray):
+                if livestream:
+                    time.sleep(self.change_detector.idle_delay())
+                yield i, None, read_at
                 i = i + 1
                 continue
 
-            a = (len(keypoints), descriptors, vo.serialize_keypoints(keypoints), gray.shape)
-            img_obj = vo.ImgObj(a[0], a[1], i, a[2], a[3])
+            if vo.is_blurry_grayscale(gray):
+                i = i + 1
+                continue
 
-            self.query_objects.add_img_obj(img_obj)
+            if self.rotation_estimator is not None:
+                self.rotation_estimator.update(gray)
 
-            if write_to_disk:
-                general.save_to_memory(img_obj, 'image' + str(i) + '.pkl', folder)
-                cv2.imwrite(folder + '/jpg/image' + str(i) + '.jpg', gray)
+            yield i, gray, read_at
+            i = i + 1
 
-            if (cv2.waitKey(1) & 0xFF == ord('q')) or break_video:
-                break
+    def extract_features(self, i, gray, detector):
+        """
+        Creates ImgObj of query frame, unless klt_tracker finds it too similar to the last frame localised
+        or it has too few keypoints
+        :param i: index of the frame in the video, used as its time_stamp
+        :param gray: gray image
+        :param detector: SURF detector, whose hessian threshold is kept as set by load_controller
+        :return: ImgObj or None
+        """
+        if self.klt_tracker is not None and self.klt_tracker.track(gray) and self.location_known:
+            # Same scene as the last frame matched, so the location found for it still holds
+            return None
+
+        if self.load_controller is not None and \
+                detector.getHessianThreshold() != self.load_controller.hessian_threshold:
+            detector.setHessianThreshold(self.load_controller.hessian_threshold)
+        keypoints, descriptors = detector.detectAndCompute(gray, None)
+        if len(keypoints) < 50:
+            print("frame skipped as keypoints", len(keypoints), " less than 50")
+            return None
+
+        a = (len(keypoints), descriptors, vo.serialize_keypoints(keypoints), gray.shape)
+        return vo.ImgObj(a[0], a[1], i, a[2], a[3])
+
+    def process_frame(self, img_obj, gray, read_at=None):
+        """
+        Localises a query frame
+        :param img_obj: ImgObj of the frame, from extract_features
+        :param gray: gray image of the frame
+        :param read_at: time the frame was read, for load_controller
+        :return: None
+        """
+        self.query_objects.add_img_obj(img_obj)
+
+        # Calling the localisation functions
+        self.handle_edges()
+        self.frames_matched += 1
+        self.location_known = self.probable_path is not None and self.frames_without_match == 0
+        if self.change_detector is not None:
+            self.change_detector.processed(gray)
+        if self.klt_tracker is not None:
+            self.klt_tracker.start(gray)
+        if self.load_controller is not None and read_at is not None and self.load_controller.frame_done(read_at):
+            self.window = self.load_controller.window
+
+    def snapshot(self, path_items: int = 32):
+        """
+        Returns tracking state as a dict of plain values (JSON serializable), edges referenced by name, so that
+        tracking can be resumed from it by restore() on another RealTimeMatching, in another process, on the
+        same graph. Query frames and the state of the optional helpers (klt_tracker, rotation_estimator, ...)
+        are not included, they are rebuilt from the next query frames
+        :param path_items: no of latest items of path_traversed included
+        :return: dict
+        """
+        def windows(possible_edges):
+            return [[possible_edge.name, possible_edge.to_match_params[0], possible_edge.to_match_params[1]]
+                    for possible_edge in possible_edges]
+
+        path = list(self.graph_obj.path_traversed)[-path_items:] if path_items > 0 else []
+        return {
+            "version": SNAPSHOT_VERSION,
+            "map_version": getattr(self.graph_obj, "map_version", 0),
+            "confirmed_path": list(self.confirmed_path),
+            "probable_path": self.probable_path.name if self.probable_path is not None else None,
+            "possible_edges": windows(self.possible_edges),
+            "next_possible_edges": windows(self.next_possible_edges),
+            "max_confidence_edges": self.max_confidence_edges,
+            "last_5_matches": [[match, edge_name] for match, edge_name in self.last_5_matches],
+            "last_matched": {edge_name: [match, time_stamp] for edge_name, (match, time_stamp)
+                             in self.last_matched.items()},
+            "frames_without_match": self.frames_without_match,
+            "window": self.window,
+            "confidence": float(self.confidence),
+            "path_traversed": [list(item) if type(item) == tuple else item for item in path],
+            "hmm": self.hmm_tracker.snapshot() if self.hmm_tracker is not None else None,
+        }
+
+    def restore(self, snapshot):
+        """
+        Resumes tracking from snapshot (see snapshot()), so that the next query frame is matched around the
+        location it holds instead of with all the edges. Edges no longer in the graph are left out. If the
+        graph has changed since (map_version), frames of an edge may have changed too, so the edges are matched
+        in full and the frames last matched are forgotten (as are, in any case, frames last matched beyond the
+        end of their edge). The snapshot is checked in full before anything is changed, so an invalid one leaves
+        the tracker as it was
+        :param snapshot: dict returned by snapshot()
+        :return: None
+        :raises SnapshotError: if snapshot is not valid
+        """
+        if not isinstance(snapshot, dict) or snapshot.get("version") != SNAPSHOT_VERSION:
+            raise SnapshotError("Not a version " + str(SNAPSHOT_VERSION) + " tracker snapshot")
+        try:
+            check_snapshot(snapshot)
+            same_map = snapshot["map_version"] == getattr(self.graph_obj, "map_version", 0)
+            restored = {}  # edge name -> PossibleEdge, so that the lists share objects as they do when tracking
+
+            def resolve(windows):
+                result = []
+                for edge_name, start, end in windows:
+                    if edge_name not in restored:
+                        src, dest = edge_name.split("_")
+                        edge = self.graph_obj.get_edge(int(src), int(dest))
+                        if edge is None or edge.distinct_frames is None:
+                            continue
+                        restored[edge_name] = PossibleEdge(edge)
+                        if same_map:
+                            restored[edge_name].set_window(start, end)
+                    result.append(restored[edge_name])
+                return result
+
+            possible_edges = resolve(snapshot["possible_edges"])
+            next_possible_edges = resolve(snapshot["next_possible_edges"])
+            if self.hmm_tracker is not None and snapshot["hmm"] is not None:
+                self.hmm_tracker.restore(snapshot["hmm"])  # changes nothing if it raises
+        except (KeyError, TypeError, ValueError) as exception:
+            raise SnapshotError("Invalid tracker snapshot: " + repr(exception))
+
+        self.possible_edges = possible_edges
+        self.next_possible_edges = next_possible_edges
+        self.probable_path = restored.get(snapshot["probable_path"])
+        self.confirmed_path = list(snapshot["confirmed_path"]) if self.probable_path is not None else []
+        self.max_confidence_edges = min(snapshot["max_confidence_edges"], len(self.next_possible_edges))
+        self.last_5_matches = [(match, edge_name) for match, edge_name in snapshot["last_5_matches"]]
+        # Frames matched last beyond the end of their edge can't be tracked from, so they are forgotten too
+        self.last_matched = {edge_name: (match, time_stamp) for edge_name, (match, time_stamp)
+                             in snapshot["last_matched"].items()
+                             if same_map and edge_name in restored and match < restored[edge_name].no_of_frames}
+        self.frames_without_match = snapshot["frames_without_match"]
+        self.location_known = self.probable_path is not None and self.frames_without_match == 0
+        self.window = snapshot["window"]
+        self.confidence = snapshot["confidence"]
+        for item in snapshot["path_traversed"]:
+            self.graph_obj.path_traversed.append(tuple(item) if type(item) == list else item)
+
+    def prepare_folder(self, folder):
+        """Asks before deleting folder if it exists, and creates folder/jpg for query frames to be saved in"""
+        if os.path.exists(folder):
+            print('---INPUT REQD----" ' + folder + " \"alongwith its contents will be deleted. Continue? (y/n)")
+            if input() == "y":
+                shutil.rmtree(folder)
+        general.ensure_path(folder + '/jpg')
 
-            # Calling the localisation functions
-            self.handle_edges()
+    @staticmethod
+    def write_query_frame(img_obj, gray, folder):
+        """Saves query frame to folder in .pkl and .jpg formats"""
+        general.save_to_memory(img_obj, 'image' + str(img_obj.get_time()) + '.pkl', folder)
+        cv2.imwrite(folder + '/jpg/image' + str(img_obj.get_time()) + '.jpg', gray)
 
-            i = i + 1
+    def save_query_objects(self, video_path, folder="query_distinct_frame", livestream=False, write_to_disk=False,
+                           frames_skipped=0, mjpeg=False, reduction=1):
+
+        """
+        Receives and reads query video, generates non-blurry gray image frames, creates ImgObj and
+        updates query_objects, all one after the other on this thread (see query_pipeline.QueryPipeline to run
+        them concurrently)
+        :param video_path: The address of query video , can be a path or a url, str format
+        :param folder: Path of folder to save query frames, str format
+        :param livestream: bool, If True: then video_path is a url , If False: video_path is a path on disk
+        :param write_to_disk: bool, If True, then query frames will be saved
+        to specified folder in .pkl and .jpg formats
+        :param frames_skipped: int, No of frames to be skipped in query video
+        :param mjpeg: bool, If True (and livestream), video_path is an MJPEG stream instead of a snapshot url
+        :param reduction: int (1, 2, 4 or 8), livestream frames are decoded at 1 / reduction of their size
+        (matching thresholds are tuned for query frames of the size graph frames were extracted at)
+        :return: None
+        """
+
+        hessian_threshold = 2500
+        if self.load_controller is not None:
+            hessian_threshold = self.load_controller.hessian_threshold
+            self.window = self.load_controller.window
+
+        if write_to_disk:
+            self.prepare_folder(folder)
+
+        detector = cv2.xfeatures2d_SURF.create(hessian_threshold)
+
+        cap = self.open_source(video_path, livestream, mjpeg, reduction)
+        for i, gray, read_at in self.read_frames(cap, livestream, frames_skipped):
+            if gray is None:
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+                continue
+
+            # cv2.imshow('Query Video!!', gray)
+            break_video = one_frame.run_query_frame(gray)
+
+            img_obj = self.extract_features(i, gray, detector)
+            if img_obj is not None:
+                if write_to_disk:
+                    self.write_query_frame(img_obj, gray, folder)
+                self.process_frame(img_obj, gray, read_at)
+
+            if (cv2.waitKey(1) & 0xFF == ord('q')) or break_video:
+                break
 
         cap.release()
+        self.query_objects.close()
+        self.close()
         cv2.destroyAllWindows()
 
 
-graph1: Graph = Graph.load_graph("new_objects/graph.pkl")
-realTimeMatching = RealTimeMatching(graph1)
-url = "http://10.194.36.234:8080/shot.jpg"
-realTimeMatching.save_query_objects(url, livestream=True,
-                                    frames_skipped=0)
+if __name__ == '__main__':
+    graph1: Graph = Graph.load_graph("new_objects/graph.pkl")
+    realTimeMatching = RealTimeMatching(graph1)
+    url = "http://10.194.36.234:8080/shot.jpg"
+    QueryPipeline(realTimeMatching).run(url, livestream=True, frames_skipped=0)
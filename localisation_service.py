@@ -0,0 +1,178 @@
+"""localisation_service.py
+HTTP service localising many devices at once on one graph (see localisation_engine): each client session
+gets its own tracker, and posts its query frames to get back its current location
+
+    POST   /sessions                        -> 201 {"session_id": ...}, body (optional, JSON): RealTimeMatching
+                                               options, e.g. {"use_hmm": true, "window": 2}
+    POST   /sessions/{session_id}/frames    -> 200 location, body: JPEG/PNG image, query param frame_index
+                                               (optional): index of the frame in the device's video
+    POST   /sessions/{session_id}/features  -> 200 location, body: SURF features extracted by the device,
+                                               see feature_wire
+    GET    /sessions/{session_id}/state     -> 200 state of the session (see Session.snapshot), to checkpoint it
+    PUT    /sessions/{session_id}/state     -> 201 {"session_id": ...}, body: state from GET, resumes the session
+                                               on this worker (replacing it if it is here already), e.g. after
+                                               the worker it was on restarted. 400 if the state is invalid or
+                                               session_id isn't one the service made (32 hex digits)
+    DELETE /sessions/{session_id}           -> 204
+    GET    /health                          -> 200 no of sessions and frames being localised
+
+Run with gunicorn, with a thread per concurrent request:
+    gunicorn -w 1 --threads 8 localisation_service:app
+configured by environment variables GRAPH_PATH, SESSION_TTL (seconds), MAX_SESSIONS, MAX_CONCURRENT
+(frames localised at once), QUEUE_TIMEOUT (seconds a frame may wait for its turn before 503) and BATCH_WINDOW
+(milliseconds, frames of different sessions arriving within it are matched together, off if not given)
+
+GRAPH_PATH can be a graph.pkl or a folder saved by graph_arena.save_arena. Loaded from an arena, the frames
+of the graph are memory mapped and shared by all worker processes, so more workers (-w) cost little memory.
+Sessions are kept in the memory of the worker which created them though, so with more than one worker the
+requests of a session should reach the same worker (e.g. a proxy routing on session_id, or a device keeping
+one keep-alive connection). A session can be moved to another worker with GET and PUT of its state, which
+holds where the device was, so the new worker doesn't have to search the whole graph for it again
+"""
+
+import os
+import falcon
+import feature_wire
+from localisation_engine import LocalisationEngine, SnapshotError, check_options, decode_frame
+
+
+class SessionsResource:
+    def __init__(self, engine: LocalisationEngine):
+        self.engine = engine
+
+    def on_post(self, req, resp):
+        options = req.media if req.content_length else {}
+        error = check_options(options)
+        if error is not None:
+            raise falcon.HTTPBadRequest(title="Invalid options", description=error)
+        session = self.engine.create_session(**options)
+        if session is None:
+            raise falcon.HTTPServiceUnavailable(title="Too many sessions",
+                                                description="Try again once other sessions end", retry_after=30)
+        resp.status = falcon.HTTP_201
+        resp.media = {"session_id": session.session_id, "session_ttl": self.engine.session_ttl}
+
+
+class SessionResource:
+    def __init__(self, engine: LocalisationEngine):
+        self.engine = engine
+
+    def on_delete(self, req, resp, session_id):
+        if not self.engine.delete_session(session_id):
+            raise falcon.HTTPNotFound(title="No such session", description="Session may have expired")
+        resp.status = falcon.HTTP_204
+
+
+class FramesResource:
+    def __init__(self, engine: LocalisationEngine):
+        self.engine = engine
+
+    def on_post(self, req, resp, session_id):
+        session = self.engine.get_session(session_id)
+        if session is None:
+            raise falcon.HTTPNotFound(title="No such session", description="Session may have expired")
+        frame_index = req.get_param_as_int("frame_index")
+        gray = decode_frame(req.bounded_stream.read())
+        if gray is None:
+            raise falcon.HTTPBadRequest(title="Invalid frame", description="Body should be a JPEG or PNG image")
+        result = self.engine.localise(session, gray, frame_index)
+        if result is None:
+            raise falcon.HTTPServiceUnavailable(title="Busy", description="Too many frames being localised",
+                                                retry_after=1)
+        result["session_id"] = session_id
+        resp.media = result
+
+
+class FeaturesResource:
+    def __init__(self, engine: LocalisationEngine):
+        self.engine = engine
+
+    def on_post(self, req, resp, session_id):
+        session = self.engine.get_session(session_id)
+        if session is None:
+            raise falcon.HTTPNotFound(title="No such session", description="Session may have expired")
+        try:
+            img_obj, params = feature_wire.decode(req.bounded_stream.read())
+        except feature_wire.WireError as exception:
+            raise falcon.HTTPBadRequest(title="Invalid features", description=str(exception))
+        error = self.engine.check_features(params)
+        if error is not None:
+            raise falcon.HTTPBadRequest(title="Features don't match graph", description=error)
+        result = self.engine.localise_features(session, img_obj)
+        if result is None:
+            raise falcon.HTTPServiceUnavailable(title="Busy", description="Too many frames being localised",
+                                                retry_after=1)
+        result["session_id"] = session_id
+        resp.media = result
+
+
+class StateResource:
+    def __init__(self, engine: LocalisationEngine):
+        self.engine = engine
+
+    def on_get(self, req, resp, session_id):
+        session = self.engine.get_session(session_id)
+        if session is None:
+            raise falcon.HTTPNotFound(title="No such session", description="Session may have expired")
+        state = self.engine.snapshot_session(session)
+        if state is None:
+            raise falcon.HTTPServiceUnavailable(title="Busy", description="A frame of the session is being localised",
+                                                retry_after=1)
+        resp.media = state
+
+    def on_put(self, req, resp, session_id):
+        try:
+            session = self.engine.restore_session(req.media, session_id)
+        except SnapshotError as exception:
+            raise falcon.HTTPBadRequest(title="Invalid state", description=str(exception))
+        if session is None:
+            raise falcon.HTTPServiceUnavailable(title="Too many sessions",
+                                                description="Try again once other sessions end", retry_after=30)
+        resp.status = falcon.HTTP_201
+        resp.media = {"session_id": session.session_id, "session_ttl": self.engine.session_ttl}
+
+
+class HealthResource:
+    def __init__(self, engine: LocalisationEngine):
+        self.engine = engine
+
+    def on_get(self, req, resp):
+        resp.media = self.engine.metrics()
+
+
+def create_app(engine: LocalisationEngine = None):
+    """
+    Returns WSGI app serving engine, by default a LocalisationEngine configured by environment variables
+    """
+    if engine is None:
+        engine = LocalisationEngine(os.environ.get("GRAPH_PATH", "new_objects/graph.pkl"),
+                                    session_ttl=float(os.environ.get("SESSION_TTL", 300)),
+                                    max_sessions=int(os.environ.get("MAX_SESSIONS", 100)),
+                                    max_concurrent=int(os.environ.get("MAX_CONCURRENT", 4)),
+                                    queue_timeout=float(os.environ.get("QUEUE_TIMEOUT", 2.0)),
+                                    batch_window=float(os.environ["BATCH_WINDOW"]) / 1000
+                                    if "BATCH_WINDOW" in os.environ else None)
+    # falcon.API was renamed to falcon.App in falcon 3.0
+    app_class = getattr(falcon, "App", None) or falcon.API
+    app = app_class()
+    app.add_route("/sessions", SessionsResource(engine))
+    app.add_route("/sessions/{session_id}", SessionResource(engine))
+    app.add_route("/sessions/{session_id}/frames", FramesResource(engine))
+    app.add_route("/sessions/{session_id}/features", FeaturesResource(engine))
+    app.add_route("/sessions/{session_id}/state", StateResource(engine))
+    app.add_route("/health", HealthResource(engine))
+    return app
+
+
+app = create_app()
+
+if __name__ == '__main__':
+    # For trying out locally, use gunicorn otherwise
+    from socketserver import ThreadingMixIn
+    from wsgiref.simple_server import make_server, WSGIServer
+
+    class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+
+    print("Serving on port 8000")
+    make_server("", 8000, app, server_class=ThreadingWSGIServer).serve_forever()
@@ -0,0 +1,117 @@
+"""map_renderer.py
+Draws the path traversed and the current location on the floor map for the live display
+"""
+
+import cv2
+import image_in_one_frame as one_frame
+
+
+class MapRenderer:
+    """
+    Keeps the static graph image of a floor, already scaled to the display size, and a copy of it with
+    the path traversed drawn on it. Items are drawn on the path layer once they are final, so every frame
+    only needs to copy it and draw the item in progress along with the current location marker.
+
+    Attributes
+    __________
+    floor_no : int
+    size : tuple
+        (width, height) of the rendered image
+    base : np.ndarray
+        nodes and edges of the floor drawn on the floor map, scaled to size
+    path_layer : np.ndarray
+        base with the path traversed drawn on it
+    drawn_len : int
+        no of items of the whole path_traversed already drawn on path_layer
+    """
+
+    def __init__(self, floor_no: int = 0, size=one_frame.GRAPH_FRAME_SIZE):
+        self.floor_no = floor_no
+        self.size = size
+        self.scale = (1.0, 1.0)
+        self.coordinates = {}  # node identity -> (x, y) on the scaled image
+        self.base = None
+        self.path_layer = None
+        self.drawn_len = 0
+
+    def __getstate__(self):
+        # Images are redrawn after loading instead of being pickled with the graph
+        state = self.__dict__.copy()
+        state["base"] = None
+        state["path_layer"] = None
+        return state
+
+    def invalidate(self):
+        """Called when nodes or edges of the floor change, so that the base image is redrawn"""
+        self.base = None
+        self.path_layer = None
+
+    def render(self, graph_obj, path_traversed, current_location_str=""):
+        """
+        Returns image of the floor map with path_traversed and the current location (its last item) drawn on it
+        :param graph_obj: Graph object the floor belongs to
+        :param path_traversed: PathHistory of node identities and (src, dest, fraction_traversed) tuples
+        :param current_location_str: text written on top of the image
+        :return: image of size self.size
+        """
+        if self.base is None:
+            self._draw_base(graph_obj)
+        self._update_path_layer(path_traversed)
+
+        img = self.path_layer.copy()
+        s = self._thickness_scale()
+        if len(path_traversed) > 0:
+            self._draw_item(img, path_traversed[-1])
+            cv2.circle(img, self._location(path_traversed[-1]), max(1, int(round(15 * s))), (0, 200, 0), -1,
+                       cv2.LINE_AA)
+        if current_location_str != "":
+            cv2.putText(img, current_location_str, (int(20 * self.scale[0]), int(32 * self.scale[1])),
+                        cv2.FONT_HERSHEY_COMPLEX, s, (0, 0, 0), max(1, int(round(2 * s))))
+        return img
+
+    def _draw_base(self, graph_obj):
+        img = graph_obj.print_graph_and_return(self.floor_no)
+        height, width = img.shape[:2]
+        self.scale = (self.size[0] / width, self.size[1] / height)
+        self.base = cv2.resize(img, self.size, interpolation=cv2.INTER_AREA)
+        self.coordinates = {}
+        for identity, coordinates in graph_obj._node_coordinates().items():
+            self.coordinates[identity] = (coordinates[0] * self.scale[0], coordinates[1] * self.scale[1])
+        self.path_layer = None
+
+    def _thickness_scale(self):
+        return (self.scale[0] + self.scale[1]) / 2
+
+    def _point(self, xy):
+        return int(round(xy[0])), int(round(xy[1]))
+
+    def _location(self, item):
+        if type(item) == tuple:
+            src, dest = self.coordinates[item[0]], self.coordinates[item[1]]
+            return self._point((src[0] + item[2] * (dest[0] - src[0]), src[1] + item[2] * (dest[1] - src[1])))
+        return self._point(self.coordinates[item])
+
+    def _draw_item(self, img, item):
+        s = self._thickness_scale()
+        if type(item) == int:
+            cv2.circle(img, self._location(item), max(1, int(round(10 * s))), (150, 0, 0), -1,
+                       cv2.LINE_AA)
+        if type(item) == tuple:
+            cv2.line(img, self._point(self.coordinates[item[0]]), self._location(item), (150, 0, 0),
+                     max(1, int(round(6 * s))), cv2.LINE_AA)
+
+    def _update_path_layer(self, path_traversed):
+        # Graph.on_node and Graph.on_edge only ever change the last item of path_traversed, so every item
+        # but the last is final and is drawn on path_layer once
+        total = path_traversed.total
+        if self.path_layer is None or total - 1 < self.drawn_len:
+            self.path_layer = self.base.copy()
+            # Items no longer in the recent part of the history are drawn from its runs
+            for item, count in path_traversed.runs:
+                self._draw_item(self.path_layer, item)
+                if type(item) == tuple and item[2] == 1:
+                    self._draw_item(self.path_layer, item[1])  # node implied by the edge
+            self.drawn_len = path_traversed.first_recent()
+        for item in path_traversed.items(self.drawn_len, total - 1):
+            self._draw_item(self.path_layer, item)
+        self.drawn_len = max(total - 1, self.drawn_len)
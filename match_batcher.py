@@ -0,0 +1,317 @@
+"""match_batcher.py
+Matches the query frames of many sessions (see localisation_engine) with the frames of the graph together:
+requests arriving within a short window are grouped by edge, and every group is matched in one pass
+"""
+
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+import video_operations_3 as vo
+import graph_arena
+from graph2 import Graph, Edge
+
+
+class EdgeDescriptors:
+    """
+    Descriptors and keypoint positions of all the frames of one edge (or of node_images of a node), stacked so
+    that any of the frames can be matched with a single matrix product. Frames of a graph loaded from an arena
+    (see graph_arena) are already stacked there, so their descriptors are a view of the memory mapped arena
+    rather than a copy
+
+    Attributes
+    __________
+    offsets : np.ndarray
+        rows of frame j are offsets[j]:offsets[j + 1]
+    descriptors : np.ndarray
+        float32 descriptors of all the frames, one after the other
+    norms : np.ndarray
+        squared L2 norm of each descriptor
+    xy : np.ndarray
+        (x, y) of the keypoint of each descriptor
+    no_of_keypoints, widths : np.ndarray
+        no_of_keypoints and shape[1] of each frame
+    """
+
+    def __init__(self, distinct_frames: vo.DistinctFrames):
+        if isinstance(distinct_frames.img_objects, graph_arena.ArenaFrames):
+            self._from_arena(distinct_frames.img_objects)
+            return
+        frames = [distinct_frames.get_object(j).get_elements() for j in range(distinct_frames.no_of_frames())]
+        counts = [0 if descriptors is None else len(descriptors) for n, descriptors, keypoints, shape in frames]
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self.descriptors = np.concatenate([np.asarray(frame[1], dtype=np.float32) for frame, count in
+                                           zip(frames, counts) if count > 0] or [np.zeros((0, 64), np.float32)])
+        self.norms = (self.descriptors.astype(np.float64) ** 2).sum(axis=1)
+        self.xy = np.concatenate([keypoint_xy(frame[2]) for frame, count in zip(frames, counts) if count > 0] or
+                                 [np.zeros((0, 2))])
+        self.no_of_keypoints = np.array([frame[0] for frame in frames], dtype=np.int64)
+        self.widths = np.array([frame[3][1] for frame in frames], dtype=np.int64)
+
+    def _from_arena(self, arena_frames: graph_arena.ArenaFrames):
+        # Descriptors of consecutive frames of the arena are consecutive rows of arena.descriptors
+        frames = np.asarray(arena_frames.arena.frames[arena_frames.start:arena_frames.stop])
+        first = int(frames[0, graph_arena.START]) if len(frames) > 0 else 0
+        self.offsets = np.concatenate(([0], np.cumsum(frames[:, graph_arena.COUNT]))).astype(np.int64)
+        rows = slice(first, first + int(self.offsets[-1]))
+        self.descriptors = arena_frames.arena.descriptors[rows]
+        self.norms = (self.descriptors.astype(np.float64) ** 2).sum(axis=1)
+        self.xy = np.asarray(arena_frames.arena.keypoints[rows, :2], dtype=np.float64)
+        self.no_of_keypoints = frames[:, graph_arena.NO_OF_KEYPOINTS].astype(np.int64)
+        self.widths = frames[:, graph_arena.SHAPE.start + 1].astype(np.int64)
+
+
+def keypoint_xy(serialized_keypoints):
+    return np.array([point[0] for point in serialized_keypoints], dtype=np.float64).reshape(-1, 2)
+
+
+def two_nearest(squared_distances, axis):
+    """Returns (index of nearest, distance to nearest, distance to second nearest) along axis"""
+    nearest = np.argpartition(squared_distances, 1, axis=axis)
+    first = np.take(nearest, [0], axis=axis)
+    second = np.take(nearest, [1], axis=axis)
+    d1 = np.take_along_axis(squared_distances, first, axis=axis)
+    d2 = np.take_along_axis(squared_distances, second, axis=axis)
+    swap = d2 < d1
+    first, d1, d2 = np.where(swap, second, first), np.minimum(d1, d2), np.maximum(d1, d2)
+    return first.squeeze(axis), np.sqrt(d1.squeeze(axis)), np.sqrt(d2.squeeze(axis))
+
+
+def count_good(distances, query_xy, train_xy, train_width, ratio_thresh, max_slope):
+    """
+    Counts matches passing the ratio test and the slope check of matcher.SURF_returns, for one direction
+    :param distances: (nearest index, nearest distance, second distance) of each query keypoint among train
+    :param train_width: width of the query frame, on the right of which the train frame is placed
+    """
+    nearest, d1, d2 = distances
+    good = d1 < ratio_thresh * d2
+    x1, y1 = query_xy[:, 0], query_xy[:, 1]
+    x2, y2 = train_xy[nearest, 0] + train_width, train_xy[nearest, 1]
+    dx = x2 - x1
+    good &= (dx != 0) & (np.abs(y1 - y2) <= max_slope * np.abs(dx))
+    return int(good.sum())
+
+
+def symmetric_match(squared_distances, a1, b1, xy1, xy2, width1, width2, ratio_thresh, max_slope):
+    """
+    Returns (fraction_matched, features_matched) of frames 1 and 2 as matcher.SURF_returns(frame 1, frame 2)
+    gives them (with symmetry_match and check_c1_c2), except that nearest neighbours are exact
+    :param squared_distances: squared L2 distances of the descriptors of frame 2 (rows) to those of frame 1
+    :param a1, b1: no_of_keypoints of frames 1 and 2
+    :param xy1, xy2: (x, y) of the keypoints of frames 1 and 2
+    :param width1, width2: shape[1] of frames 1 and 2
+    """
+    if a1 < 2 or b1 < 2:
+        return -1, None
+    # Frame 1 matched with frame 2 (placed on its right), as knnMatch(descriptors1, descriptors2)
+    c1 = count_good(two_nearest(squared_distances, 0), xy1, xy2, width1, ratio_thresh, max_slope)
+    # and the other way round (symmetry_match)
+    c2 = count_good(two_nearest(squared_distances, 1), xy2, xy1, width2, ratio_thresh, max_slope)
+    if c2 == 0 or not 0.5 <= c1 / c2 <= 2:
+        return 2 * min(c1, c2) / (a1 + b1), min(c1, c2)
+    return (c1 + c2) / (a1 + b1), min(c1, c2)
+
+
+class MatchRequest:
+    def __init__(self, query_params, pairs):
+        self.query_params = query_params
+        self.pairs = pairs  # list of (Edge, frame index)
+        self.results = [None] * len(pairs)
+        self.done = threading.Event()
+        self.submitted_at = time.time()
+
+
+class MatchBatcher:
+    """
+    Gathers match requests (a query frame and the edge frames to match it with) from all sessions for up to
+    batch_window seconds after the first one arrives, or until max_batch requests are waiting, then matches
+    them by edge: the query frames of all requests for an edge are stacked, and their distances to all the
+    edge frames requested computed as one matrix product against the edge's cached EdgeDescriptors. The
+    result of each (query frame, edge frame) pair is the same (fraction_matched, features_matched) as
+    matcher.SURF_returns gives, except that nearest neighbours are exact instead of approximated by FLANN.
+
+    A longer batch_window puts more requests in a batch, at the cost of that much more latency per frame.
+
+    Attributes
+    __________
+    cache : OrderedDict
+        edge name -> EdgeDescriptors of the max_cached_edges edges used last
+    batches, requests_batched, groups, pairs_matched : int
+        counts for metrics()
+    """
+
+    def __init__(self, graph_obj: Graph, batch_window: float = 0.005, max_batch: int = 32,
+                 max_cached_edges: int = 256, ratio_thresh: float = 0.7, max_slope: float = 0.2):
+        self.graph_obj = graph_obj
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.max_cached_edges = max_cached_edges
+        self.ratio_thresh = ratio_thresh
+        self.max_slope = max_slope
+        self.cache = OrderedDict()
+        self.map_version = getattr(graph_obj, "map_version", 0)
+        self.pending = []
+        self.condition = threading.Condition()
+        self.running = True
+        self.batches = 0
+        self.requests_batched = 0
+        self.max_batch_size = 0
+        self.groups = 0
+        self.pairs_matched = 0
+        self.wait_time = 0.0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def match(self, query_params, pairs):
+        """
+        Matches a query frame with edge frames, waiting for the batch it is put in
+        :param query_params: ( no_of_keypoints, descriptors, serialized_keypoints, shape ) of query frame
+        :param pairs: list of (Edge, frame index)
+        :return: list of (fraction_matched, features_matched) of each pair, as matcher.SURF_returns(edge frame,
+        query frame)
+        """
+        if len(pairs) == 0:
+            return []
+        request = MatchRequest(query_params, pairs)
+        with self.condition:
+            if not self.running:
+                raise Exception("MatchBatcher is stopped, frames can't be matched by it any more")
+            self.pending.append(request)
+            self.condition.notify_all()
+        request.done.wait()
+        return request.results
+
+    def stop(self):
+        """Stops matching, requests still waiting get (-1, None) for every pair, as if nothing matched"""
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+
+    def _edge_descriptors(self, edge: Edge):
+        if getattr(self.graph_obj, "map_version", 0) != self.map_version:
+            self.cache = OrderedDict()
+            self.map_version = getattr(self.graph_obj, "map_version", 0)
+        if edge.name in self.cache:
+            self.cache.move_to_end(edge.name)
+        else:
+            self.cache[edge.name] = EdgeDescriptors(edge.distinct_frames)
+            if len(self.cache) > self.max_cached_edges:
+                self.cache.popitem(last=False)
+        return self.cache[edge.name]
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.pending) > 0 or not self.running)
+                if not self.running:
+                    break
+                deadline = self.pending[0].submitted_at + self.batch_window
+                self.condition.wait_for(lambda: len(self.pending) >= self.max_batch or not self.running,
+                                        max(deadline - time.time(), 0))
+                batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            self._match_batch(batch)
+        for request in self.pending:
+            request.results = [(-1, None)] * len(request.pairs)
+            request.done.set()
+        self.pending = []
+
+    def _match_batch(self, batch):
+        started_at = time.time()
+        groups = OrderedDict()  # edge name -> (Edge, list of (request, position in request.pairs))
+        for request in batch:
+            for position, (edge, frame_index) in enumerate(request.pairs):
+                groups.setdefault(edge.name, (edge, []))[1].append((request, position))
+        for edge, items in groups.values():
+            try:
+                self._match_group(edge, items)
+            except Exception as exception:
+                print("Batched matching with edge " + edge.name + " failed: " + repr(exception))
+                for request, position in items:
+                    request.results[position] = (-1, None)
+        self.batches += 1
+        self.requests_batched += len(batch)
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+        self.groups += len(groups)
+        self.wait_time += sum(started_at - request.submitted_at for request in batch)
+        for request in batch:
+            request.done.set()
+
+    def _match_group(self, edge: Edge, items):
+        """
+        Matches the query frames of the requests in items with the frames of edge they asked for. Requests
+        asking for the same frames (e.g. sessions at the same place, or searching the entry frames of the edge)
+        are matched together, so no query frame is matched with frames of the edge outside its own window
+        """
+        index = self._edge_descriptors(edge)
+        windows = OrderedDict()  # frames asked for -> list of (request, position in request.pairs)
+        frames_of = {}  # id of request -> frames of edge it asked for
+        for request, position in items:
+            frames_of.setdefault(id(request), set()).add(request.pairs[position][1])
+        for request, position in items:
+            windows.setdefault(tuple(sorted(frames_of[id(request)])), []).append((request, position))
+        for frames, window_items in windows.items():
+            self._match_window(index, frames, window_items)
+
+    def _match_window(self, index: EdgeDescriptors, frames, items):
+        # Query frames of the requests, stacked
+        requests = list(OrderedDict((id(request), request) for request, position in items).values())
+        query_rows = {}
+        query_descriptors = []
+        start = 0
+        for request in requests:
+            no_of_keypoints, descriptors, serialized_keypoints, shape = request.query_params
+            count = 0 if descriptors is None else len(descriptors)
+            query_rows[id(request)] = (start, start + count)
+            if count > 0:
+                query_descriptors.append(np.asarray(descriptors, dtype=np.float32))
+            start += count
+        # Frames of the edge asked for, stacked (a slice of index.descriptors, not a copy, if they are consecutive)
+        frame_rows = {}
+        rows = []
+        start = 0
+        for j in frames:
+            count = int(index.offsets[j + 1] - index.offsets[j])
+            frame_rows[j] = (start, start + count)
+            rows.append(np.arange(index.offsets[j], index.offsets[j + 1]))
+            start += count
+        if frames[-1] - frames[0] + 1 == len(frames):
+            rows = slice(int(index.offsets[frames[0]]), int(index.offsets[frames[-1] + 1]))
+        else:
+            rows = np.concatenate(rows)
+        if len(query_descriptors) > 0 and start > 0:
+            queries = np.concatenate(query_descriptors)
+            query_norms = (queries.astype(np.float64) ** 2).sum(axis=1)
+            # |q - f| ^ 2 = |q| ^ 2 - 2 q.f + |f| ^ 2, for all query and edge frame descriptors at once
+            squared_distances = query_norms[:, None] - 2 * (queries @ index.descriptors[rows].T) + \
+                index.norms[rows][None, :]
+            np.maximum(squared_distances, 0, out=squared_distances)
+
+        for request, position in items:
+            j = request.pairs[position][1]
+            no_of_keypoints, descriptors, serialized_keypoints, shape = request.query_params
+            a1, b1 = int(index.no_of_keypoints[j]), no_of_keypoints
+            if a1 < 2 or b1 < 2:
+                request.results[position] = (-1, None)
+                continue
+            q_start, q_end = query_rows[id(request)]
+            f_start, f_end = frame_rows[j]
+            request.results[position] = symmetric_match(
+                squared_distances[q_start:q_end, f_start:f_end], a1, b1,
+                index.xy[index.offsets[j]:index.offsets[j + 1]], keypoint_xy(serialized_keypoints),
+                index.widths[j], shape[1], self.ratio_thresh, self.max_slope)
+            self.pairs_matched += 1
+
+    def metrics(self):
+        """Returns dict of batch sizes and time spent waiting for batches"""
+        return {
+            "batch_window_ms": round(self.batch_window * 1000, 1),
+            "batches": self.batches,
+            "mean_batch_size": round(self.requests_batched / self.batches, 2) if self.batches > 0 else None,
+            "max_batch_size": self.max_batch_size,
+            "mean_edges_per_batch": round(self.groups / self.batches, 2) if self.batches > 0 else None,
+            "pairs_matched": self.pairs_matched,
+            "mean_wait_ms": round(1000 * self.wait_time / self.requests_batched, 2) if self.requests_batched > 0
+            else None,
+            "cached_edges": len(self.cache),
+        }
@@ -0,0 +1,246 @@
+"""multi_stream.py
+Localises many cameras (urls of IP cameras, or video files) in one process, headless: each stream has its own
+tracker (RealTimeMatching) on a fork of one graph, and all of them share one pool of threads localising frames
+and one pool matching them (or a MatchBatcher), with frames taken from the streams in turn
+
+    python multi_stream.py graph.pkl http://10.194.36.234:8080/shot.jpg testData/query.mp4 ...
+"""
+
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import feature_wire
+from graph2 import Graph
+from localisation_final import RealTimeMatching
+from localisation_engine import load_graph, tracker_location
+from match_batcher import MatchBatcher
+from query_pipeline import DropOldestQueue
+
+
+class Stream:
+    """
+    One camera and its tracker
+
+    Attributes
+    __________
+    matcher : RealTimeMatching
+        tracker, on a fork of the graph (see Graph.fork) so that it has its own path_traversed
+    latest : DropOldestQueue
+        holds the latest frame read and not yet localised, a frame read before the last one is localised
+        replaces it (and is counted as dropped)
+    busy : bool
+        True while a frame of the stream is being localised, frames of a stream are localised one at a time
+    lag : float
+        moving average of time (in seconds) from a frame being read to it being localised
+    """
+
+    def __init__(self, name: str, source: str, graph_obj: Graph, hessian_threshold: int = 2500, **options):
+        self.name = name
+        self.source = source
+        self.livestream = source.startswith("http")
+        self.matcher = RealTimeMatching(graph_obj.fork(name), **options)
+        self.matcher.display_hook = lambda current_location_str: None  # Nothing is displayed
+        self.detector = cv2.xfeatures2d_SURF.create(hessian_threshold)
+        self.latest = DropOldestQueue(1)
+        self.busy = False
+        self.finished = False  # True once the source has no more frames
+        self.frames_read = 0
+        self.frames_localised = 0
+        self.frames_ignored = 0  # too few keypoints, or same scene as the last one (see extract_features)
+        self.lag = None
+        self.max_lag = 0.0
+        self.started_at = None
+        self.localised_at = []  # times frames were localised, within the last report interval
+
+
+class MultiStreamRunner:
+    """
+    Reads every stream on a thread of its own and localises the latest frame of each. Streams with a frame
+    waiting are served in turn (round robin), with at most one frame per stream and workers frames in all
+    being localised at once, so a slow or busy camera can't starve the others: it only drops more frames.
+
+    Frames are matched with the graph by match_workers threads shared by all the trackers, on a pool of
+    their own (the localising threads wait on them), or if batch_window (seconds) is given, by a
+    MatchBatcher which matches the frames of all the streams being localised at the same time together.
+
+    Attributes
+    __________
+    streams : list
+        Stream objects, in the order of sources
+    condition : threading.Condition
+        guards the busy flags and the no of frames in flight, notified when a frame is read or localised
+    """
+
+    def __init__(self, graph_obj: Graph, sources, workers: int = 4, match_workers: int = 4,
+                 batch_window: float = None, frames_skipped: int = 0, mjpeg: bool = False,
+                 report_interval: float = 5, smoothing: float = 0.1, **options):
+        self.graph_obj = graph_obj
+        self.workers = workers
+        self.frames_skipped = frames_skipped
+        self.mjpeg = mjpeg
+        self.report_interval = report_interval
+        self.smoothing = smoothing
+        self.match_batcher = MatchBatcher(graph_obj, batch_window, workers) if batch_window is not None else None
+        self.match_executor = None
+        if self.match_batcher is None and match_workers > 1:
+            self.match_executor = ThreadPoolExecutor(max_workers=match_workers)
+        hessian_threshold = feature_wire.graph_detector_params(graph_obj)["hessian_threshold"]
+        self.streams = []
+        for k, source in enumerate(sources):
+            stream = Stream("stream" + str(k), source, graph_obj, hessian_threshold,
+                            match_batcher=self.match_batcher, **options)
+            if self.match_executor is not None:
+                stream.matcher.workers = match_workers
+                stream.matcher.executor = self.match_executor
+            self.streams.append(stream)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.next_stream = 0  # stream to be looked at first for a frame, so that all get their turn
+        self.stopped = threading.Event()
+        self.readers = []
+
+    def _read(self, stream: Stream):
+        cap = stream.matcher.open_source(stream.source, stream.livestream, self.mjpeg)
+        fps = 0 if stream.livestream else cap.get(cv2.CAP_PROP_FPS)
+        stream.started_at = time.time()
+        try:
+            for i, gray, read_at in stream.matcher.read_frames(cap, stream.livestream, self.frames_skipped):
+                if self.stopped.is_set():
+                    break
+                if gray is None:
+                    continue
+                if fps > 0:
+                    # Video files are played at their frame rate, as a camera would give them
+                    delay = stream.started_at + i / fps - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                        read_at = time.time()
+                stream.frames_read += 1
+                stream.latest.put((i, gray, read_at))
+                with self.condition:
+                    self.condition.notify_all()
+        finally:
+            cap.release()
+            with self.condition:
+                stream.finished = True
+                self.condition.notify_all()
+
+    def _next_frame(self):
+        """Returns (Stream, frame) of the next stream in turn with a frame waiting and none in flight, or None"""
+        for k in range(len(self.streams)):
+            stream = self.streams[(self.next_stream + k) % len(self.streams)]
+            if stream.busy:
+                continue
+            item = stream.latest.get(timeout=0)
+            if item is not None:
+                self.next_stream = (self.next_stream + k + 1) % len(self.streams)
+                return stream, item
+        return None
+
+    def _localise(self, stream: Stream, item):
+        i, gray, read_at = item
+        try:
+            img_obj = stream.matcher.extract_features(i, gray, stream.detector)
+            if img_obj is None:
+                stream.frames_ignored += 1
+            else:
+                stream.matcher.process_frame(img_obj, gray, read_at)
+                lag = time.time() - read_at
+                stream.lag = lag if stream.lag is None else stream.lag + self.smoothing * (lag - stream.lag)
+                stream.max_lag = max(stream.max_lag, lag)
+                stream.frames_localised += 1
+                stream.localised_at.append(time.time())
+        except Exception as exception:
+            print(stream.name + ": frame " + str(i) + " failed: " + repr(exception))
+        finally:
+            with self.condition:
+                stream.busy = False
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def _done(self):
+        return all(stream.finished and len(stream.latest.items) == 0 and not stream.busy
+                   for stream in self.streams)
+
+    def run(self):
+        """Localises all the streams until they end or stop() is called, reporting every report_interval seconds"""
+        for stream in self.streams:
+            reader = threading.Thread(target=self._read, args=(stream,), daemon=True)
+            reader.start()
+            self.readers.append(reader)
+        reported_at = time.time()
+        try:
+            with self.condition:
+                while not self.stopped.is_set() and not self._done():
+                    if self.in_flight < self.workers:
+                        next_frame = self._next_frame()
+                        if next_frame is not None:
+                            stream, item = next_frame
+                            stream.busy = True
+                            self.in_flight += 1
+                            self.executor.submit(self._localise, stream, item)
+                            continue
+                    self.condition.wait(timeout=0.1)
+                    if time.time() - reported_at >= self.report_interval:
+                        self.report()
+                        reported_at = time.time()
+        finally:
+            self.stop()
+        self.report()
+
+    def stop(self):
+        self.stopped.set()
+        for stream in self.streams:
+            stream.latest.close()
+        self.executor.shutdown(wait=True)
+        if self.match_executor is not None:
+            self.match_executor.shutdown(wait=True)
+        if self.match_batcher is not None and self.match_batcher.running:
+            self.match_batcher.stop()
+
+    def metrics(self):
+        """
+        Returns dict of stream name -> fps (frames localised per second over the last report interval), lag
+        (moving average and max, in seconds), no of frames read, localised, ignored and dropped, and location
+        (see localisation_engine.tracker_location)
+        """
+        now = time.time()
+        metrics = {}
+        for stream in self.streams:
+            stream.localised_at = [t for t in stream.localised_at if now - t <= self.report_interval]
+            window = min(self.report_interval, now - stream.started_at) if stream.started_at is not None else 0
+            metrics[stream.name] = {
+                "source": stream.source,
+                "fps": round(len(stream.localised_at) / window, 2) if window > 0 else 0.0,
+                "lag": round(stream.lag, 3) if stream.lag is not None else None,
+                "max_lag": round(stream.max_lag, 3),
+                "frames_read": stream.frames_read,
+                "frames_localised": stream.frames_localised,
+                "frames_ignored": stream.frames_ignored,
+                "frames_dropped": stream.latest.dropped,
+                "location": tracker_location(stream.matcher),
+            }
+        return metrics
+
+    def report(self):
+        for name, metrics in self.metrics().items():
+            location = metrics["location"]
+            where = location["edge"] + " " + str(round(location["fraction"], 2)) if location["edge"] is not None \
+                else str(location["node"])
+            print(name + ": " + str(metrics["fps"]) + " fps, lag " + str(metrics["lag"]) + " s (max " +
+                  str(metrics["max_lag"]) + "), " + str(metrics["frames_localised"]) + " localised, " +
+                  str(metrics["frames_dropped"]) + " dropped, at " + where)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Usage: python multi_stream.py graph.pkl url_or_video [url_or_video ...]")
+        sys.exit(1)
+    runner = MultiStreamRunner(load_graph(sys.argv[1]), sys.argv[2:])
+    try:
+        runner.run()
+    except KeyboardInterrupt:
+        runner.stop()
@@ -0,0 +1,225 @@
+"""offline_localisation.py
+Localisation of recorded query videos, e.g. walkthroughs for analytics. Since decisions need not be made
+frame by frame as they come, the globally most likely path is decoded with Viterbi over (edge, frame index)
+states, and a compact trajectory file with one line per query frame is written.
+"""
+
+import os
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import matcher as mt
+import video_operations_3 as vo
+from graph2 import Graph
+from hmm_tracker import EdgeStateSpace
+
+
+def read_query_frames(video_path, frames_skipped: int = 0, hessian_threshold: int = 2500, min_keypoints: int = 50):
+    """
+    Reads a query video and yields ImgObj of its non blurry frames with enough keypoints, as in
+    RealTimeMatching.save_query_objects but without any display
+    :param video_path: path of the video
+    :param frames_skipped: int, No of frames to be skipped after every frame read
+    :return: generator of ImgObj, with time_stamp being the index of the frame in the video
+    """
+    frames_skipped += 1
+    detector = cv2.xfeatures2d_SURF.create(hessian_threshold)
+    cap = cv2.VideoCapture(video_path)
+    i = 0
+    while True:
+        if i % frames_skipped != 0:
+            # grab() skips decoding of frames which are not needed
+            if not cap.grab():
+                break
+            i = i + 1
+            continue
+        ret, frame = cap.read()
+        if not ret:
+            break
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if not vo.is_blurry_grayscale(gray):
+            keypoints, descriptors = detector.detectAndCompute(gray, None)
+            if len(keypoints) >= min_keypoints:
+                yield vo.ImgObj(len(keypoints), descriptors, i, vo.serialize_keypoints(keypoints), gray.shape)
+        i = i + 1
+    cap.release()
+
+
+class ViterbiLocaliser:
+    """
+    Decodes the most likely sequence of (edge, frame index) states for a sequence of query frames.
+    Transitions are those of hmm_tracker.EdgeStateSpace, and the log likelihood of a query frame at a state
+    is sharpness * fraction_matched with the frame of the state.
+
+    Only the beam_width most likely states are kept after every query frame, so frames of at most
+    (no of steps) * beam_width states (plus successors at edge ends) are matched with each query frame.
+    Matching is done in parallel on a thread pool. If no state matches for max_misses query frames in a
+    row, the first frames of all edges are matched too, reached from the best state with a restart penalty.
+
+    Attributes
+    __________
+    space : EdgeStateSpace (object)
+    history : list
+        (states, back_pointers) of every query frame, back pointers are indexes into states of previous frame
+    time_stamps : list
+        time_stamp of every query frame
+    """
+
+    def __init__(self, graph_obj: Graph, z: int = 0, beam_width: int = 32, step_probs=(0.3, 0.5, 0.2),
+                 sharpness: float = 20, match_threshold: float = 0.09, max_misses: int = 5,
+                 entry_frames: int = 2, restart_penalty: float = 10, workers: int = 4):
+        self.space = EdgeStateSpace(graph_obj, z)
+        self.beam_width = beam_width
+        self.step_probs = step_probs
+        self.sharpness = sharpness
+        self.match_threshold = match_threshold
+        self.max_misses = max_misses
+        self.entry_frames = entry_frames
+        self.restart_penalty = restart_penalty
+        self.workers = workers
+        self.history = []
+        self.time_stamps = []
+        self.states = None
+        self.log_delta = None
+        self.misses = 0
+
+    def score(self, executor, img_obj, states):
+        """Returns fraction_matched of img_obj with frame of each of states"""
+        query_params = img_obj.get_elements()
+
+        def fraction(state):
+            fraction_matched, features_matched = mt.SURF_returns(self.space.get_frame_params(state), query_params)
+            return fraction_matched
+
+        return np.array(list(executor.map(fraction, states.tolist())), dtype=np.float64)
+
+    def add_frame(self, executor, img_obj):
+        """Runs one Viterbi step for query frame img_obj"""
+        if self.states is None:
+            states = self.space.entry_states(self.entry_frames)
+            back_pointers = np.full(len(states), -1, dtype=np.int64)
+            log_prior = np.zeros(len(states))
+        else:
+            parents, next_states, probs = self.space.transitions(self.states, self.step_probs)
+            scores = self.log_delta[parents] + np.log(probs)
+            if self.misses >= self.max_misses:
+                entry = self.space.entry_states(self.entry_frames)
+                best = int(np.argmax(self.log_delta))
+                parents = np.concatenate((parents, np.full(len(entry), best)))
+                next_states = np.concatenate((next_states, entry))
+                scores = np.concatenate((scores, np.full(len(entry), self.log_delta[best] - self.restart_penalty)))
+            # Best parent of every next state: sort by state, then by decreasing score, and take the first
+            order = np.lexsort((-scores, next_states))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = next_states[order][1:] != next_states[order][:-1]
+            states = next_states[order][first]
+            back_pointers = parents[order][first]
+            log_prior = scores[order][first]
+
+        fractions = self.score(executor, img_obj, states)
+        if len(fractions) == 0 or fractions.max() <= self.match_threshold:
+            self.misses += 1
+        else:
+            self.misses = 0
+        log_delta = log_prior + self.sharpness * np.clip(fractions, 0, 1)
+
+        if len(states) > self.beam_width:
+            keep = np.argpartition(-log_delta, self.beam_width)[:self.beam_width]
+            states, back_pointers, log_delta = states[keep], back_pointers[keep], log_delta[keep]
+        self.states, self.log_delta = states, log_delta - log_delta.max()
+        self.history.append((states, back_pointers))
+        self.time_stamps.append(img_obj.get_time())
+
+    def run(self, img_objects, queue_size: int = 16):
+        """
+        Runs Viterbi over img_objects (any iterable, e.g. read_query_frames()), which are read on a separate
+        thread so that feature extraction of the next frames overlaps with matching
+        :return: None
+        :raises: the exception reading img_objects raised, if any, once the frames read before it are decoded
+        """
+        frames = queue.Queue(maxsize=queue_size)
+        errors = []
+
+        def produce():
+            try:
+                for img_obj in img_objects:
+                    frames.put(img_obj)
+            except Exception as exception:
+                errors.append(exception)
+            finally:
+                frames.put(None)  # Marks end of input, also if reading failed so that the loop below ends
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                img_obj = frames.get()
+                if img_obj is None:
+                    break
+                self.add_frame(executor, img_obj)
+                if len(self.time_stamps) % 100 == 0:
+                    print("Decoded " + str(len(self.time_stamps)) + " query frames")
+        producer.join()
+        if len(errors) > 0:
+            raise errors[0]
+
+    def decode(self):
+        """
+        Backtracks the most likely path
+        :return: list of (time_stamp, Edge, frame_index) for every query frame
+        """
+        if len(self.history) == 0:
+            return []
+        path = []
+        k = int(np.argmax(self.log_delta))
+        for t in range(len(self.history) - 1, -1, -1):
+            states, back_pointers = self.history[t]
+            state = states[k]
+            path.append((self.time_stamps[t], self.space.get_edge(state), self.space.get_frame_index(state)))
+            k = back_pointers[k]
+        path.reverse()
+        return path
+
+    def write_trajectory(self, file_path):
+        """
+        Writes decoded path as lines of "time_stamp,edge_name,frame_index,fraction" where fraction is the
+        fraction of the edge traversed
+        :return: None
+        """
+        folder = os.path.dirname(file_path)
+        if folder != "":
+            os.makedirs(folder, exist_ok=True)
+        with open(file_path, "w") as trajectory:
+            trajectory.write("time_stamp,edge,frame_index,fraction\n")
+            for time_stamp, edge, frame_index in self.decode():
+                total_time = edge.distinct_frames.get_time()
+                fraction = edge.distinct_frames.get_object(frame_index).get_time() / total_time \
+                    if total_time != 0 else 0
+                trajectory.write(str(time_stamp) + "," + edge.name + "," + str(frame_index) + "," +
+                                 str(round(fraction, 4)) + "\n")
+
+
+def localise_video(graph_obj: Graph, video_path, trajectory_path, frames_skipped: int = 4, workers: int = 4,
+                   beam_width: int = 32):
+    """
+    Localises a recorded query video and writes its trajectory file
+    :param graph_obj: Graph object
+    :param video_path: path of the query video
+    :param trajectory_path: path of the trajectory file to be written
+    :param frames_skipped: No of frames skipped after every frame localised
+    :param workers: no of threads matching frames
+    :param beam_width: no of states kept after every query frame
+    :return: list of (time_stamp, Edge, frame_index) for every query frame localised
+    """
+    localiser = ViterbiLocaliser(graph_obj, beam_width=beam_width, workers=workers)
+    localiser.run(read_query_frames(video_path, frames_skipped))
+    localiser.write_trajectory(trajectory_path)
+    return localiser.decode()
+
+
+if __name__ == '__main__':
+    graph: Graph = Graph.load_graph("new_objects/graph.pkl")
+    localise_video(graph, "testData/night sit 0 june 18/query video/VID_20190618_202826.webm",
+                   "trajectories/VID_20190618_202826.csv")
@@ -0,0 +1,114 @@
+"""path_history.py
+Bounded history of the path traversed, used as Graph.path_traversed
+"""
+
+import os
+from collections import deque
+
+
+class PathHistory:
+    """
+    Path traversed, as items of the form node identity (int) or (src, dest, fraction_traversed) (tuple)
+
+    The latest ring_size items are kept as they are. Older items are folded into run length compressed
+    runs of (item, count), where a node reached at the end of a fully traversed edge is implied by the edge
+    and repeated items are counted. Once there are max_runs runs the oldest are appended to the log file at
+    log_path (if any), so the memory used stays the same however long the path gets.
+
+    Only the last item can be changed, which is all Graph.on_node and Graph.on_edge need.
+
+    Attributes
+    __________
+    recent : deque
+        latest items
+    runs : deque
+        (item, count) runs of items older than those in recent
+    total : int
+        no of items ever appended, so item k (0 based) of the whole path is in recent if
+        k >= total - len(recent)
+    log_path : str
+        path of the file to which runs are spilled, None means they are discarded
+    """
+
+    def __init__(self, ring_size: int = 256, max_runs: int = 256, log_path: str = None):
+        if ring_size < 2 or max_runs < 1:
+            raise Exception("ring_size should be at least 2 and max_runs at least 1")
+        self.recent = deque(maxlen=ring_size)
+        self.runs = deque(maxlen=max_runs)
+        self.total = 0
+        self.log_path = log_path
+
+    def __len__(self):
+        return len(self.recent)
+
+    def __iter__(self):
+        return iter(self.recent)
+
+    def __getitem__(self, index):
+        if not -len(self.recent) <= index < 0:
+            raise IndexError("Only the latest " + str(len(self.recent)) + " items can be accessed, with index < 0")
+        return self.recent[index]
+
+    def __setitem__(self, index, item):
+        if index != -1 or len(self.recent) == 0:
+            raise IndexError("Only the last item can be changed")
+        self.recent[-1] = item
+
+    def append(self, item):
+        if len(self.recent) == self.recent.maxlen:
+            self._fold(self.recent[0])
+        self.recent.append(item)
+        self.total += 1
+
+    def first_recent(self):
+        """Returns index (in the whole path) of the oldest item still in recent"""
+        return self.total - len(self.recent)
+
+    def items(self, start: int, stop: int = None):
+        """
+        Returns list of items of the whole path with index in [start, stop), restricted to those still in recent
+        """
+        first = self.first_recent()
+        stop = self.total if stop is None else min(stop, self.total)
+        start = max(start, first)
+        return [self.recent[k - first] for k in range(start, stop)]
+
+    def copy(self):
+        """Returns a copy which doesn't change with this one, e.g. to be drawn on another thread (not spilled)"""
+        history = PathHistory.__new__(PathHistory)
+        history.recent = deque(self.recent, maxlen=self.recent.maxlen)
+        history.runs = deque(self.runs, maxlen=self.runs.maxlen)
+        history.total = self.total
+        history.log_path = None
+        return history
+
+    def spill(self):
+        """Appends all the runs to the log file and clears them, e.g. at the end of a session"""
+        while len(self.runs) > 0:
+            self._spill(self.runs.popleft())
+
+    def _fold(self, item):
+        if len(self.runs) > 0:
+            prev, count = self.runs[-1]
+            if prev == item:
+                self.runs[-1] = (prev, count + 1)
+                return
+            if type(item) == int and type(prev) == tuple and prev[1] == item and prev[2] == 1:
+                return
+        if len(self.runs) == self.runs.maxlen:
+            self._spill(self.runs.popleft())
+        self.runs.append((item, 1))
+
+    def _spill(self, run):
+        if self.log_path is None:
+            return
+        folder = os.path.dirname(self.log_path)
+        if folder != "":
+            os.makedirs(folder, exist_ok=True)
+        item, count = run
+        if type(item) == tuple:
+            line = str(item[0]) + "_" + str(item[1]) + " " + str(item[2]) + " " + str(count)
+        else:
+            line = str(item) + " " + str(count)
+        with open(self.log_path, "a") as log:
+            log.write(line + "\n")
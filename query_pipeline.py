@@ -0,0 +1,210 @@
+"""query_pipeline.py
+Runs the real time localisation of RealTimeMatching as a pipeline of stages on separate threads, so that
+capture, feature extraction, localisation and display (and saving to disk) of consecutive frames overlap
+"""
+
+import threading
+import time
+from collections import deque
+import cv2
+import image_in_one_frame as one_frame
+
+
+class DropOldestQueue:
+    """
+    Bounded queue between two stages. When it is full, putting an item drops the oldest one, so a slow
+    consumer always gets the latest items instead of making the producer wait
+
+    Attributes
+    __________
+    dropped : int
+        no of items dropped
+    """
+
+    def __init__(self, maxsize: int = 2):
+        self.items = deque()
+        self.maxsize = maxsize
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        with self.condition:
+            if len(self.items) >= self.maxsize:
+                self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.condition.notify()
+
+    def get(self, timeout: float = None):
+        """
+        Returns the oldest item, waiting for one if empty
+        :return: item, or None if the queue is closed and empty or nothing arrived within timeout
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.items) > 0 or self.closed, timeout)
+            if len(self.items) == 0:
+                return None
+            return self.items.popleft()
+
+    def close(self):
+        """Wakes up the consumer, which gets None once the items left are consumed"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class QueryPipeline:
+    """
+    Stages, each taking items from the queue before it:
+    1. capture (thread): reads frames with RealTimeMatching.read_frames
+    2. extract (thread): SURF features with RealTimeMatching.extract_features
+    3. localise (thread): RealTimeMatching.process_frame, with the path to be displayed copied instead of
+       being drawn (through RealTimeMatching.display_hook)
+    4. render (calling thread, as OpenCV windows need it): draws query frame and path, saves query frames
+       to disk if asked to
+
+    Queues hold at most queue_size items and drop the oldest when full, so localisation never waits for
+    display or disk, and a slow stage works on the latest frames rather than falling behind.
+
+    Attributes
+    __________
+    latency : float
+        moving average of time (in seconds) from a frame being read to its location being displayed
+    max_latency : float
+        largest such time
+    localise_latency : float
+        moving average of time from a frame being read to it being localised
+    """
+
+    def __init__(self, matcher, queue_size: int = 2, smoothing: float = 0.1):
+        self.matcher = matcher  # RealTimeMatching object
+        self.extract_queue = DropOldestQueue(queue_size)
+        self.localise_queue = DropOldestQueue(queue_size)
+        self.render_queue = DropOldestQueue(queue_size)
+        self.smoothing = smoothing
+        self.stopped = threading.Event()
+        self.view = None  # current_location_str handed over by display_hook since the last frame localised
+        self.latency = None
+        self.max_latency = 0.0
+        self.localise_latency = None
+        self.frames_displayed = 0
+
+    def _average(self, average, value):
+        return value if average is None else average + self.smoothing * (value - average)
+
+    def _capture(self, cap, livestream, frames_skipped):
+        try:
+            for i, gray, read_at in self.matcher.read_frames(cap, livestream, frames_skipped):
+                if self.stopped.is_set():
+                    break
+                if gray is not None:
+                    self.extract_queue.put((i, gray, read_at))
+        finally:
+            cap.release()
+            self.extract_queue.close()
+
+    def _extract(self, detector):
+        try:
+            while not self.stopped.is_set():
+                item = self.extract_queue.get()
+                if item is None:
+                    break
+                i, gray, read_at = item
+                img_obj = self.matcher.extract_features(i, gray, detector)
+                if img_obj is None:
+                    self.render_queue.put((gray, None, None, None, read_at))  # only the query frame changes
+                else:
+                    self.localise_queue.put((img_obj, gray, read_at))
+        finally:
+            self.localise_queue.close()
+
+    def _on_display(self, current_location_str):
+        self.view = current_location_str
+
+    def _localise(self):
+        try:
+            while not self.stopped.is_set():
+                item = self.localise_queue.get()
+                if item is None:
+                    break
+                img_obj, gray, read_at = item
+                self.view = None
+                self.matcher.process_frame(img_obj, gray, read_at)
+                self.localise_latency = self._average(self.localise_latency, time.time() - read_at)
+                path = self.matcher.graph_obj.path_traversed.copy() if self.view is not None else None
+                self.render_queue.put((gray, img_obj, self.view, path, read_at))
+        finally:
+            self.render_queue.close()
+
+    def _render(self, folder):
+        graph_obj = self.matcher.graph_obj
+        while True:
+            item = self.render_queue.get(timeout=0.05)
+            if item is None:
+                if self.render_queue.closed:
+                    break
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+                continue
+            gray, img_obj, view, path, read_at = item
+            if folder is not None and img_obj is not None:
+                self.matcher.write_query_frame(img_obj, gray, folder)
+            break_video = one_frame.run_query_frame(gray)
+            if path is not None:
+                one_frame.run_graph_frame(graph_obj._renderer(0).render(graph_obj, path, view))
+                now = time.time()
+                self.latency = self._average(self.latency, now - read_at)
+                self.max_latency = max(self.max_latency, now - read_at)
+                self.frames_displayed += 1
+            if break_video:
+                break
+
+    def run(self, video_path, livestream=False, frames_skipped=0, mjpeg=False, reduction=1,
+            folder="query_distinct_frame", write_to_disk=False):
+        """
+        Localises query video until it ends or q is pressed, see RealTimeMatching.save_query_objects for params
+        :return: None
+        """
+        hessian_threshold = 2500
+        if self.matcher.load_controller is not None:
+            hessian_threshold = self.matcher.load_controller.hessian_threshold
+            self.matcher.window = self.matcher.load_controller.window
+        if write_to_disk:
+            self.matcher.prepare_folder(folder)
+        detector = cv2.xfeatures2d_SURF.create(hessian_threshold)
+        cap = self.matcher.open_source(video_path, livestream, mjpeg, reduction)
+
+        self.matcher.display_hook = self._on_display
+        threads = [threading.Thread(target=self._capture, args=(cap, livestream, frames_skipped), daemon=True),
+                   threading.Thread(target=self._extract, args=(detector,), daemon=True),
+                   threading.Thread(target=self._localise, daemon=True)]
+        for thread in threads:
+            thread.start()
+        try:
+            self._render(folder if write_to_disk else None)
+        finally:
+            self.stopped.set()
+            for queue in (self.extract_queue, self.localise_queue, self.render_queue):
+                queue.close()
+            for thread in threads:
+                thread.join()
+            self.matcher.display_hook = None
+            self.matcher.query_objects.close()
+            self.matcher.close()
+            cv2.destroyAllWindows()
+            print(self.metrics())
+
+    def metrics(self):
+        """Returns dict of latencies (in ms) and no of frames dropped by each queue"""
+        def ms(seconds):
+            return None if seconds is None else round(seconds * 1000, 1)
+        return {
+            "latency_ms": ms(self.latency),
+            "max_latency_ms": ms(self.max_latency),
+            "localise_latency_ms": ms(self.localise_latency),
+            "frames_displayed": self.frames_displayed,
+            "dropped_before_extract": self.extract_queue.dropped,
+            "dropped_before_localise": self.localise_queue.dropped,
+            "dropped_before_render": self.render_queue.dropped,
+        }
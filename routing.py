@@ -0,0 +1,265 @@
+"""routing.py
+Shortest routes and ETAs over the graph, from the current location to any node
+
+Routes are searched over edges rather than nodes, so that turning from one edge to the next can be
+penalised using the angle between them (Edge.angles)
+"""
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import shortest_path, dijkstra
+from graph2 import Graph
+
+NO_PREDECESSOR = -9999  # as returned by scipy.sparse.csgraph
+
+
+class RoutingTable:
+    """
+    Cost of going from the end of edge a to the end of edge b is the length of every edge traversed after a,
+    plus turn_penalty * |angle| / 180 for every turn taken (so a U-turn costs turn_penalty).
+
+    For graphs with up to max_dense_edges edges the costs between all pairs of edges are precomputed, and
+    edges added to the graph later are inserted into the tables in O(no of edges ^ 2). For larger graphs
+    the costs from an edge are computed the first time that edge is queried and cached.
+    In both cases the tables are rebuilt when edges are deleted.
+
+    Attributes
+    __________
+    graph_obj : Graph (object)
+    turn_penalty : float
+        cost (in map units) of a U-turn
+    walking_speed : float
+        map units per second, used for ETA
+    names : list
+        edge name of each row
+    dist : np.ndarray
+        dist[a, b] is the cost from end of edge a to end of edge b (dense mode)
+    pred : np.ndarray
+        pred[a, b] is the edge before b on the route from a to b (dense mode)
+    node_dist : np.ndarray
+        node_dist[a, k] is the cost from end of edge a to node node_ids[k] (dense mode)
+    node_via : np.ndarray
+        node_via[a, k] is the last edge on that route (dense mode)
+    """
+
+    def __init__(self, graph_obj: Graph, turn_penalty: float = 50, walking_speed: float = 40,
+                 max_dense_edges: int = 2000):
+        self.graph_obj = graph_obj
+        self.turn_penalty = turn_penalty
+        self.walking_speed = walking_speed
+        self.max_dense_edges = max_dense_edges
+        self.map_version = None
+        self.rebuild()
+
+    # Building the tables
+
+    def rebuild(self):
+        """Recomputes all the tables from the graph"""
+        self.names, self.rows, self.edges, self.floors = [], {}, [], []
+        self.src_ids, self.dest_ids, self.lengths = [], [], []
+        self.turns = {}  # edge name -> {next_edge_name: angle}
+        for edge, z in self._graph_edges():
+            self._add_row(edge, z)
+        self._set_node_columns()
+
+        self.dense = len(self.names) <= self.max_dense_edges
+        self.row_cache = {}  # row -> (dist, pred, node_dist, node_via), in sparse mode
+        self.weights = self._weights()
+        if self.dense:
+            self.dist, self.pred = shortest_path(self.weights, method="D", directed=True,
+                                                 return_predecessors=True)
+            self._set_node_tables()
+        self.map_version = getattr(self.graph_obj, "map_version", 0)
+
+    def sync(self):
+        """Brings the tables up to date with the graph, if it has changed since they were built"""
+        if getattr(self.graph_obj, "map_version", 0) == self.map_version:
+            return
+        edges = self._graph_edges()
+        current = set(edge.name for edge, z in edges)
+        if not self.dense or any(name not in current for name in self.names):
+            self.rebuild()
+            return
+        for edge, z in edges:
+            if edge.name not in self.rows:
+                self._insert_edge(edge, z)
+        self.map_version = getattr(self.graph_obj, "map_version", 0)
+
+    def _graph_edges(self):
+        edges = []
+        for z, floor_nodes in enumerate(self.graph_obj.Nodes):
+            for nd in floor_nodes:
+                for edge in nd.links:
+                    edges.append((edge, z))
+        return edges
+
+    def _add_row(self, edge, z):
+        self.rows[edge.name] = len(self.names)
+        self.names.append(edge.name)
+        self.edges.append(edge)
+        self.floors.append(z)
+        self.src_ids.append(edge.src)
+        self.dest_ids.append(edge.dest)
+        self.lengths.append(self.graph_obj._edge_geometry(z).length(edge.name))
+        self._set_turns(len(self.names) - 1)
+
+    def _set_turns(self, row):
+        self.turns[self.names[row]] = dict(self.graph_obj.get_edge_angles(self.edges[row], self.floors[row]))
+
+    def _set_node_columns(self):
+        self.node_ids = sorted(set(self.src_ids) | set(self.dest_ids))
+        self.node_columns = {identity: k for k, identity in enumerate(self.node_ids)}
+        self.out_rows = {identity: [] for identity in self.node_ids}  # node identity -> rows of edges leaving it
+        for row, src in enumerate(self.src_ids):
+            self.out_rows[src].append(row)
+
+    def _turn_cost(self, angle):
+        return self.turn_penalty * abs(angle) / 180
+
+    def _transition(self, row1, row2):
+        # Cost of going from end of edge row1 to end of edge row2, which starts at the end of row1
+        angle = self.turns[self.names[row1]].get(self.names[row2], 180)
+        # Explicit zeros are treated as missing connections by scipy
+        return max(self.lengths[row2] + self._turn_cost(angle), 1e-9)
+
+    def _weights(self):
+        rows, cols, weights = [], [], []
+        for row1 in range(len(self.names)):
+            for row2 in self.out_rows.get(self.dest_ids[row1], []):
+                rows.append(row1)
+                cols.append(row2)
+                weights.append(self._transition(row1, row2))
+        n = len(self.names)
+        return csr_matrix((weights, (rows, cols)), shape=(n, n))
+
+    def _node_table(self, dist):
+        # Cost to every node is the least cost to any edge ending at it
+        dist = np.atleast_2d(dist)
+        node_dist = np.full((dist.shape[0], len(self.node_ids)), np.inf)
+        node_via = np.full((dist.shape[0], len(self.node_ids)), NO_PREDECESSOR, dtype=np.int64)
+        columns = np.array([self.node_columns[dest] for dest in self.dest_ids], dtype=np.int64)
+        for row in range(len(self.names)):
+            k = columns[row]
+            better = dist[:, row] < node_dist[:, k]
+            node_dist[better, k] = dist[better, row]
+            node_via[better, k] = row
+        return node_dist, node_via
+
+    def _set_node_tables(self):
+        self.node_dist, self.node_via = self._node_table(self.dist)
+
+    def _insert_edge(self, edge, z):
+        # Dense tables: any route improved by the new edge s goes through s once, so
+        # dist[i, j] = min(dist[i, j], dist[i, s] + dist[s, j])
+        n = len(self.names)
+        self._add_row(edge, z)
+        s = n
+        in_rows = [row for row in range(n) if self.dest_ids[row] == edge.src]
+        out_rows = [row for row in range(n) if self.src_ids[row] == edge.dest]
+        for p in in_rows:
+            self._set_turns(p)  # edges leading into the new edge have a new turn
+
+        to_s = np.full(n, np.inf)
+        to_s_pred = np.full(n, NO_PREDECESSOR, dtype=np.int64)
+        for p in in_rows:
+            cost = self.dist[:, p] + self._transition(p, s)
+            better = cost < to_s
+            to_s[better] = cost[better]
+            to_s_pred[better] = p
+        from_s = np.full(n, np.inf)
+        from_s_pred = np.full(n, NO_PREDECESSOR, dtype=np.int64)
+        for q in out_rows:
+            cost = self._transition(s, q) + self.dist[q, :]
+            better = cost < from_s
+            from_s[better] = cost[better]
+            from_s_pred[better] = np.where(np.arange(n) == q, s, self.pred[q, :])[better]
+
+        through_s = to_s[:, None] + from_s[None, :]
+        better = through_s < self.dist
+        dist = np.full((n + 1, n + 1), np.inf)
+        pred = np.full((n + 1, n + 1), NO_PREDECESSOR, dtype=np.int64)
+        dist[:n, :n] = np.where(better, through_s, self.dist)
+        pred[:n, :n] = np.where(better, from_s_pred[None, :], self.pred)
+        dist[:n, s], pred[:n, s] = to_s, to_s_pred
+        dist[s, :n], pred[s, :n] = from_s, from_s_pred
+        dist[s, s] = 0
+        self.dist, self.pred = dist, pred
+        self.weights = self._weights()
+        self._set_node_columns()
+        self._set_node_tables()
+
+    def _row_tables(self, row):
+        if self.dense:
+            return self.dist[row], self.pred[row], self.node_dist[row], self.node_via[row]
+        if row not in self.row_cache:
+            dist, pred = dijkstra(self.weights, directed=True, indices=row, return_predecessors=True)
+            node_dist, node_via = self._node_table(dist)
+            self.row_cache[row] = (dist, pred, node_dist[0], node_via[0])
+        return self.row_cache[row]
+
+    # Queries
+
+    def route_from_edge(self, edge_name: str, fraction_traversed: float, target: int):
+        """
+        Returns best route from a point on an edge to a node
+        :param edge_name: name of the edge, of the form src_dest
+        :param fraction_traversed: fraction of the edge already traversed
+        :param target: identity of the destination node
+        :return: (cost, list of names of edges to be traversed starting with edge_name),
+        or (inf, []) if target can't be reached
+        """
+        self.sync()
+        row = self.rows[edge_name]
+        dist, pred, node_dist, node_via = self._row_tables(row)
+        remaining = (1 - fraction_traversed) * self.lengths[row]
+        if target == self.dest_ids[row]:
+            return remaining, [edge_name]
+        if target not in self.node_columns or node_via[self.node_columns[target]] == NO_PREDECESSOR:
+            return np.inf, []
+        last = int(node_via[self.node_columns[target]])
+        route = [last]
+        while route[-1] != row:
+            route.append(int(pred[route[-1]]))
+        return remaining + float(node_dist[self.node_columns[target]]), [self.names[r] for r in reversed(route)]
+
+    def route_from_node(self, identity: int, target: int):
+        """
+        Returns best route from a node to a node
+        :return: (cost, list of names of edges to be traversed), or (inf, []) if target can't be reached
+        """
+        self.sync()
+        if identity == target:
+            return 0, []
+        best_cost, best_route = np.inf, []
+        for row in self.out_rows.get(identity, []):
+            cost, route = self.route_from_edge(self.names[row], 0, target)
+            if cost < best_cost:
+                best_cost, best_route = cost, route
+        return best_cost, best_route
+
+    def route_from_location(self, location, target: int):
+        """
+        Returns best route from a location to a node
+        :param location: item of Graph.path_traversed, i.e. node identity or (src, dest, fraction_traversed)
+        :param target: identity of the destination node
+        :return: (cost, list of names of edges to be traversed)
+        """
+        if type(location) == tuple:
+            return self.route_from_edge(str(location[0]) + "_" + str(location[1]), location[2], target)
+        return self.route_from_node(location, target)
+
+    def route_from_current_location(self, target: int):
+        """Returns best route from the last location in graph_obj.path_traversed to target"""
+        if len(self.graph_obj.path_traversed) == 0:
+            raise Exception("Current location is not known yet")
+        return self.route_from_location(self.graph_obj.path_traversed[-1], target)
+
+    def eta(self, target: int, location=None):
+        """
+        Returns estimated time (in seconds) to reach target from location (defaults to current location)
+        """
+        if location is None:
+            cost, route = self.route_from_current_location(target)
+        else:
+            cost, route = self.route_from_location(location, target)
+        return cost / self.walking_speed
@@ -0,0 +1,110 @@
+"""socket_client.py
+Test client of socket_server: streams frames of a video file (or camera) to the server as JPEG, or as SURF
+features extracted here (see feature_wire), and prints the positions pushed back, with the round trip time
+of each frame
+
+    python socket_client.py testData/query.mp4 127.0.0.1 1234 [float32|float16|int8]
+"""
+
+import sys
+import json
+import time
+import asyncio
+import cv2
+import feature_wire
+import socket_server as ss
+
+
+class FrameClient:
+    """
+    Sends frames and receives positions on separate tasks, so frames keep going out while earlier ones are
+    localised, as fast as the server takes them
+
+    Attributes
+    __________
+    round_trips : dict
+        frame index -> time from the frame being sent to its position arriving, in seconds
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 1234, frames_skipped: int = 0, max_width: int = 640,
+                 jpeg_quality: int = 80, options=None, features: str = None, hessian_threshold: int = 2500):
+        self.host = host
+        self.port = port
+        self.frames_skipped = frames_skipped
+        self.max_width = max_width
+        self.jpeg_quality = jpeg_quality
+        self.options = options if options is not None else {}
+        # If features is a descriptor encoding of feature_wire, features are sent instead of frames
+        self.features = features
+        self.detector = cv2.xfeatures2d_SURF.create(hessian_threshold) if features is not None else None
+        self.session_id = None
+        self.sent_at = {}
+        self.round_trips = {}
+
+    async def _send_frames(self, writer, video_path):
+        cap = cv2.VideoCapture(video_path)
+        i = 0
+        try:
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                if i % (self.frames_skipped + 1) == 0:
+                    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                    if gray.shape[1] > self.max_width:
+                        gray = cv2.resize(gray, (self.max_width, gray.shape[0] * self.max_width // gray.shape[1]))
+                    self.sent_at[i] = time.time()
+                    if self.features is not None:
+                        writer.write(ss.pack_message(ss.FEATURES, feature_wire.extract(gray, self.detector, i,
+                                                                                       self.features)))
+                    else:
+                        ret, jpeg = cv2.imencode(".jpg", gray, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+                        writer.write(ss.pack_frame(i, jpeg.tobytes()))
+                    await writer.drain()  # Waits while the server isn't reading, i.e. is behind
+                i = i + 1
+        finally:
+            cap.release()
+        writer.write(ss.pack_message(ss.BYE, b""))
+        await writer.drain()
+
+    async def _receive_positions(self, reader):
+        while True:
+            try:
+                message_type, payload = await ss.read_message(reader, 2 ** 20)
+            except asyncio.IncompleteReadError:
+                return  # Server closed the connection after BYE
+            message = json.loads(payload.decode())
+            if message_type == ss.POSITION:
+                frame_index = message["frame_index"]
+                self.round_trips[frame_index] = time.time() - self.sent_at.pop(frame_index, time.time())
+                print(str(frame_index) + ": " + str(message["edge"]) + " " + str(message["fraction"]) + " (" +
+                      str(message["confidence"]) + ") in " + str(round(self.round_trips[frame_index] * 1000)) +
+                      " ms" + ("" if message["localised"] else ", skipped as " + str(message["skipped"])))
+            elif message_type == ss.ERROR:
+                print("Error: " + str(message))
+
+    async def run(self, video_path):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        writer.write(ss.pack_json(ss.HELLO, self.options))
+        await writer.drain()
+        message_type, payload = await ss.read_message(reader, 2 ** 20)
+        if message_type != ss.SESSION:
+            raise Exception("Server refused session: " + payload.decode())
+        self.session_id = json.loads(payload.decode())["session_id"]
+        print("Session " + self.session_id)
+        receiver = asyncio.get_event_loop().create_task(self._receive_positions(reader))
+        await self._send_frames(writer, video_path)
+        await receiver
+        writer.close()
+        if len(self.round_trips) > 0:
+            print("Frames localised: " + str(len(self.round_trips)) + ", mean round trip " +
+                  str(round(1000 * sum(self.round_trips.values()) / len(self.round_trips))) + " ms")
+
+
+if __name__ == '__main__':
+    video = sys.argv[1] if len(sys.argv) > 1 else "0"
+    video = int(video) if video.isdigit() else video  # camera index
+    client = FrameClient(sys.argv[2] if len(sys.argv) > 2 else "127.0.0.1",
+                         int(sys.argv[3]) if len(sys.argv) > 3 else 1234,
+                         features=sys.argv[4] if len(sys.argv) > 4 else None)
+    asyncio.get_event_loop().run_until_complete(client.run(video))
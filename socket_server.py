@@ -1,29 +1,249 @@
-import socket
+"""socket_server.py
+TCP server streaming query frames from many devices at once to the localisation engine (see
+localisation_engine), and pushing the location found for each frame back on the same connection
+
+Every message, either way, is a 5 byte header of message type (unsigned byte) and payload length (unsigned
+int, big endian) followed by the payload:
+    HELLO    (client) JSON session options (see localisation_engine.SESSION_OPTIONS), or {"session_id": ...}
+             to carry on with an existing session, e.g. after reconnecting
+    SESSION  (server) JSON {"session_id": ..., "session_ttl": ...}
+    FRAME    (client) frame index in the device's video (signed long long, -1 if not known) and JPEG/PNG image
+    FEATURES (client) SURF features extracted by the device, see feature_wire
+    POSITION (server) JSON location of a frame, see localisation_engine.Session.localise
+    ERROR    (server) JSON {"error": ...}
+    BYE      (client) ends the session
+
+Frames of a connection are localised one at a time on a thread pool, in the order they arrive. At most
+queue_size frames wait to be localised, after which the connection isn't read until one is taken, so a
+device sending faster than it is localised is slowed down by TCP flow control rather than filling memory.
+The same holds the other way for a device not reading its positions.
+
+    python socket_server.py new_objects/graph.pkl 1234
+and to try it out, python socket_client.py
+"""
+
 import sys
+import json
+import struct
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import feature_wire
+from localisation_engine import LocalisationEngine, check_options, decode_frame
+
+HEADER = struct.Struct("!BI")
+FRAME_INDEX = struct.Struct("!q")
+HELLO, SESSION, FRAME, POSITION, ERROR, BYE, FEATURES = range(1, 8)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+async def read_message(reader: asyncio.StreamReader, max_size: int):
+    """
+    Reads one message
+    :return: (message type, payload bytes)
+    """
+    message_type, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if length > max_size:
+        raise ProtocolError("Message of " + str(length) + " bytes is larger than " + str(max_size))
+    return message_type, await reader.readexactly(length)
+
+
+def pack_message(message_type: int, payload: bytes):
+    return HEADER.pack(message_type, len(payload)) + payload
+
+
+def pack_json(message_type: int, obj):
+    return pack_message(message_type, json.dumps(obj).encode())
+
+
+def pack_frame(frame_index: int, image: bytes):
+    """Returns FRAME message of encoded image, frame_index None if not known"""
+    return pack_message(FRAME, FRAME_INDEX.pack(-1 if frame_index is None else frame_index) + image)
+
+
+class Connection:
+    """
+    One client connection, with the session it is sending frames of and its frames waiting to be localised
+    """
+
+    def __init__(self, reader, writer, queue_size: int):
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info("peername")
+        self.session = None
+        self.frames = asyncio.Queue(queue_size)  # (session, message type, frame index, payload)
+        self.write_lock = asyncio.Lock()  # messages are written by both the reading and localising tasks
+        self.lost = False  # True once sending to the client failed
+
+    async def send(self, message: bytes):
+        async with self.write_lock:
+            self.writer.write(message)
+            await self.writer.drain()
+
+
+class FrameServer:
+    """
+    Asyncio TCP server of the protocol above
+
+    Attributes
+    __________
+    engine : LocalisationEngine
+    executor : ThreadPoolExecutor
+        threads localising frames, as many as the frames the engine localises at once
+    """
+
+    def __init__(self, engine: LocalisationEngine, host: str = "0.0.0.0", port: int = 1234, queue_size: int = 2,
+                 max_message_size: int = 4 * 2 ** 20):
+        self.engine = engine
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.max_message_size = max_message_size
+        self.executor = ThreadPoolExecutor(engine.max_concurrent)
+        self.server = None
+        self.connections = 0
+        self.frames_received = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        return self
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        self.executor.shutdown(wait=False)
+
+    def _localise(self, session, message_type, frame_index, payload):
+        """Localises FRAME or FEATURES payload, returns (POSITION or ERROR, message)"""
+        if message_type == FEATURES:
+            try:
+                img_obj, params = feature_wire.decode(payload)
+            except feature_wire.WireError as exception:
+                return ERROR, {"error": "Invalid features: " + str(exception)}
+            error = self.engine.check_features(params)
+            if error is not None:
+                return ERROR, {"error": error, "frame_index": img_obj.get_time()}
+            result = self.engine.localise_features(session, img_obj)
+            frame_index = img_obj.get_time()
+        else:
+            gray = decode_frame(payload)
+            if gray is None:
+                return ERROR, {"error": "Invalid image", "frame_index": frame_index}
+            result = self.engine.localise(session, gray, frame_index)
+        if result is None:
+            result = {"frame_index": frame_index, "localised": False, "skipped": "busy"}
+        return POSITION, result
+
+    async def _localise_frames(self, connection: Connection):
+        loop = asyncio.get_event_loop()
+        while True:
+            session, message_type, frame_index, payload = await connection.frames.get()
+            try:
+                if connection.lost:
+                    continue  # frames left are dropped, but still marked done so that the reading task goes on
+                reply, message = await loop.run_in_executor(self.executor, self._localise, session, message_type,
+                                                            frame_index, payload)
+                message["session_id"] = session.session_id
+                await connection.send(pack_json(reply, message))
+            except ConnectionError:
+                self._lose(connection)
+            except Exception as exception:
+                print("Localising frame " + str(frame_index) + " failed: " + repr(exception))
+                try:
+                    await connection.send(pack_json(ERROR, {"error": "Localising frame failed",
+                                                            "frame_index": frame_index}))
+                except ConnectionError:
+                    self._lose(connection)
+            finally:
+                connection.frames.task_done()
 
-# AF_INET = IPV4 and SOCK_STREAM = TCP
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    @staticmethod
+    def _lose(connection: Connection):
+        """Closes connection to a client which can't be sent to any more, so that the reading task ends too"""
+        connection.lost = True
+        connection.writer.close()
 
-# IP = "192.168.43.33"
+    async def _hello(self, connection: Connection, payload: bytes):
+        try:
+            options = json.loads(payload.decode()) if len(payload) > 0 else {}
+        except ValueError:
+            options = None
+        if isinstance(options, dict) and "session_id" in options:
+            session = self.engine.get_session(options["session_id"])
+            if session is None:
+                raise ProtocolError("No such session, it may have expired")
+        else:
+            error = check_options(options)
+            if error is not None:
+                raise ProtocolError(error)
+            # Creating the first session loads the graph, which shouldn't hold up other connections
+            session = await asyncio.get_event_loop().run_in_executor(
+                self.executor, lambda: self.engine.create_session(**options))
+            if session is None:
+                raise ProtocolError("Too many sessions")
+        connection.session = session
+        await connection.send(pack_json(SESSION, {"session_id": session.session_id,
+                                                  "session_ttl": self.engine.session_ttl}))
 
-# vishal lappy ip IP = "10.194.35.37"
-# bindal lappy ip
-IP = "192.168.43.33"
+    async def _handle(self, reader, writer):
+        connection = Connection(reader, writer, self.queue_size)
+        self.connections += 1
+        localiser = asyncio.get_event_loop().create_task(self._localise_frames(connection))
+        try:
+            while True:
+                message_type, payload = await read_message(reader, self.max_message_size)
+                if message_type == HELLO:
+                    await self._hello(connection, payload)
+                elif message_type == FRAME or message_type == FEATURES:
+                    if connection.session is None:
+                        raise ProtocolError("HELLO should be sent before frames")
+                    frame_index = None
+                    if message_type == FRAME:
+                        if len(payload) < FRAME_INDEX.size:
+                            raise ProtocolError("FRAME too short")
+                        frame_index = FRAME_INDEX.unpack_from(payload)[0]
+                        frame_index, payload = None if frame_index < 0 else frame_index, payload[FRAME_INDEX.size:]
+                    self.frames_received += 1
+                    # Waits (and so stops reading) while queue_size frames of the connection are waiting
+                    await connection.frames.put((connection.session, message_type, frame_index, payload))
+                elif message_type == BYE:
+                    await connection.frames.join()  # positions of the frames sent are sent before closing
+                    if connection.session is not None:
+                        self.engine.delete_session(connection.session.session_id)
+                    break
+                else:
+                    raise ProtocolError("Unknown message type " + str(message_type))
+        except ProtocolError as exception:
+            print("Closing connection from " + str(connection.peer) + ": " + str(exception))
+            try:
+                await connection.send(pack_json(ERROR, {"error": str(exception)}))
+            except ConnectionError:
+                pass
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass  # Client went away, its session is kept until it expires so that it can reconnect
+        finally:
+            localiser.cancel()
+            writer.close()
+            self.connections -= 1
 
-try:
-    s.bind((IP, 1234))
-except socket.error as err:
-    print("Bind failed, Error Code" + str(err.args[0]) + ", message: " + err.args[1])
-    sys.exit()
+    def metrics(self):
+        metrics = self.engine.metrics()
+        metrics.update({"connections": self.connections, "frames_received": self.frames_received})
+        return metrics
 
-print("Socket server build successfully")
-s.listen(5)  # listen to maximum of 5 people after adding them to queue
 
-while True:
-    clientsocket, address = s.accept()
-    print(f"Connection from {address} has been extablished")
-    # clientsocket.send(bytes("Welcome to the socket"))
-    # clientsocket.close()
-    burf = clientsocket.recv(64)
-    print(burf)
-s.close()
+if __name__ == '__main__':
+    graph_path = sys.argv[1] if len(sys.argv) > 1 else "new_objects/graph.pkl"
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 1234
+    loop1 = asyncio.get_event_loop()
+    frame_server = loop1.run_until_complete(FrameServer(LocalisationEngine(graph_path), port=port).start())
+    print("Socket server listening on port " + str(port))
+    try:
+        loop1.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        frame_server.close()
+        print(frame_server.metrics())
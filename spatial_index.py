@@ -0,0 +1,146 @@
+"""spatial_index.py
+KD-tree index over node coordinates of a floor, for picking nodes with the mouse
+and answering map coordinate queries
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class NodeIndex:
+    """
+    Nodes are stored in a KD-tree. Newly added nodes are kept in a small buffer which is scanned
+    directly, and deleted nodes are only marked dead, until either grows past rebuild_after and the
+    tree is rebuilt
+
+    Attributes
+    __________
+    floor_no : int
+    rebuild_after : int
+        size of the buffer (added + deleted nodes) after which the tree is rebuilt
+    """
+
+    def __init__(self, floor_no: int = 0, rebuild_after: int = 64):
+        self.floor_no = floor_no
+        self.rebuild_after = rebuild_after
+        self.tree = None
+        self.items = {}  # key -> item
+        self.tree_keys = []  # key of each point of the tree
+        self.tree_xy = np.zeros((0, 2))
+        self.alive = np.zeros(0, dtype=bool)
+        self.pending_keys = []  # keys added after the tree was built
+        self.pending_xy = np.zeros((0, 2))
+        self.rows = {}  # key -> (in_tree, row)
+        self.no_of_dead = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getstate__(self):
+        # The tree is rebuilt after loading instead of being pickled
+        state = self.__dict__.copy()
+        state["tree"] = None
+        return state
+
+    def build(self, keys, coordinates, items=None):
+        """
+        Builds the index from scratch
+        :param keys: list of unique keys (generally node identities)
+        :param coordinates: list of (x, y) of each key
+        :param items: list of objects (generally Node objects) to be returned by queries, defaults to keys
+        :return: None
+        """
+        self.tree_keys = list(keys)
+        self.items = dict(zip(self.tree_keys, items if items is not None else self.tree_keys))
+        self.tree_xy = np.array(coordinates, dtype=np.float64).reshape(-1, 2)
+        self.alive = np.ones(len(self.tree_keys), dtype=bool)
+        self.pending_keys = []
+        self.pending_xy = np.zeros((0, 2))
+        self.rows = {key: (True, row) for row, key in enumerate(self.tree_keys)}
+        self.no_of_dead = 0
+        self.tree = cKDTree(self.tree_xy) if len(self.tree_keys) > 0 else None
+
+    def add(self, key, x, y, item=None):
+        if key in self.rows:
+            raise Exception("Key " + str(key) + " is already present in the index")
+        self.rows[key] = (False, len(self.pending_keys))
+        self.items[key] = item if item is not None else key
+        self.pending_keys.append(key)
+        self.pending_xy = np.vstack((self.pending_xy, (x, y)))
+        self._rebuild_if_needed()
+
+    def remove(self, key):
+        if key not in self.rows:
+            raise Exception("Key " + str(key) + " does not exist in the index")
+        in_tree, row = self.rows.pop(key)
+        del self.items[key]
+        if in_tree:
+            self.alive[row] = False
+            self.no_of_dead += 1
+        else:
+            del self.pending_keys[row]
+            self.pending_xy = np.delete(self.pending_xy, row, axis=0)
+            for i in range(row, len(self.pending_keys)):
+                self.rows[self.pending_keys[i]] = (False, i)
+        self._rebuild_if_needed()
+
+    def nearest(self, x, y, max_distance: float = np.inf):
+        """
+        Returns (item, distance) of the item nearest to (x, y), or (None, inf) if none is within max_distance
+        """
+        self._rebuild_if_needed()
+        best, best_distance = None, np.inf
+        if self.tree is not None and self.no_of_dead < len(self.tree_keys):
+            k = 1
+            while True:
+                # Widening k until an alive point is found, dead points are at most rebuild_after
+                distances, rows = self.tree.query((x, y), k=min(k, len(self.tree_keys)),
+                                                  distance_upper_bound=max_distance)
+                distances, rows = np.atleast_1d(distances), np.atleast_1d(rows)
+                found = False
+                for distance, row in zip(distances.tolist(), rows.tolist()):
+                    if row == len(self.tree_keys):  # no more points within max_distance
+                        found = True
+                        break
+                    if self.alive[row]:
+                        best, best_distance = self.items[self.tree_keys[row]], distance
+                        found = True
+                        break
+                if found or k >= len(self.tree_keys):
+                    break
+                k *= 2
+        if len(self.pending_keys) > 0:
+            distances = np.hypot(self.pending_xy[:, 0] - x, self.pending_xy[:, 1] - y)
+            row = int(np.argmin(distances))
+            if distances[row] < best_distance and distances[row] <= max_distance:
+                best, best_distance = self.items[self.pending_keys[row]], float(distances[row])
+        return best, best_distance
+
+    def within(self, x, y, radius: float, p: float = 2):
+        """
+        Returns list of (item, (x, y)) within radius of (x, y) in the Minkowski p-norm
+        (p = np.inf gives a square box of half side radius)
+        """
+        self._rebuild_if_needed()
+        found = []
+        if self.tree is not None:
+            for row in self.tree.query_ball_point((x, y), radius, p=p):
+                if self.alive[row]:
+                    found.append((self.items[self.tree_keys[row]], tuple(self.tree_xy[row])))
+        if len(self.pending_keys) > 0:
+            offsets = np.abs(self.pending_xy - (x, y))
+            if p == np.inf:
+                distances = offsets.max(axis=1)
+            else:
+                distances = (offsets ** p).sum(axis=1) ** (1 / p)
+            for row in np.nonzero(distances <= radius)[0].tolist():
+                found.append((self.items[self.pending_keys[row]], tuple(self.pending_xy[row])))
+        return found
+
+    def _rebuild_if_needed(self):
+        if self.tree is None and len(self.tree_keys) > 0:
+            self.tree = cKDTree(self.tree_xy)
+        if len(self.pending_keys) + self.no_of_dead >= self.rebuild_after:
+            keys = [key for key, kept in zip(self.tree_keys, self.alive) if kept] + self.pending_keys
+            coordinates = np.vstack((self.tree_xy[self.alive], self.pending_xy))
+            self.build(keys, coordinates, [self.items[key] for key in keys])
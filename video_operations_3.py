@@ -6,6 +6,7 @@ import cv2
 import numpy as np
 import os
 import time
+import threading
 import pickle
 import matcher as mt
 from general import *
@@ -79,6 +80,68 @@ class DistinctFrames:
         return self.img_objects[index]
 
 
+class FrameRing:
+    """
+    Latest capacity ImgObj of a stream of frames, with the same interface as DistinctFrames, where index is
+    the position of the frame in the whole stream (so the latest frame is at no_of_frames() - 1), but only
+    the latest capacity frames can be read. Memory used stays the same however long the stream is.
+
+    If record_path is given, every frame added is also appended (pickled) to that file, which can be replayed
+    with read_recording()
+    """
+
+    def __init__(self, capacity: int = 32, record_path: str = None):
+        if capacity < 1:
+            raise Exception("capacity should be at least 1")
+        self.img_objects = [None] * capacity
+        self.capacity = capacity
+        self.total = 0
+        self.record_path = record_path
+        self.record_file = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["record_file"] = None
+        return state
+
+    def add_img_obj(self, img_obj):
+        if not isinstance(img_obj, ImgObj):
+            raise Exception("Param is not an img object")
+        self.img_objects[self.total % self.capacity] = img_obj
+        self.total += 1
+        if self.record_path is not None:
+            if self.record_file is None:
+                folder = os.path.dirname(self.record_path)
+                if folder != "":
+                    os.makedirs(folder, exist_ok=True)
+                self.record_file = open(self.record_path, "ab")
+            pickle.dump(img_obj, self.record_file, pickle.HIGHEST_PROTOCOL)
+
+    def no_of_frames(self):
+        return self.total
+
+    def get_object(self, index):
+        if index not in range(max(0, self.total - self.capacity), self.total):
+            raise Exception("Invalid index, only the latest " + str(self.capacity) + " frames are kept")
+        return self.img_objects[index % self.capacity]
+
+    def close(self):
+        """Flushes and closes the recording, if any"""
+        if self.record_file is not None:
+            self.record_file.close()
+            self.record_file = None
+
+
+def read_recording(record_path):
+    """Generator of ImgObj recorded by FrameRing at record_path, in the order they were added"""
+    with open(record_path, "rb") as record_file:
+        while True:
+            try:
+                yield pickle.load(record_file)
+            except EOFError:
+                return
+
+
 def variance_of_laplacian(image):
     """Compute the Laplacian of the image and then return the focus measure,
     which is simply the variance of the Laplacian
@@ -121,6 +184,62 @@ def is_blurry_grayscale(gray_image):
     return (variance_of_laplacian(gray_image) < 100)
 
 
+class ChangeDetector:
+    """
+    Tells if a frame is a near duplicate of the last frame processed (e.g. when the user has stopped),
+    by comparing tiny downscaled copies of them, which costs much less than SURF detection
+
+    Parameters
+    ----------
+    size : (width, height) the frames are downscaled to
+    threshold : mean absolute difference (in gray levels) of the downscaled frames, after removing
+        the difference in their mean brightness, below which a frame is a near duplicate
+    max_skipped : no of near duplicates in a row after which a frame is processed anyway
+
+    Frames are checked (is_duplicate) and marked processed (processed) on different threads by
+    query_pipeline.QueryPipeline, so the last frame processed and the count of skipped frames are guarded by lock
+    """
+
+    def __init__(self, size=(32, 24), threshold: float = 4.0, max_skipped: int = 30, idle_sleep: float = 0.01,
+                 max_idle_sleep: float = 0.2):
+        self.size = size
+        self.threshold = threshold
+        self.max_skipped = max_skipped
+        self.idle_sleep = idle_sleep
+        self.max_idle_sleep = max_idle_sleep
+        self.last = None
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    def _thumbnail(self, gray):
+        small = cv2.resize(gray, self.size, interpolation=cv2.INTER_AREA).astype(np.float32)
+        return small - small.mean()
+
+    def is_duplicate(self, gray):
+        """Returns True if gray need not be processed, counting it as skipped"""
+        with self.lock:
+            last, skipped = self.last, self.skipped
+        if last is None or skipped >= self.max_skipped:
+            return False
+        if np.abs(self._thumbnail(gray) - last).mean() >= self.threshold:
+            return False
+        with self.lock:
+            self.skipped += 1
+        return True
+
+    def processed(self, gray):
+        """Makes gray the frame later frames are compared with"""
+        thumbnail = self._thumbnail(gray)
+        with self.lock:
+            self.last = thumbnail
+            self.skipped = 0
+
+    def idle_delay(self):
+        """Returns time (in seconds) to wait before reading the next frame of a live stream, growing with the
+        no of near duplicates in a row"""
+        return min(self.idle_sleep * self.skipped, self.max_idle_sleep)
+
+
 def serialize_keypoints(keypoints):
     index = []
     for point in keypoints:
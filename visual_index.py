@@ -0,0 +1,199 @@
+"""visual_index.py
+Graph wide visual word index over the frames of all edges and nodes, used to find where a query frame
+may be without matching it against every frame (first localisation and recovery after losing track)
+
+Offline, a vocabulary of visual words is trained by clustering SURF descriptors of the graph:
+    python visual_index.py new_objects/graph.pkl new_objects 1000
+which saves vocabulary.pkl and visual_index.pkl in new_objects
+"""
+
+import sys
+import cv2
+import numpy as np
+from scipy.sparse import csr_matrix
+import general
+from graph2 import Graph
+
+
+class Vocabulary:
+    """
+    Visual words, i.e. cluster centres of SURF descriptors. A descriptor is quantized to its nearest word
+
+    Attributes
+    __________
+    words : np.ndarray
+        (no_of_words, descriptor length) float32 cluster centres
+    """
+
+    def __init__(self, words):
+        self.words = np.asarray(words, dtype=np.float32)
+        self.word_norms = (self.words.astype(np.float64) ** 2).sum(axis=1)
+
+    def __len__(self):
+        return len(self.words)
+
+    @staticmethod
+    def train(descriptors, no_of_words: int = 1000, iterations: int = 20, attempts: int = 1):
+        """
+        Clusters descriptors into no_of_words words with k-means
+        :param descriptors: np.ndarray of descriptors, one per row
+        :return: Vocabulary object
+        """
+        descriptors = np.asarray(descriptors, dtype=np.float32)
+        no_of_words = min(no_of_words, len(descriptors))
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, iterations, 1e-3)
+        compactness, labels, centres = cv2.kmeans(descriptors, no_of_words, None, criteria, attempts,
+                                                  cv2.KMEANS_PP_CENTERS)
+        return Vocabulary(centres)
+
+    def quantize(self, descriptors):
+        """Returns np.ndarray of the index of the nearest word of each descriptor"""
+        if descriptors is None or len(descriptors) == 0:
+            return np.zeros(0, dtype=np.int64)
+        descriptors = np.asarray(descriptors, dtype=np.float64)
+        # |d - w| ^ 2 = |d| ^ 2 - 2 d.w + |w| ^ 2, where |d| ^ 2 doesn't change the nearest word
+        distances = self.word_norms[None, :] - 2 * descriptors @ self.words.T.astype(np.float64)
+        return np.argmin(distances, axis=1)
+
+
+def graph_frames(graph_obj: Graph, z: int = 0):
+    """
+    Returns list of (kind, key, frame_index, ImgObj) of every stored frame of the floor, where kind is "edge"
+    (key being the edge name) or "node" (key being the node identity)
+    """
+    frames = []
+    for nd in graph_obj.Nodes[z]:
+        if nd.node_images is not None:
+            for j in range(nd.node_images.no_of_frames()):
+                frames.append(("node", nd.identity, j, nd.node_images.get_object(j)))
+        for edge in nd.links:
+            if edge.distinct_frames is not None:
+                for j in range(edge.distinct_frames.no_of_frames()):
+                    frames.append(("edge", edge.name, j, edge.distinct_frames.get_object(j)))
+    return frames
+
+
+def train_vocabulary(graph_obj: Graph, no_of_words: int = 1000, max_descriptors: int = 200000, z: int = 0,
+                     seed: int = 0):
+    """
+    Trains a vocabulary on (a random sample of at most max_descriptors of) the descriptors of all the frames
+    of the floor
+    :return: Vocabulary object
+    """
+    descriptors = [img_obj.get_elements()[1] for kind, key, j, img_obj in graph_frames(graph_obj, z)]
+    descriptors = np.concatenate([d for d in descriptors if d is not None and len(d) > 0])
+    if len(descriptors) > max_descriptors:
+        sample = np.random.RandomState(seed).choice(len(descriptors), max_descriptors, replace=False)
+        descriptors = descriptors[sample]
+    return Vocabulary.train(descriptors, no_of_words)
+
+
+class VisualIndex:
+    """
+    Inverted index from visual words to the frames containing them, with tf-idf weighting.
+    Every frame is a document with L2 normalised tf-idf weights of its words, and inverted holds the
+    weights with a row (posting list) per word, so that scoring a query frame only reads the posting lists
+    of the words it contains.
+
+    Attributes
+    __________
+    vocabulary : Vocabulary (object)
+    entries : list
+        (kind, key, frame_index) of each row, see graph_frames
+    idf : np.ndarray
+        inverse document frequency of each word
+    inverted : csr_matrix
+        (no of words, no of frames) tf-idf weights
+    map_version : int
+        Graph.map_version the index was built for
+    """
+
+    def __init__(self, vocabulary: Vocabulary):
+        self.vocabulary = vocabulary
+        self.entries = []
+        self.idf = np.zeros(len(vocabulary))
+        self.inverted = csr_matrix((len(vocabulary), 0))
+        self.map_version = None
+        self.z = 0
+
+    def build(self, graph_obj: Graph, z: int = 0):
+        """Indexes all the frames of edges and nodes of floor z of graph_obj"""
+        self.z = z
+        self.entries, rows, cols, counts = [], [], [], []
+        for kind, key, j, img_obj in graph_frames(graph_obj, z):
+            words, word_counts = np.unique(self.vocabulary.quantize(img_obj.get_elements()[1]),
+                                           return_counts=True)
+            rows.append(np.full(len(words), len(self.entries)))
+            cols.append(words)
+            counts.append(word_counts / max(word_counts.sum(), 1))
+            self.entries.append((kind, key, j))
+        no_of_frames, no_of_words = len(self.entries), len(self.vocabulary)
+        if no_of_frames == 0:
+            self.idf = np.zeros(no_of_words)
+            self.inverted = csr_matrix((no_of_words, 0))
+        else:
+            rows, cols, tf = np.concatenate(rows), np.concatenate(cols), np.concatenate(counts)
+            document_frequency = np.bincount(cols, minlength=no_of_words)
+            self.idf = np.log((no_of_frames + 1) / (document_frequency + 1))
+            weights = tf * self.idf[cols]
+            norms = np.sqrt(np.bincount(rows, weights=weights ** 2, minlength=no_of_frames))
+            weights = weights / np.maximum(norms[rows], 1e-12)
+            self.inverted = csr_matrix((weights, (cols, rows)), shape=(no_of_words, no_of_frames))
+        self.map_version = getattr(graph_obj, "map_version", 0)
+
+    def sync(self, graph_obj: Graph):
+        """Rebuilds the index if nodes or edges of graph_obj changed since it was built"""
+        if getattr(graph_obj, "map_version", 0) != self.map_version:
+            self.build(graph_obj, self.z)
+
+    def query(self, descriptors, k: int = 10):
+        """
+        Returns the k frames most similar to a query frame
+        :param descriptors: SURF descriptors of the query frame
+        :return: list of (kind, key, frame_index, score) with decreasing score
+        """
+        words, word_counts = np.unique(self.vocabulary.quantize(descriptors), return_counts=True)
+        if len(words) == 0 or len(self.entries) == 0:
+            return []
+        weights = word_counts / word_counts.sum() * self.idf[words]
+        weights /= max(np.sqrt((weights ** 2).sum()), 1e-12)
+        query_vector = csr_matrix((weights, (np.zeros(len(words), dtype=np.int64), words)),
+                                  shape=(1, len(self.vocabulary)))
+        scores = (query_vector @ self.inverted).tocoo()
+        frames, scores = scores.col, scores.data
+        if len(frames) > k:
+            top = np.argpartition(-scores, k)[:k]
+            frames, scores = frames[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return [self.entries[f] + (float(score),) for f, score in zip(frames[order], scores[order])]
+
+    def candidate_edges(self, graph_obj: Graph, descriptors, k: int = 10):
+        """
+        Returns the edges (and their frames) where a query frame may be, from the k most similar frames.
+        A node frame stands for the first frame of every edge leaving the node
+        :return: list of (Edge, list of frame indexes) in decreasing order of score of their best frame
+        """
+        self.sync(graph_obj)
+        candidates = {}
+        for kind, key, j, score in self.query(descriptors, k):
+            if kind == "edge":
+                src, dest = key.split("_")
+                pairs = [(graph_obj.get_edge(int(src), int(dest), self.z, self.z), j)]
+            else:
+                pairs = [(edge, 0) for edge in graph_obj.get_node(key, self.z).links]
+            for edge, frame_index in pairs:
+                if edge is None or edge.distinct_frames is None:
+                    continue
+                candidates.setdefault(edge.name, (edge, []))[1].append(frame_index)
+        return [(edge, sorted(set(frame_indexes))) for edge, frame_indexes in candidates.values()]
+
+
+if __name__ == '__main__':
+    # python visual_index.py <graph path> <folder to save> [no of words]
+    graph: Graph = Graph.load_graph(sys.argv[1])
+    vocabulary = train_vocabulary(graph, int(sys.argv[3]) if len(sys.argv) > 3 else 1000)
+    index = VisualIndex(vocabulary)
+    index.build(graph)
+    general.save_to_memory(vocabulary, "vocabulary.pkl", sys.argv[2])
+    general.save_to_memory(index, "visual_index.pkl", sys.argv[2])
+    print("Indexed " + str(len(index.entries)) + " frames with " + str(len(vocabulary)) + " words")
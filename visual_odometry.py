@@ -0,0 +1,177 @@
+"""visual_odometry.py
+Cheap estimates of the motion of the camera between consecutive query frames, from sparse optical flow
+"""
+
+import math
+import threading
+import cv2
+import numpy as np
+
+
+def track_points(prev_gray, gray, points, max_error: float = 1.0):
+    """
+    Tracks points from prev_gray to gray with pyramidal Lucas-Kanade, keeping only those tracked back to
+    within max_error pixels of where they started
+    :param points: np.ndarray of shape (n, 1, 2), float32
+    :return: (points in gray, np.ndarray of bool, True for the points tracked)
+    """
+    if points is None or len(points) == 0:
+        return np.zeros((0, 1, 2), np.float32), np.zeros(0, dtype=bool)
+    lk_params = dict(winSize=(21, 21), maxLevel=3,
+                     criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01))
+    next_points, status, error = cv2.calcOpticalFlowPyrLK(prev_gray, gray, points, None, **lk_params)
+    back_points, back_status, error = cv2.calcOpticalFlowPyrLK(gray, prev_gray, next_points, None, **lk_params)
+    drift = np.abs(points - back_points).reshape(-1, 2).max(axis=1)
+    good = (status.ravel() == 1) & (back_status.ravel() == 1) & (drift < max_error)
+    return next_points, good
+
+
+class RotationEstimator:
+    """
+    Estimates the heading change (yaw) of the camera from the horizontal displacement of corners tracked
+    between consecutive query frames. Walking forward moves points away from the centre on both sides, so
+    the median displacement is mostly due to rotation: a turn of yaw degrees moves the scene sideways by
+    focal_length * tan(yaw) pixels.
+
+    Attributes
+    __________
+    heading_change : float
+        heading change in degrees since the last reset, anticlockwise positive as in Edge.angles
+    no_of_frames : int
+        no of frames over which heading_change was accumulated
+    lock : threading.Lock
+        guards heading_change and no_of_frames, as frames are fed (update) and the heading is reset (reset)
+        on different threads by query_pipeline.QueryPipeline
+    """
+
+    def __init__(self, fov: float = 60, max_corners: int = 200, min_points: int = 10):
+        self.fov = fov  # horizontal field of view of the camera in degrees
+        self.max_corners = max_corners
+        self.min_points = min_points  # frames with fewer points tracked don't change heading_change
+        self.prev_gray = None
+        self.heading_change = 0.0
+        self.no_of_frames = 0
+        self.lock = threading.Lock()
+
+    def reset(self):
+        """Starts accumulating heading change afresh, e.g. when the user is known to be walking along an edge"""
+        with self.lock:
+            self.heading_change = 0.0
+            self.no_of_frames = 0
+
+    def update(self, gray):
+        """
+        Adds the rotation between the previous frame and gray to heading_change
+        :param gray: grayscale query frame
+        :return: rotation in degrees between the two frames, 0 if it couldn't be estimated
+        """
+        prev_gray, self.prev_gray = self.prev_gray, gray
+        if prev_gray is None or prev_gray.shape != gray.shape:
+            return 0.0
+        corners = cv2.goodFeaturesToTrack(prev_gray, self.max_corners, 0.01, 8)
+        points, good = track_points(prev_gray, gray, corners)
+        if good.sum() < self.min_points:
+            return 0.0
+        dx = float(np.median((points - corners)[good, 0, 0]))
+        focal_length = gray.shape[1] / (2 * math.tan(math.radians(self.fov) / 2))
+        # Scene moving right (dx > 0) means the camera turned left, i.e. anticlockwise
+        yaw = math.degrees(math.atan(dx / focal_length))
+        with self.lock:
+            self.heading_change += yaw
+            self.no_of_frames += 1
+        return yaw
+
+
+def rank_turns(turns, heading_change: float, max_error: float = 45, min_turn: float = 30):
+    """
+    Orders the edges leaving a node by how well their turn angle agrees with the heading change measured
+    :param turns: list of (edge_name, angle) as in Edge.angles
+    :param heading_change: heading change in degrees, anticlockwise positive
+    :param max_error: once |heading_change| >= min_turn (i.e. the user has clearly turned), edges whose
+    angle differs from it by more than max_error are dropped
+    :return: list of (edge_name, angle, error) with increasing error
+    """
+    ranked = []
+    for edge_name, angle in turns:
+        error = abs((angle - heading_change + 180) % 360 - 180)
+        if abs(heading_change) >= min_turn and error > max_error:
+            continue
+        ranked.append((edge_name, angle, error))
+    return sorted(ranked, key=lambda x: x[2])
+
+
+class KLTTracker:
+    """
+    Follows corners from the last query frame that was fully matched (the reference frame) through the
+    following frames, to tell when the scene has changed enough to need SURF detection and matching again:
+    when less than min_overlap of the corners can still be tracked, when the corners have spread out by more
+    than max_progress (i.e. the user has walked forward that much), or every refresh_interval frames.
+
+    Attributes
+    __________
+    overlap : float
+        fraction of corners of the reference frame still tracked
+    progress : float
+        forward progress since the reference frame, as the relative increase in spread of the corners tracked
+    frames_tracked : int
+        no of frames tracked since the reference frame
+    lock : threading.Lock
+        guards the reference frame and the points tracked, as frames are tracked (track) and the reference
+        frame replaced (start) on different threads by query_pipeline.QueryPipeline. Optical flow is computed
+        outside it, and a frame tracked from a reference frame replaced meanwhile is to be fully matched
+    """
+
+    def __init__(self, min_overlap: float = 0.5, max_progress: float = 0.25, refresh_interval: int = 10,
+                 max_corners: int = 300, min_corners: int = 30):
+        self.min_overlap = min_overlap
+        self.max_progress = max_progress
+        self.refresh_interval = refresh_interval
+        self.max_corners = max_corners
+        self.min_corners = min_corners  # reference frames with fewer corners are not tracked
+        self.prev_gray = None
+        self.start_points = None
+        self.points = None
+        self.no_of_corners = 0
+        self.overlap = 0.0
+        self.progress = 0.0
+        self.frames_tracked = 0
+        self.reference = 0  # no of reference frames started, tells if it changed while a frame was tracked
+        self.lock = threading.Lock()
+
+    def start(self, gray):
+        """Makes gray (a frame which has just been fully matched) the reference frame"""
+        corners = cv2.goodFeaturesToTrack(gray, self.max_corners, 0.01, 8)
+        with self.lock:
+            self.prev_gray = gray
+            self.points = corners if corners is not None else np.zeros((0, 1, 2), np.float32)
+            self.start_points = self.points
+            self.no_of_corners = len(self.points)
+            self.overlap = 1.0
+            self.progress = 0.0
+            self.frames_tracked = 0
+            self.reference += 1
+
+    def track(self, gray):
+        """
+        Tracks the corners into gray
+        :return: True if gray is similar enough to the reference frame to skip matching it, False if it
+        should be fully matched (after which start() should be called with it)
+        """
+        with self.lock:
+            if self.prev_gray is None or self.no_of_corners < self.min_corners or \
+                    self.prev_gray.shape != gray.shape:
+                return False
+            prev_gray, prev_points, reference = self.prev_gray, self.points, self.reference
+        points, good = track_points(prev_gray, gray, prev_points)
+        with self.lock:
+            if self.reference != reference:
+                return False  # start() was called meanwhile, the points tracked are of the old reference frame
+            self.start_points, self.points, self.prev_gray = self.start_points[good], points[good], gray
+            self.frames_tracked += 1
+            self.overlap = len(self.points) / self.no_of_corners
+            if len(self.points) >= 2:
+                start_spread = np.linalg.norm(self.start_points - self.start_points.mean(axis=0), axis=2)
+                spread = np.linalg.norm(self.points - self.points.mean(axis=0), axis=2)
+                self.progress = float(np.median(spread / np.maximum(start_spread, 1e-6))) - 1
+            return self.overlap >= self.min_overlap and self.progress <= self.max_progress and \
+                self.frames_tracked < self.refresh_interval